@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
-import stepper, homing
+import stepper, homing, mcu
 
 StepList = (0, 1, 2)
 
@@ -41,6 +41,22 @@ class CartKinematics:
             printer.lookup_object('gcode').register_command(
                 'SET_DUAL_CARRIAGE', self.cmd_SET_DUAL_CARRIAGE,
                 desc=self.cmd_SET_DUAL_CARRIAGE_help)
+        # Setup step generation
+        self.use_itersolve = config.getchoice(
+            'step_solver', {'analytic': False, 'iterative': True}, 'analytic')
+        if self.use_itersolve:
+            steppers = zip('xyz', self.steppers)
+            if self.dual_carriage_axis is not None:
+                steppers.append(('xy'[self.dual_carriage_axis],
+                                 self.dual_carriage_steppers[1]))
+            for axis, s in steppers:
+                for mcu_stepper in s.get_mcu_steppers():
+                    mcu_stepper.setup_itersolve('cartesian_stepper_alloc', axis)
+        self._build_step_group()
+    def _build_step_group(self):
+        self.step_group = mcu.StepperGroup([
+            (s, i) for i in StepList
+            for s in self.steppers[i].get_mcu_steppers()])
     def get_steppers(self, flags=""):
         if flags == "Z":
             return [self.steppers[2]]
@@ -139,34 +155,11 @@ class CartKinematics:
     def move(self, print_time, move):
         if self.need_motor_enable:
             self._check_motor_enable(print_time, move)
-        for i in StepList:
-            axis_d = move.axes_d[i]
-            if not axis_d:
-                continue
-            step_const = self.steppers[i].step_const
-            move_time = print_time
-            start_pos = move.start_pos[i]
-            axis_r = abs(axis_d) / move.move_d
-            accel = move.accel * axis_r
-            cruise_v = move.cruise_v * axis_r
-
-            # Acceleration steps
-            if move.accel_r:
-                accel_d = move.accel_r * axis_d
-                step_const(move_time, start_pos, accel_d,
-                           move.start_v * axis_r, accel)
-                start_pos += accel_d
-                move_time += move.accel_t
-            # Cruising steps
-            if move.cruise_r:
-                cruise_d = move.cruise_r * axis_d
-                step_const(move_time, start_pos, cruise_d, cruise_v, 0.)
-                start_pos += cruise_d
-                move_time += move.cruise_t
-            # Deceleration steps
-            if move.decel_r:
-                decel_d = move.decel_r * axis_d
-                step_const(move_time, start_pos, decel_d, cruise_v, -accel)
+        if self.use_itersolve:
+            self.step_group.step_itersolve(print_time, move)
+            return
+        self.step_group.step_move(
+            print_time, move, move.start_pos, move.axes_d)
     # Dual carriage support
     def _activate_carriage(self, carriage):
         toolhead = self.printer.lookup_object('toolhead')
@@ -174,6 +167,7 @@ class CartKinematics:
         dc_stepper = self.dual_carriage_steppers[carriage]
         dc_axis = self.dual_carriage_axis
         self.steppers[dc_axis] = dc_stepper
+        self._build_step_group()
         extruder_pos = toolhead.get_position()[3]
         toolhead.set_position(self.get_position() + [extruder_pos])
         if self.limits[dc_axis][0] <= self.limits[dc_axis][1]:
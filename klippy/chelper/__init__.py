@@ -12,9 +12,16 @@ import cffi
 ######################################################################
 
 COMPILE_CMD = "gcc -Wall -g -O2 -shared -fPIC -o %s %s"
-SOURCE_FILES = ['stepcompress.c', 'serialqueue.c', 'pyhelper.c']
+SOURCE_FILES = [
+    'stepcompress.c', 'serialqueue.c', 'msgblock.c', 'lookahead.c',
+    'pyhelper.c', 'itersolve.c', 'kin_cartesian.c', 'kin_corexy.c',
+    'kin_delta.c'
+]
 DEST_LIB = "c_helper.so"
-OTHER_FILES = ['list.h', 'serialqueue.h', 'pyhelper.h']
+OTHER_FILES = [
+    'list.h', 'serialqueue.h', 'msgblock.h', 'pyhelper.h', 'stepcompress.h',
+    'itersolve.h'
+]
 
 defs_stepcompress = """
     struct stepcompress *stepcompress_alloc(uint32_t max_error
@@ -22,8 +29,20 @@ defs_stepcompress = """
         , uint32_t invert_sdir, uint32_t oid);
     void stepcompress_free(struct stepcompress *sc);
     int stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock);
+    int stepcompress_flush(struct stepcompress *sc, uint64_t move_clock);
     int stepcompress_set_homing(struct stepcompress *sc, uint64_t homing_clock);
     int stepcompress_queue_msg(struct stepcompress *sc, uint32_t *data, int len);
+    int stepcompress_set_capture(struct stepcompress *sc, const char *filename);
+    void stepcompress_set_fast_mode(struct stepcompress *sc, int fast_mode);
+    void stepcompress_set_max_error(struct stepcompress *sc
+        , uint32_t max_error);
+    void stepcompress_get_stats(struct stepcompress *sc, char *buf, int len);
+    struct stepcompress_replay {
+        uint32_t oid, max_error, peak_error;
+        uint64_t steps, messages, bytes;
+    };
+    int stepcompress_replay(uint32_t *data, int len, const char *out_filename
+        , int fast_mode, struct stepcompress_replay *res);
 
     int32_t stepcompress_push(struct stepcompress *sc, double step_clock
         , int32_t sdir);
@@ -32,13 +51,68 @@ defs_stepcompress = """
     int32_t stepcompress_push_delta(struct stepcompress *sc
         , double clock_offset, double move_sd, double start_sv, double accel
         , double height, double startxy_sd, double arm_d, double movez_r);
+    int32_t stepcompress_push_move(struct stepcompress **sc_list, int sc_num
+        , double *sparams, double print_time, double move_d, double accel
+        , double start_v, double cruise_v
+        , double accel_r, double cruise_r, double decel_r
+        , double accel_t, double cruise_t);
+    int32_t stepcompress_push_delta_move(struct stepcompress **sc_list
+        , int sc_num, double *sparams, double print_time, double accel
+        , double start_v, double cruise_v
+        , double accel_d, double cruise_d, double decel_d
+        , double accel_t, double cruise_t, double movexy_r, double movez_r);
 
     struct steppersync *steppersync_alloc(struct serialqueue *sq
         , struct stepcompress **sc_list, int sc_num, int move_num);
     void steppersync_free(struct steppersync *ss);
-    void steppersync_set_time(struct steppersync *ss
+    int steppersync_set_time(struct steppersync *ss
         , double time_offset, double mcu_freq);
     int steppersync_flush(struct steppersync *ss, uint64_t move_clock);
+    int steppersync_set_threads(struct steppersync *ss, int num_threads);
+    void steppersync_get_stats(struct steppersync *ss, char *buf, int len);
+"""
+
+defs_itersolve = """
+    struct move *move_alloc(void);
+    void move_fill(struct move *m, double print_time
+        , double accel_t, double cruise_t, double decel_t
+        , double start_pos_x, double start_pos_y, double start_pos_z
+        , double axes_d_x, double axes_d_y, double axes_d_z
+        , double start_v, double cruise_v, double accel);
+    int32_t itersolve_gen_steps(struct stepper_kinematics *sk
+        , struct move *m, double *step_pos);
+    int32_t itersolve_gen_steps_move(struct stepper_kinematics **sk_list
+        , int sk_num, double *step_pos, struct move *m);
+    void itersolve_set_stepcompress(struct stepper_kinematics *sk
+        , struct stepcompress *sc, double step_dist);
+"""
+
+defs_kin_cartesian = """
+    struct stepper_kinematics *cartesian_stepper_alloc(char axis);
+"""
+
+defs_kin_corexy = """
+    struct stepper_kinematics *corexy_stepper_alloc(char type);
+"""
+
+defs_kin_delta = """
+    struct stepper_kinematics *delta_stepper_alloc(double arm2
+        , double tower_x, double tower_y);
+"""
+
+defs_lookahead = """
+    struct lookahead *lookahead_alloc(void);
+    void lookahead_free(struct lookahead *lq);
+    void lookahead_reset(struct lookahead *lq);
+    double lookahead_add_move(struct lookahead *lq, double move_d
+        , double accel, double axis_x, double axis_y, double axis_z
+        , int is_kinematic_move, double max_cruise_v2, double delta_v2
+        , double smooth_delta_v2, double junction_deviation
+        , double extruder_v2);
+    int lookahead_flush(struct lookahead *lq, int leftover, int lazy);
+    void lookahead_get_junctions(struct lookahead *lq, int start, int end
+        , double *out);
+    void lookahead_pop(struct lookahead *lq, int count);
 """
 
 defs_serialqueue = """
@@ -48,8 +122,24 @@ defs_serialqueue = """
         int len;
         double sent_time, receive_time;
     };
+    #define SQ_RTT_BUCKETS 32
+    struct serialqueue_stats {
+        uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+        uint64_t send_seq, receive_seq, retransmit_seq;
+        double srtt, rttvar, rto;
+        int ready_bytes, stalled_bytes, need_ack_bytes;
+        int send_window, receive_window, pending_queues;
+        uint32_t rtt_count, rtt_hist[SQ_RTT_BUCKETS];
+    };
+    struct commandqueue_stats {
+        int ready_msgs, ready_bytes, stalled_msgs, stalled_bytes;
+    };
 
+    struct serialengine *serialengine_alloc(void);
+    void serialengine_free(struct serialengine *se);
     struct serialqueue *serialqueue_alloc(int serial_fd, int write_only);
+    struct serialqueue *serialqueue_alloc_engine(int serial_fd, int write_only
+        , struct serialengine *se);
     void serialqueue_exit(struct serialqueue *sq);
     void serialqueue_free(struct serialqueue *sq);
     struct command_queue *serialqueue_alloc_commandqueue(void);
@@ -59,18 +149,39 @@ defs_serialqueue = """
     void serialqueue_encode_and_send(struct serialqueue *sq
         , struct command_queue *cq, uint32_t *data, int len
         , uint64_t min_clock, uint64_t req_clock);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *pqm, int max);
+    int serialqueue_pull_pending(struct serialqueue *sq
+        , struct pull_queue_message *pqm, int max);
+    void serialqueue_set_receive_notify(struct serialqueue *sq, int fd);
     void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
     void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
     void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
         , double last_clock_time, uint64_t last_clock);
     void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
+    void serialqueue_fill_stats(struct serialqueue *sq
+        , struct serialqueue_stats *stats);
+    void serialqueue_fill_commandqueue_stats(struct serialqueue *sq
+        , struct command_queue *cq, struct commandqueue_stats *stats);
     int serialqueue_extract_old(struct serialqueue *sq, int sentq
         , struct pull_queue_message *q, int max);
 """
 
+defs_msgblock = """
+    uint16_t msgblock_crc16_ccitt(uint8_t *buf, int len);
+    int msgblock_encode(uint32_t msgid, uint8_t *param_types, int num_params
+        , int64_t *params, uint8_t *buf, int maxlen);
+    int msgblock_parse(uint8_t *param_types, int num_params
+        , void *data, int pos, int len, int64_t *params);
+"""
+
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
+    double get_thread_cputime(void);
+    int create_timerfd(void);
+    int set_timerfd(int fd, double waketime);
+    void free(void*);
 """
 
 # Return the list of file modification times
@@ -108,7 +219,13 @@ def get_ffi():
                          , OTHER_FILES)
         FFI_main = cffi.FFI()
         FFI_main.cdef(defs_stepcompress)
+        FFI_main.cdef(defs_itersolve)
+        FFI_main.cdef(defs_kin_cartesian)
+        FFI_main.cdef(defs_kin_corexy)
+        FFI_main.cdef(defs_kin_delta)
+        FFI_main.cdef(defs_lookahead)
         FFI_main.cdef(defs_serialqueue)
+        FFI_main.cdef(defs_msgblock)
         FFI_main.cdef(defs_pyhelper)
         FFI_lib = FFI_main.dlopen(os.path.join(srcdir, DEST_LIB))
         # Setup error logging
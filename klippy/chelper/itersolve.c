@@ -0,0 +1,254 @@
+// Iterative solver for kinematic moves
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// Instead of using a hand derived formula for the time of each step,
+// the code in this file finds step times by repeatedly evaluating the
+// position of a stepper at a given time during a move.  A kinematic
+// only needs to provide a calc_position() callback that returns the
+// stepper position for a given cartesian coordinate.
+
+#include <math.h> // sqrt
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "itersolve.h" // struct coord
+#include "pyhelper.h" // unlikely
+#include "stepcompress.h" // queue_append_start
+
+
+/****************************************************************
+ * Kinematic moves
+ ****************************************************************/
+
+struct move *
+move_alloc(void)
+{
+    struct move *m = malloc(sizeof(*m));
+    memset(m, 0, sizeof(*m));
+    return m;
+}
+
+// Populate a 'struct move' with a velocity trapezoid
+void
+move_fill(struct move *m, double print_time
+          , double accel_t, double cruise_t, double decel_t
+          , double start_pos_x, double start_pos_y, double start_pos_z
+          , double axes_d_x, double axes_d_y, double axes_d_z
+          , double start_v, double cruise_v, double accel)
+{
+    // Setup velocity trapezoid
+    m->print_time = print_time;
+    m->move_t = accel_t + cruise_t + decel_t;
+    m->accel_t = accel_t;
+    m->accel_start_v = start_v;
+    m->accel_half_accel = .5 * accel;
+    m->cruise_t = cruise_t;
+    m->cruise_start_d = accel_t * .5 * (cruise_v + start_v);
+    m->cruise_v = cruise_v;
+    m->decel_start_d = m->cruise_start_d + cruise_t * cruise_v;
+    m->decel_start_v = cruise_v;
+    m->decel_half_accel = -.5 * accel;
+
+    // Setup for move_get_coord()
+    m->start_pos.x = start_pos_x;
+    m->start_pos.y = start_pos_y;
+    m->start_pos.z = start_pos_z;
+    double inv_move_d = 1. / sqrt(axes_d_x*axes_d_x + axes_d_y*axes_d_y
+                                  + axes_d_z*axes_d_z);
+    m->axes_r.x = axes_d_x * inv_move_d;
+    m->axes_r.y = axes_d_y * inv_move_d;
+    m->axes_r.z = axes_d_z * inv_move_d;
+}
+
+// Find the distance travel during a move
+double
+move_get_distance(struct move *m, double move_time)
+{
+    if (move_time < m->accel_t)
+        // Acceleration phase of move
+        return (m->accel_start_v + m->accel_half_accel * move_time) * move_time;
+    move_time -= m->accel_t;
+    if (move_time < m->cruise_t)
+        // Cruising phase
+        return m->cruise_start_d + m->cruise_v * move_time;
+    // Deceleration phase
+    move_time -= m->cruise_t;
+    return m->decel_start_d + (m->decel_start_v
+                               + m->decel_half_accel * move_time) * move_time;
+}
+
+// Return the XYZ coordinates given a time in a move
+struct coord
+move_get_coord(struct move *m, double move_time)
+{
+    double move_dist = move_get_distance(m, move_time);
+    return (struct coord) {
+        .x = m->start_pos.x + m->axes_r.x * move_dist,
+        .y = m->start_pos.y + m->axes_r.y * move_dist,
+        .z = m->start_pos.z + m->axes_r.z * move_dist };
+}
+
+
+/****************************************************************
+ * Iterative solver
+ ****************************************************************/
+
+struct timepos {
+    double time, position;
+};
+
+// Maximum time between position checks when searching for a step (a
+// reversal in direction shorter than this may be missed)
+#define SEEK_TIME_MAX 0.000100
+
+// Find step using "false position" method (with the "Illinois"
+// modification to avoid slow convergence from one side)
+static struct timepos
+itersolve_find_step(struct stepper_kinematics *sk, struct move *m
+                    , struct timepos low, struct timepos high
+                    , double target)
+{
+    sk_callback calc_position = sk->calc_position;
+    double inv_step_dist = sk->inv_step_dist;
+    struct timepos best_guess = high;
+    low.position -= target;
+    high.position -= target;
+    if (!high.position)
+        // The high range was a perfect guess for the next step
+        return best_guess;
+    int high_sign = signbit(high.position);
+    if (high_sign == signbit(low.position))
+        // The target is not in the low/high range - return low range
+        return (struct timepos){ low.time, target };
+    int prev_sign = -1;
+    for (;;) {
+        double guess_time = ((low.time*high.position - high.time*low.position)
+                             / (high.position - low.position));
+        if (fabs(guess_time - best_guess.time) <= .000000001)
+            break;
+        best_guess.time = guess_time;
+        best_guess.position = calc_position(sk, m, guess_time) * inv_step_dist;
+        double guess_position = best_guess.position - target;
+        int guess_sign = signbit(guess_position);
+        if (guess_sign == high_sign) {
+            high.time = guess_time;
+            high.position = guess_position;
+            if (guess_sign == prev_sign)
+                low.position *= .5;
+        } else {
+            low.time = guess_time;
+            low.position = guess_position;
+            if (guess_sign == prev_sign)
+                high.position *= .5;
+        }
+        prev_sign = guess_sign;
+    }
+    return best_guess;
+}
+
+// Generate step times for a stepper during a move.  The 'step_pos'
+// parameter is the commanded position of the stepper (in steps) and
+// is updated on return.
+int32_t
+itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m
+                    , double *step_pos)
+{
+    struct stepcompress *sc = sk->sc;
+    int ret = stepcompress_run_jobs(sc);
+    if (ret)
+        return ret;
+    sk_callback calc_position = sk->calc_position;
+    double inv_step_dist = sk->inv_step_dist, half_step = .5;
+    double mcu_freq = stepcompress_get_mcu_freq(sc);
+    struct timepos last = { 0., *step_pos };
+    struct timepos low = { 0., calc_position(sk, m, 0.) * inv_step_dist };
+    struct timepos high = low;
+    double seek_time_delta = SEEK_TIME_MAX;
+    int sdir = stepcompress_get_step_dir(sc), steps = 0;
+    struct queue_append qa = queue_append_start(sc, m->print_time, .5);
+    for (;;) {
+        // Determine if next step is in forward or reverse direction
+        double dist = high.position - last.position;
+        if (fabs(dist) < half_step) {
+        seek_new_high_range:
+            if (high.time >= m->move_t)
+                // At end of move
+                break;
+            // Need to increase next step search range
+            low = high;
+            high.time = last.time + seek_time_delta;
+            seek_time_delta += seek_time_delta;
+            if (high.time <= low.time || high.time > low.time + SEEK_TIME_MAX)
+                high.time = low.time + SEEK_TIME_MAX;
+            if (high.time > m->move_t)
+                high.time = m->move_t;
+            high.position = calc_position(sk, m, high.time) * inv_step_dist;
+            continue;
+        }
+        int next_sdir = dist > 0.;
+        if (unlikely(next_sdir != sdir)) {
+            // Direction change
+            if (fabs(dist) < half_step + .000000001)
+                // Only change direction if going past midway point
+                goto seek_new_high_range;
+            if (steps && last.time >= low.time && high.time > last.time) {
+                // Must seek new low range to avoid re-finding previous time
+                high.time = (last.time + high.time) * .5;
+                high.position = calc_position(sk, m, high.time) * inv_step_dist;
+                continue;
+            }
+            ret = queue_append_set_next_step_dir(&qa, next_sdir);
+            if (ret)
+                return ret;
+            sdir = next_sdir;
+        }
+        // Find step
+        double target = last.position + (sdir ? half_step : -half_step);
+        struct timepos next = itersolve_find_step(sk, m, low, high, target);
+        // Add step at given time
+        ret = queue_append(&qa, next.time * mcu_freq);
+        if (ret)
+            return ret;
+        steps++;
+        seek_time_delta = next.time - last.time;
+        if (seek_time_delta < .000000001)
+            seek_time_delta = .000000001;
+        last.position = target + (sdir ? half_step : -half_step);
+        last.time = next.time;
+        low = next;
+    }
+    queue_append_finish(qa);
+    *step_pos = last.position;
+    return 0;
+}
+
+// Generate the steps of a move for a list of steppers
+int32_t
+itersolve_gen_steps_move(struct stepper_kinematics **sk_list, int sk_num
+                         , double *step_pos, struct move *m)
+{
+    int active_flags = ((m->axes_r.x ? AF_X : 0) | (m->axes_r.y ? AF_Y : 0)
+                        | (m->axes_r.z ? AF_Z : 0));
+    int i;
+    for (i=0; i<sk_num; i++) {
+        struct stepper_kinematics *sk = sk_list[i];
+        if (!(sk->active_flags & active_flags))
+            continue;
+        int32_t ret = itersolve_gen_steps(sk, m, &step_pos[i]);
+        if (ret)
+            return ret;
+    }
+    return 0;
+}
+
+// Associate a stepcompress object with a stepper_kinematics object
+void
+itersolve_set_stepcompress(struct stepper_kinematics *sk
+                           , struct stepcompress *sc, double step_dist)
+{
+    sk->sc = sc;
+    sk->step_dist = step_dist;
+    sk->inv_step_dist = 1. / step_dist;
+}
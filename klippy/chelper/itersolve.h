@@ -0,0 +1,50 @@
+#ifndef ITERSOLVE_H
+#define ITERSOLVE_H
+
+#include <stdint.h> // int32_t
+
+struct coord {
+    double x, y, z;
+};
+
+struct move {
+    double print_time, move_t;
+    double accel_t, accel_start_v, accel_half_accel;
+    double cruise_t, cruise_start_d, cruise_v;
+    double decel_start_d, decel_start_v, decel_half_accel;
+    struct coord start_pos, axes_r;
+};
+
+struct move *move_alloc(void);
+void move_fill(struct move *m, double print_time
+               , double accel_t, double cruise_t, double decel_t
+               , double start_pos_x, double start_pos_y, double start_pos_z
+               , double axes_d_x, double axes_d_y, double axes_d_z
+               , double start_v, double cruise_v, double accel);
+double move_get_distance(struct move *m, double move_time);
+struct coord move_get_coord(struct move *m, double move_time);
+
+struct stepper_kinematics;
+typedef double (*sk_callback)(struct stepper_kinematics *sk, struct move *m
+                              , double move_time);
+
+enum {
+    AF_X = 1 << 0, AF_Y = 1 << 1, AF_Z = 1 << 2,
+};
+
+struct stepper_kinematics {
+    double step_dist, inv_step_dist;
+    struct stepcompress *sc;
+    int active_flags;
+    sk_callback calc_position;
+};
+
+int32_t itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m
+                            , double *step_pos);
+int32_t itersolve_gen_steps_move(struct stepper_kinematics **sk_list
+                                 , int sk_num, double *step_pos
+                                 , struct move *m);
+void itersolve_set_stepcompress(struct stepper_kinematics *sk
+                                , struct stepcompress *sc, double step_dist);
+
+#endif // itersolve.h
@@ -0,0 +1,41 @@
+// CoreXY kinematics stepper pulse time generation
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "itersolve.h" // move_get_coord
+#include "pyhelper.h" // errorf
+
+static double
+corexy_stepper_plus_calc_position(struct stepper_kinematics *sk
+                                  , struct move *m, double move_time)
+{
+    struct coord c = move_get_coord(m, move_time);
+    return c.x + c.y;
+}
+
+static double
+corexy_stepper_minus_calc_position(struct stepper_kinematics *sk
+                                   , struct move *m, double move_time)
+{
+    struct coord c = move_get_coord(m, move_time);
+    return c.x - c.y;
+}
+
+struct stepper_kinematics *
+corexy_stepper_alloc(char type)
+{
+    struct stepper_kinematics *sk = malloc(sizeof(*sk));
+    memset(sk, 0, sizeof(*sk));
+    if (type == '+')
+        sk->calc_position = corexy_stepper_plus_calc_position;
+    else if (type == '-')
+        sk->calc_position = corexy_stepper_minus_calc_position;
+    else
+        errorf("corexy_stepper_alloc invalid type %c", type);
+    sk->active_flags = AF_X | AF_Y;
+    return sk;
+}
@@ -0,0 +1,40 @@
+// Delta kinematics stepper pulse time generation
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // sqrt
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "itersolve.h" // move_get_coord
+#include "list.h" // container_of
+
+struct delta_stepper {
+    struct stepper_kinematics sk;
+    double arm2, tower_x, tower_y;
+};
+
+static double
+delta_stepper_calc_position(struct stepper_kinematics *sk, struct move *m
+                            , double move_time)
+{
+    struct delta_stepper *ds = container_of(sk, struct delta_stepper, sk);
+    struct coord c = move_get_coord(m, move_time);
+    double dx = ds->tower_x - c.x, dy = ds->tower_y - c.y;
+    return sqrt(ds->arm2 - dx*dx - dy*dy) + c.z;
+}
+
+struct stepper_kinematics *
+delta_stepper_alloc(double arm2, double tower_x, double tower_y)
+{
+    struct delta_stepper *ds = malloc(sizeof(*ds));
+    memset(ds, 0, sizeof(*ds));
+    ds->arm2 = arm2;
+    ds->tower_x = tower_x;
+    ds->tower_y = tower_y;
+    ds->sk.calc_position = delta_stepper_calc_position;
+    ds->sk.active_flags = AF_X | AF_Y | AF_Z;
+    return &ds->sk;
+}
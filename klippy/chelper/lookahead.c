@@ -0,0 +1,273 @@
+// Toolhead move "look-ahead" velocity planning
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// This is a C implementation of the junction and trapezoid
+// calculations found in the MoveQueue and Move classes of
+// toolhead.py.  The results must exactly match the python code, so
+// the floating point operations below are performed in the same
+// order as the python code and fused multiply-add contraction is
+// disabled.
+
+#pragma GCC optimize ("fp-contract=off")
+
+#include <math.h> // sqrt
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "pyhelper.h" // errorf
+
+struct lookahead_move {
+    // Move parameters
+    double move_d, accel, axes_d[3];
+    double max_cruise_v2, delta_v2, smooth_delta_v2;
+    double max_start_v2, max_smoothed_v2;
+    int is_kinematic_move;
+    // Results of lookahead (copied out by lookahead_get_junctions())
+    double accel_r, cruise_r, decel_r, start_v, cruise_v, end_v;
+    double accel_t, cruise_t, decel_t;
+};
+
+#define JUNCTION_FIELDS 9
+
+struct lookahead_delayed {
+    struct lookahead_move *move;
+    double start_v2, end_v2;
+};
+
+struct lookahead {
+    struct lookahead_move *moves;
+    struct lookahead_delayed *delayed;
+    int count, alloc;
+};
+
+// Equivalent of python's min(a, b) (returns 'a' on a tie)
+static inline double
+py_min(double a, double b)
+{
+    return b < a ? b : a;
+}
+
+// Equivalent of python's max(a, b) (returns 'a' on a tie)
+static inline double
+py_max(double a, double b)
+{
+    return b > a ? b : a;
+}
+
+// Allocate a new 'lookahead' object
+struct lookahead *
+lookahead_alloc(void)
+{
+    struct lookahead *lq = malloc(sizeof(*lq));
+    memset(lq, 0, sizeof(*lq));
+    return lq;
+}
+
+// Free memory associated with a 'lookahead' object
+void
+lookahead_free(struct lookahead *lq)
+{
+    if (!lq)
+        return;
+    free(lq->moves);
+    free(lq->delayed);
+    free(lq);
+}
+
+// Discard all queued moves
+void
+lookahead_reset(struct lookahead *lq)
+{
+    lq->count = 0;
+}
+
+// Determine the maximum junction velocity with the previous move
+// (see Move.calc_junction() in toolhead.py)
+static void
+calc_junction(struct lookahead_move *m, struct lookahead_move *prev
+              , double junction_deviation, double extruder_v2)
+{
+    double *axes_d = m->axes_d, *prev_axes_d = prev->axes_d;
+    double junction_cos_theta = -((axes_d[0] * prev_axes_d[0]
+                                   + axes_d[1] * prev_axes_d[1]
+                                   + axes_d[2] * prev_axes_d[2])
+                                  / (m->move_d * prev->move_d));
+    if (junction_cos_theta > 0.999999)
+        return;
+    junction_cos_theta = py_max(junction_cos_theta, -0.999999);
+    double sin_theta_d2 = sqrt(0.5*(1.0-junction_cos_theta));
+    double R = junction_deviation * sin_theta_d2 / (1. - sin_theta_d2);
+    double tan_theta_d2 = sin_theta_d2 / sqrt(0.5*(1.0+junction_cos_theta));
+    double move_centripetal_v2 = .5 * m->move_d * tan_theta_d2 * m->accel;
+    double prev_move_centripetal_v2 = (.5 * prev->move_d * tan_theta_d2
+                                       * prev->accel);
+    double v2 = R * m->accel;
+    v2 = py_min(v2, R * prev->accel);
+    v2 = py_min(v2, move_centripetal_v2);
+    v2 = py_min(v2, prev_move_centripetal_v2);
+    v2 = py_min(v2, extruder_v2);
+    v2 = py_min(v2, m->max_cruise_v2);
+    v2 = py_min(v2, prev->max_cruise_v2);
+    v2 = py_min(v2, prev->max_start_v2 + prev->delta_v2);
+    m->max_start_v2 = v2;
+    m->max_smoothed_v2 = py_min(
+        v2, prev->max_smoothed_v2 + prev->smooth_delta_v2);
+}
+
+// Add a move to the end of the queue and return its max_start_v2 (or
+// -1. on an allocation failure)
+double
+lookahead_add_move(struct lookahead *lq, double move_d, double accel
+                   , double axis_x, double axis_y, double axis_z
+                   , int is_kinematic_move, double max_cruise_v2
+                   , double delta_v2, double smooth_delta_v2
+                   , double junction_deviation, double extruder_v2)
+{
+    if (lq->count >= lq->alloc) {
+        int alloc = lq->alloc ? lq->alloc * 2 : 1024;
+        struct lookahead_move *moves = realloc(
+            lq->moves, alloc * sizeof(*lq->moves));
+        if (!moves) {
+            errorf("lookahead: unable to allocate %d moves", alloc);
+            return -1.;
+        }
+        lq->moves = moves;
+        struct lookahead_delayed *delayed = realloc(
+            lq->delayed, alloc * sizeof(*lq->delayed));
+        if (!delayed) {
+            errorf("lookahead: unable to allocate %d moves", alloc);
+            return -1.;
+        }
+        lq->delayed = delayed;
+        lq->alloc = alloc;
+    }
+    struct lookahead_move *m = &lq->moves[lq->count++];
+    memset(m, 0, sizeof(*m));
+    m->move_d = move_d;
+    m->accel = accel;
+    m->axes_d[0] = axis_x;
+    m->axes_d[1] = axis_y;
+    m->axes_d[2] = axis_z;
+    m->is_kinematic_move = is_kinematic_move;
+    m->max_cruise_v2 = max_cruise_v2;
+    m->delta_v2 = delta_v2;
+    m->smooth_delta_v2 = smooth_delta_v2;
+    if (lq->count > 1) {
+        struct lookahead_move *prev = m - 1;
+        if (is_kinematic_move && prev->is_kinematic_move)
+            calc_junction(m, prev, junction_deviation, extruder_v2);
+    }
+    return m->max_start_v2;
+}
+
+// Determine accel, cruise, and decel portions of a move
+// (see Move.set_junction() in toolhead.py)
+static void
+set_junction(struct lookahead_move *m
+             , double start_v2, double cruise_v2, double end_v2)
+{
+    double inv_delta_v2 = 1. / m->delta_v2;
+    double accel_r = m->accel_r = (cruise_v2 - start_v2) * inv_delta_v2;
+    double decel_r = m->decel_r = (cruise_v2 - end_v2) * inv_delta_v2;
+    double cruise_r = m->cruise_r = 1. - accel_r - decel_r;
+    double start_v = m->start_v = sqrt(start_v2);
+    double cruise_v = m->cruise_v = sqrt(cruise_v2);
+    double end_v = m->end_v = sqrt(end_v2);
+    m->accel_t = accel_r * m->move_d / ((start_v + cruise_v) * 0.5);
+    m->cruise_t = cruise_r * m->move_d / cruise_v;
+    m->decel_t = decel_r * m->move_d / ((end_v + cruise_v) * 0.5);
+}
+
+// Perform the lookahead backwards pass on the moves from 'leftover'
+// to the end of the queue (see MoveQueue.flush() in toolhead.py).
+// Returns the number of moves that may be flushed, or -1 if a lazy
+// flush found no moves ready to flush.
+int
+lookahead_flush(struct lookahead *lq, int leftover, int lazy)
+{
+    struct lookahead_move *moves = lq->moves;
+    struct lookahead_delayed *delayed = lq->delayed;
+    int update_flush_count = lazy, flush_count = lq->count, num_delayed = 0;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    int i;
+    for (i=flush_count-1; i>=leftover; i--) {
+        struct lookahead_move *m = &moves[i];
+        double reachable_start_v2 = next_end_v2 + m->delta_v2;
+        double start_v2 = py_min(m->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + m->smooth_delta_v2;
+        double smoothed_v2 = py_min(m->max_smoothed_v2
+                                    , reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + m->smooth_delta_v2 > next_smoothed_v2
+                || num_delayed) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = py_min(m->max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (num_delayed) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        int j;
+                        for (j=0; j<num_delayed; j++) {
+                            struct lookahead_delayed *d = &delayed[j];
+                            double mc_v2 = py_min(peak_cruise_v2, d->start_v2);
+                            set_junction(d->move, py_min(d->start_v2, mc_v2)
+                                         , mc_v2, py_min(d->end_v2, mc_v2));
+                        }
+                    }
+                    num_delayed = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = py_min(
+                    (start_v2 + reachable_start_v2) * .5, m->max_cruise_v2);
+                cruise_v2 = py_min(cruise_v2, peak_cruise_v2);
+                set_junction(m, py_min(start_v2, cruise_v2), cruise_v2
+                             , py_min(next_end_v2, cruise_v2));
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            struct lookahead_delayed *d = &delayed[num_delayed++];
+            d->move = m;
+            d->start_v2 = start_v2;
+            d->end_v2 = next_end_v2;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    if (update_flush_count)
+        return -1;
+    return flush_count;
+}
+
+// Copy the lookahead results of moves 'start' through 'end' into
+// 'out' (JUNCTION_FIELDS doubles per move)
+void
+lookahead_get_junctions(struct lookahead *lq, int start, int end, double *out)
+{
+    int i;
+    for (i=start; i<end; i++) {
+        struct lookahead_move *m = &lq->moves[i];
+        memcpy(out, &m->accel_r, JUNCTION_FIELDS * sizeof(*out));
+        out += JUNCTION_FIELDS;
+    }
+}
+
+// Remove 'count' moves from the start of the queue
+void
+lookahead_pop(struct lookahead *lq, int count)
+{
+    if (count > lq->count) {
+        errorf("lookahead_pop invalid count %d vs %d", count, lq->count);
+        count = lq->count;
+    }
+    lq->count -= count;
+    memmove(lq->moves, &lq->moves[count], lq->count * sizeof(*lq->moves));
+}
@@ -0,0 +1,98 @@
+// Helper code for encoding and parsing mcu protocol messages
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// The code in this file implements the same message encoding as
+// msgproto.py - it is used by the host python code to reduce the cpu
+// time spent encoding commands and parsing responses.
+
+#include <stdint.h> // uint8_t
+#include "msgblock.h" // msgblock_crc16_ccitt
+
+// Implement the standard crc "ccitt" algorithm on the given buffer
+uint16_t
+msgblock_crc16_ccitt(uint8_t *buf, int len)
+{
+    uint16_t crc = 0xffff;
+    while (len-- > 0) {
+        uint8_t data = *buf++;
+        data ^= crc & 0xff;
+        data ^= data << 4;
+        crc = ((((uint16_t)data << 8) | (crc >> 8)) ^ (uint8_t)(data >> 4)
+               ^ ((uint16_t)data << 3));
+    }
+    return crc;
+}
+
+// Encode an integer as a variable length quantity (vlq).  This
+// matches PT_uint32.encode() in msgproto.py for all 64bit values.
+static uint8_t *
+encode_int(uint8_t *p, int64_t v)
+{
+    if (v >= 0xc000000 || v < -0x4000000) *p++ = ((v>>28) & 0x7f) | 0x80;
+    if (v >= 0x180000 || v < -0x80000)    *p++ = ((v>>21) & 0x7f) | 0x80;
+    if (v >= 0x3000 || v < -0x1000)       *p++ = ((v>>14) & 0x7f) | 0x80;
+    if (v >= 0x60 || v < -0x20)           *p++ = ((v>>7) & 0x7f) | 0x80;
+    *p++ = v & 0x7f;
+    return p;
+}
+
+// Encode a message id and its integer parameters into 'buf'.  Returns
+// the length of the message or -1 if it does not fit in 'maxlen'.
+int
+msgblock_encode(uint32_t msgid, uint8_t *param_types, int num_params
+                , int64_t *params, uint8_t *buf, int maxlen)
+{
+    uint8_t *p = buf, *end = &buf[maxlen];
+    if (p >= end)
+        return -1;
+    *p++ = msgid;
+    int i;
+    for (i=0; i<num_params; i++) {
+        if (param_types[i] == MB_PT_BUFFER || end - p < 5)
+            return -1;
+        p = encode_int(p, params[i]);
+    }
+    return p - buf;
+}
+
+// Parse the parameters of a message starting at 'pos'.  Integer
+// parameters are stored in 'params' - for buffer parameters the
+// offset of the buffer data is stored instead (the length of the
+// buffer is the byte prior to that offset).  Returns the position
+// after the message or -1 if the message is truncated.
+int
+msgblock_parse(uint8_t *param_types, int num_params
+               , void *data, int pos, int len, int64_t *params)
+{
+    uint8_t *buf = data, *p = &buf[pos], *end = &buf[len];
+    int i;
+    for (i=0; i<num_params; i++) {
+        if (p >= end)
+            return -1;
+        uint8_t c = *p++;
+        if (param_types[i] == MB_PT_BUFFER) {
+            if (c > end - p)
+                return -1;
+            params[i] = p - buf;
+            p += c;
+            continue;
+        }
+        int64_t v = c & 0x7f;
+        if ((c & 0x60) == 0x60)
+            v |= -0x20;
+        uint8_t *vend = p + 8;
+        while (c & 0x80) {
+            if (p >= end || p >= vend)
+                return -1;
+            c = *p++;
+            v = v * 128 + (c & 0x7f);
+        }
+        if (param_types[i] == MB_PT_UINT32)
+            v &= 0xffffffff;
+        params[i] = v;
+    }
+    return p - buf;
+}
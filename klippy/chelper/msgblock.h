@@ -0,0 +1,17 @@
+#ifndef MSGBLOCK_H
+#define MSGBLOCK_H
+
+#include <stdint.h> // uint8_t
+
+// Parameter types understood by msgblock_encode() and msgblock_parse()
+enum {
+    MB_PT_UINT32, MB_PT_INT32, MB_PT_BUFFER,
+};
+
+uint16_t msgblock_crc16_ccitt(uint8_t *buf, int len);
+int msgblock_encode(uint32_t msgid, uint8_t *param_types, int num_params
+                    , int64_t *params, uint8_t *buf, int maxlen);
+int msgblock_parse(uint8_t *param_types, int num_params
+                   , void *data, int pos, int len, int64_t *params);
+
+#endif // msgblock.h
@@ -9,6 +9,7 @@
 #include <stdint.h> // uint8_t
 #include <stdio.h> // fprintf
 #include <string.h> // strerror
+#include <sys/timerfd.h> // timerfd_create
 #include <time.h> // struct timespec
 #include "pyhelper.h" // get_monotonic
 
@@ -25,6 +26,19 @@ get_monotonic(void)
     return (double)ts.tv_sec + (double)ts.tv_nsec * .000000001;
 }
 
+// Return the cpu time used by the calling thread as a double
+double
+get_thread_cputime(void)
+{
+    struct timespec ts;
+    int ret = clock_gettime(CLOCK_THREAD_CPUTIME_ID, &ts);
+    if (ret) {
+        report_errno("clock_gettime", ret);
+        return 0.;
+    }
+    return (double)ts.tv_sec + (double)ts.tv_nsec * .000000001;
+}
+
 // Fill a 'struct timespec' with a system time stored in a double
 struct timespec
 fill_time(double time)
@@ -33,6 +47,36 @@ fill_time(double time)
     return (struct timespec) {t, (time - t)*1000000000. };
 }
 
+// Create a file descriptor that becomes readable at a given
+// monotonic time (see set_timerfd())
+int
+create_timerfd(void)
+{
+    int fd = timerfd_create(CLOCK_MONOTONIC, TFD_NONBLOCK|TFD_CLOEXEC);
+    if (fd < 0)
+        report_errno("timerfd_create", fd);
+    return fd;
+}
+
+// Arm a timerfd to wake at the given monotonic time (or disarm it if
+// 'waketime' is not positive).  Arming the timer also clears any
+// pending expiration.
+int
+set_timerfd(int fd, double waketime)
+{
+    struct itimerspec its;
+    memset(&its, 0, sizeof(its));
+    if (waketime > 0.) {
+        its.it_value = fill_time(waketime);
+        if (!its.it_value.tv_sec && !its.it_value.tv_nsec)
+            its.it_value.tv_nsec = 1;
+    }
+    int ret = timerfd_settime(fd, TFD_TIMER_ABSTIME, &its, NULL);
+    if (ret)
+        report_errno("timerfd_settime", ret);
+    return ret;
+}
+
 static void
 default_logger(const char *msg)
 {
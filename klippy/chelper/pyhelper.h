@@ -5,7 +5,10 @@
 #define unlikely(x)     __builtin_expect(!!(x), 0)
 
 double get_monotonic(void);
+double get_thread_cputime(void);
 struct timespec fill_time(double time);
+int create_timerfd(void);
+int set_timerfd(int fd, double waketime);
 void set_python_logging_callback(void (*func)(const char *));
 void errorf(const char *fmt, ...) __attribute__ ((format (printf, 1, 2)));
 void report_errno(char *where, int rc);
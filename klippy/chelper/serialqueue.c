@@ -21,9 +21,11 @@
 #include <stdio.h> // snprintf
 #include <stdlib.h> // malloc
 #include <string.h> // memset
+#include <sys/epoll.h> // epoll_wait
 #include <termios.h> // tcflush
 #include <unistd.h> // pipe
 #include "list.h" // list_add_tail
+#include "msgblock.h" // msgblock_crc16_ccitt
 #include "pyhelper.h" // get_monotonic
 #include "serialqueue.h" // struct queue_message
 
@@ -199,21 +201,6 @@ set_non_blocking(int fd)
  * Serial protocol helpers
  ****************************************************************/
 
-// Implement the standard crc "ccitt" algorithm on the given buffer
-static uint16_t
-crc16_ccitt(uint8_t *buf, uint8_t len)
-{
-    uint16_t crc = 0xffff;
-    while (len--) {
-        uint8_t data = *buf++;
-        data ^= crc & 0xff;
-        data ^= data << 4;
-        crc = ((((uint16_t)data << 8) | (crc >> 8)) ^ (uint8_t)(data >> 4)
-               ^ ((uint16_t)data << 3));
-    }
-    return crc;
-}
-
 // Verify a buffer starts with a valid mcu message
 static int
 check_message(uint8_t *need_sync, uint8_t *buf, int buf_len)
@@ -236,7 +223,7 @@ check_message(uint8_t *need_sync, uint8_t *buf, int buf_len)
         goto error;
     uint16_t msgcrc = ((buf[msglen-MESSAGE_TRAILER_CRC] << 8)
                        | (uint8_t)buf[msglen-MESSAGE_TRAILER_CRC+1]);
-    uint16_t crc = crc16_ccitt(buf, msglen-MESSAGE_TRAILER_SIZE);
+    uint16_t crc = msgblock_crc16_ccitt(buf, msglen-MESSAGE_TRAILER_SIZE);
     if (crc != msgcrc)
         goto error;
     return msglen;
@@ -343,6 +330,15 @@ message_queue_free(struct list_head *root)
  * Serialqueue interface
  ****************************************************************/
 
+#define SQPF_SERIAL 0
+#define SQPF_PIPE   1
+#define SQPF_NUM    2
+
+struct serialengine_fd {
+    struct serialqueue *sq;
+    int pos;
+};
+
 struct serialqueue {
     // Input reading
     struct pollreactor pr;
@@ -356,6 +352,12 @@ struct serialqueue {
     pthread_mutex_t lock; // protects variables below
     pthread_cond_t cond;
     int receive_waiting;
+    int receive_notify_fd, receive_notified;
+    // Shared engine (see serialengine_alloc)
+    struct serialengine *engine;
+    struct list_node engine_node;
+    int engine_attached;
+    struct serialengine_fd engine_fds[SQPF_NUM];
     // Baud / clock tracking
     double baud_adjust, idle_time;
     double est_freq, last_clock_time;
@@ -376,12 +378,9 @@ struct serialqueue {
     struct list_head old_sent, old_receive;
     // Stats
     uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint32_t rtt_count, rtt_hist[SQ_RTT_BUCKETS];
 };
 
-#define SQPF_SERIAL 0
-#define SQPF_PIPE   1
-#define SQPF_NUM    2
-
 #define SQPT_RETRANSMIT 0
 #define SQPT_COMMAND    1
 #define SQPT_NUM        2
@@ -425,6 +424,12 @@ check_wake_receive(struct serialqueue *sq)
         sq->receive_waiting = 0;
         pthread_cond_signal(&sq->cond);
     }
+    if (sq->receive_notify_fd >= 0 && !sq->receive_notified) {
+        sq->receive_notified = 1;
+        int ret = write(sq->receive_notify_fd, ".", 1);
+        if (ret < 0)
+            report_errno("notify write", ret);
+    }
 }
 
 // Write to the internal pipe to wake the background thread if in poll
@@ -436,6 +441,21 @@ kick_bg_thread(struct serialqueue *sq)
         report_errno("pipe write", ret);
 }
 
+// Add a send to ack time to the rtt histogram
+static void
+rtt_hist_add(struct serialqueue *sq, double rtt)
+{
+    double bound = SQ_RTT_BASE;
+    int i;
+    for (i=0; i<SQ_RTT_BUCKETS-1; i++) {
+        if (rtt < bound)
+            break;
+        bound *= M_SQRT2;
+    }
+    sq->rtt_hist[i]++;
+    sq->rtt_count++;
+}
+
 // Update internal state when the receive sequence increases
 static void
 update_receive_seq(struct serialqueue *sq, double eventtime, uint64_t rseq)
@@ -463,6 +483,8 @@ update_receive_seq(struct serialqueue *sq, double eventtime, uint64_t rseq)
     }
     sq->receive_seq = rseq;
     pollreactor_update_timer(&sq->pr, SQPT_COMMAND, PR_NOW);
+    if (rseq > sq->retransmit_seq && sq->last_receive_sent_time)
+        rtt_hist_add(sq, eventtime - sq->last_receive_sent_time);
 
     // Update retransmit info
     if (sq->rtt_sample_seq && rseq > sq->rtt_sample_seq
@@ -661,7 +683,8 @@ build_and_send_command(struct serialqueue *sq, double eventtime)
     out->len += MESSAGE_TRAILER_SIZE;
     out->msg[MESSAGE_POS_LEN] = out->len;
     out->msg[MESSAGE_POS_SEQ] = MESSAGE_DEST | (sq->send_seq & MESSAGE_SEQ_MASK);
-    uint16_t crc = crc16_ccitt(out->msg, out->len - MESSAGE_TRAILER_SIZE);
+    uint16_t crc = msgblock_crc16_ccitt(out->msg
+                                        , out->len - MESSAGE_TRAILER_SIZE);
     out->msg[out->len - MESSAGE_TRAILER_CRC] = crc >> 8;
     out->msg[out->len - MESSAGE_TRAILER_CRC+1] = crc & 0xff;
     out->msg[out->len - MESSAGE_TRAILER_SYNC] = MESSAGE_SYNC;
@@ -782,15 +805,212 @@ background_thread(void *data)
     return NULL;
 }
 
-// Create a new 'struct serialqueue' object
-struct serialqueue *
-serialqueue_alloc(int serial_fd, int write_only)
+
+/****************************************************************
+ * Shared serialqueue engine
+ ****************************************************************/
+
+// A 'struct serialengine' runs the poll reactors of several
+// serialqueues from a single epoll driven background thread (instead
+// of one thread per serialqueue).
+
+struct serialengine {
+    int epoll_fd, pipe_fds[2], must_exit;
+    pthread_t tid;
+    pthread_mutex_t lock; // protects variables below
+    pthread_cond_t cond;
+    struct list_head queues;
+};
+
+#define SE_MAX_EVENTS 16
+
+// Write to the engine pipe to wake the engine thread
+static void
+kick_engine(struct serialengine *se)
+{
+    int ret = write(se->pipe_fds[1], ".", 1);
+    if (ret < 0)
+        report_errno("engine pipe write", ret);
+}
+
+// Remove a serialqueue from the engine (caller must hold engine lock)
+static void
+serialengine_detach(struct serialengine *se, struct serialqueue *sq)
+{
+    int i;
+    for (i=0; i<sq->pr.num_fds; i++)
+        if (sq->pr.fd_callbacks[i])
+            epoll_ctl(se->epoll_fd, EPOLL_CTL_DEL, sq->pr.fds[i].fd, NULL);
+    list_del(&sq->engine_node);
+    sq->engine_attached = 0;
+    pthread_cond_broadcast(&se->cond);
+
+    pthread_mutex_lock(&sq->lock);
+    check_wake_receive(sq);
+    pthread_mutex_unlock(&sq->lock);
+}
+
+// Add a serialqueue to the engine
+static int
+serialengine_attach(struct serialengine *se, struct serialqueue *sq)
+{
+    pthread_mutex_lock(&se->lock);
+    int i;
+    for (i=0; i<sq->pr.num_fds; i++) {
+        if (!sq->pr.fd_callbacks[i])
+            continue;
+        struct serialengine_fd *ef = &sq->engine_fds[i];
+        ef->sq = sq;
+        ef->pos = i;
+        struct epoll_event ev;
+        memset(&ev, 0, sizeof(ev));
+        ev.events = EPOLLIN|EPOLLHUP;
+        ev.data.ptr = ef;
+        int ret = epoll_ctl(se->epoll_fd, EPOLL_CTL_ADD, sq->pr.fds[i].fd, &ev);
+        if (ret) {
+            report_errno("epoll_ctl", ret);
+            pthread_mutex_unlock(&se->lock);
+            return -1;
+        }
+    }
+    sq->engine = se;
+    list_add_tail(&sq->engine_node, &se->queues);
+    sq->engine_attached = 1;
+    pthread_mutex_unlock(&se->lock);
+    kick_engine(se);
+    return 0;
+}
+
+// Main engine thread - run the timers and fd callbacks of all queues
+static void *
+engine_thread(void *data)
+{
+    struct serialengine *se = data;
+    struct epoll_event events[SE_MAX_EVENTS];
+    pthread_mutex_lock(&se->lock);
+    double eventtime = get_monotonic();
+    while (!se->must_exit) {
+        // Detach exiting queues and run pending timers
+        int timeout = 1000;
+        struct serialqueue *sq, *n;
+        list_for_each_entry_safe(sq, n, &se->queues, engine_node) {
+            if (pollreactor_is_exit(&sq->pr)) {
+                serialengine_detach(se, sq);
+                continue;
+            }
+            int t = pollreactor_check_timers(&sq->pr, eventtime);
+            if (t < timeout)
+                timeout = t;
+        }
+
+        // Wait for fd activity
+        pthread_mutex_unlock(&se->lock);
+        int ret = epoll_wait(se->epoll_fd, events, SE_MAX_EVENTS, timeout);
+        pthread_mutex_lock(&se->lock);
+        eventtime = get_monotonic();
+        if (ret < 0) {
+            report_errno("epoll_wait", ret);
+            break;
+        }
+        int i;
+        for (i=0; i<ret; i++) {
+            struct serialengine_fd *ef = events[i].data.ptr;
+            if (!ef) {
+                char dummy[4096];
+                int ret = read(se->pipe_fds[0], dummy, sizeof(dummy));
+                if (ret < 0)
+                    report_errno("engine pipe read", ret);
+                continue;
+            }
+            sq = ef->sq;
+            if (!pollreactor_is_exit(&sq->pr))
+                sq->pr.fd_callbacks[ef->pos](sq, eventtime);
+        }
+    }
+    // Detach any remaining queues
+    while (!list_empty(&se->queues)) {
+        struct serialqueue *sq = list_first_entry(
+            &se->queues, struct serialqueue, engine_node);
+        pollreactor_do_exit(&sq->pr);
+        serialengine_detach(se, sq);
+    }
+    pthread_mutex_unlock(&se->lock);
+    return NULL;
+}
+
+// Create a new 'struct serialengine' object
+struct serialengine *
+serialengine_alloc(void)
+{
+    struct serialengine *se = malloc(sizeof(*se));
+    memset(se, 0, sizeof(*se));
+    list_init(&se->queues);
+    int ret = se->epoll_fd = epoll_create1(EPOLL_CLOEXEC);
+    if (ret < 0)
+        goto fail;
+    ret = pipe(se->pipe_fds);
+    if (ret)
+        goto fail;
+    set_non_blocking(se->pipe_fds[0]);
+    set_non_blocking(se->pipe_fds[1]);
+    struct epoll_event ev;
+    memset(&ev, 0, sizeof(ev));
+    ev.events = EPOLLIN;
+    ev.data.ptr = NULL;
+    ret = epoll_ctl(se->epoll_fd, EPOLL_CTL_ADD, se->pipe_fds[0], &ev);
+    if (ret)
+        goto fail;
+    ret = pthread_mutex_init(&se->lock, NULL);
+    if (ret)
+        goto fail;
+    ret = pthread_cond_init(&se->cond, NULL);
+    if (ret)
+        goto fail;
+    ret = pthread_create(&se->tid, NULL, engine_thread, se);
+    if (ret)
+        goto fail;
+    return se;
+
+fail:
+    report_errno("engine init", ret);
+    return NULL;
+}
+
+// Stop the engine thread and free all resources
+void
+serialengine_free(struct serialengine *se)
+{
+    if (!se)
+        return;
+    pthread_mutex_lock(&se->lock);
+    se->must_exit = 1;
+    pthread_mutex_unlock(&se->lock);
+    kick_engine(se);
+    int ret = pthread_join(se->tid, NULL);
+    if (ret)
+        report_errno("pthread_join", ret);
+    close(se->epoll_fd);
+    close(se->pipe_fds[0]);
+    close(se->pipe_fds[1]);
+    free(se);
+}
+
+
+/****************************************************************
+ * Serialqueue setup
+ ****************************************************************/
+
+// Create a new 'struct serialqueue' object (run from the given engine
+// if 'se' is not NULL)
+static struct serialqueue *
+serialqueue_setup(int serial_fd, int write_only, struct serialengine *se)
 {
     struct serialqueue *sq = malloc(sizeof(*sq));
     memset(sq, 0, sizeof(*sq));
 
     // Reactor setup
     sq->serial_fd = serial_fd;
+    sq->receive_notify_fd = -1;
     int ret = pipe(sq->pipe_fds);
     if (ret)
         goto fail;
@@ -833,7 +1053,10 @@ serialqueue_alloc(int serial_fd, int write_only)
     ret = pthread_cond_init(&sq->cond, NULL);
     if (ret)
         goto fail;
-    ret = pthread_create(&sq->tid, NULL, background_thread, sq);
+    if (se)
+        ret = serialengine_attach(se, sq);
+    else
+        ret = pthread_create(&sq->tid, NULL, background_thread, sq);
     if (ret)
         goto fail;
 
@@ -844,10 +1067,39 @@ fail:
     return NULL;
 }
 
+// Create a new 'struct serialqueue' object
+struct serialqueue *
+serialqueue_alloc(int serial_fd, int write_only)
+{
+    return serialqueue_setup(serial_fd, write_only, NULL);
+}
+
+// Create a new 'struct serialqueue' object that is run by a shared
+// serialengine instead of its own background thread
+struct serialqueue *
+serialqueue_alloc_engine(int serial_fd, int write_only
+                         , struct serialengine *se)
+{
+    return serialqueue_setup(serial_fd, write_only, se);
+}
+
 // Request that the background thread exit
 void
 serialqueue_exit(struct serialqueue *sq)
 {
+    struct serialengine *se = sq->engine;
+    if (se) {
+        // Wait for the engine thread to detach the queue
+        pthread_mutex_lock(&se->lock);
+        pollreactor_do_exit(&sq->pr);
+        if (sq->engine_attached) {
+            kick_engine(se);
+            while (sq->engine_attached)
+                pthread_cond_wait(&se->cond, &se->lock);
+        }
+        pthread_mutex_unlock(&se->lock);
+        return;
+    }
     pollreactor_do_exit(&sq->pr);
     kick_bg_thread(sq);
     int ret = pthread_join(sq->tid, NULL);
@@ -861,7 +1113,7 @@ serialqueue_free(struct serialqueue *sq)
 {
     if (!sq)
         return;
-    if (!pollreactor_is_exit(&sq->pr))
+    if (sq->engine || !pollreactor_is_exit(&sq->pr))
         serialqueue_exit(sq);
     pthread_mutex_lock(&sq->lock);
     message_queue_free(&sq->sent_queue);
@@ -972,42 +1224,93 @@ serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
-// Return a message read from the serial port (or wait for one if none
-// available)
-void
-serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+// Copy up to 'max' messages from the receive queue (caller must hold
+// the lock)
+static int
+pull_receive_queue(struct serialqueue *sq, struct pull_queue_message *pqm
+                   , int max)
+{
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue)) {
+        // Remove message from queue
+        struct queue_message *qm = list_first_entry(
+            &sq->receive_queue, struct queue_message, node);
+        list_del(&qm->node);
+
+        // Copy message
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        debug_queue_add(&sq->old_receive, qm);
+        pqm++;
+        count++;
+    }
+    if (list_empty(&sq->receive_queue))
+        sq->receive_notified = 0;
+    return count;
+}
+
+// Return up to 'max' messages read from the serial port (or wait for
+// one if none available).  Returns the number of messages or -1 if
+// the serialqueue is exiting.
+int
+serialqueue_pull_batch(struct serialqueue *sq, struct pull_queue_message *pqm
+                       , int max)
 {
     pthread_mutex_lock(&sq->lock);
     // Wait for message to be available
     while (list_empty(&sq->receive_queue)) {
-        if (pollreactor_is_exit(&sq->pr))
-            goto exit;
+        if (pollreactor_is_exit(&sq->pr)) {
+            pthread_mutex_unlock(&sq->lock);
+            return -1;
+        }
         sq->receive_waiting = 1;
         int ret = pthread_cond_wait(&sq->cond, &sq->lock);
         if (ret)
             report_errno("pthread_cond_wait", ret);
     }
 
-    // Remove message from queue
-    struct queue_message *qm = list_first_entry(
-        &sq->receive_queue, struct queue_message, node);
-    list_del(&qm->node);
-
-    // Copy message
-    memcpy(pqm->msg, qm->msg, qm->len);
-    pqm->len = qm->len;
-    pqm->sent_time = qm->sent_time;
-    pqm->receive_time = qm->receive_time;
-    debug_queue_add(&sq->old_receive, qm);
+    int count = pull_receive_queue(sq, pqm, max);
+    pthread_mutex_unlock(&sq->lock);
+    return count;
+}
 
+// Return up to 'max' already received messages without waiting.  A
+// byte is written to the notify fd (see serialqueue_set_receive_notify)
+// when a message arrives and this call last returned all messages.
+int
+serialqueue_pull_pending(struct serialqueue *sq, struct pull_queue_message *pqm
+                         , int max)
+{
+    pthread_mutex_lock(&sq->lock);
+    int count = pull_receive_queue(sq, pqm, max);
     pthread_mutex_unlock(&sq->lock);
-    return;
+    return count;
+}
 
-exit:
-    pqm->len = -1;
+// Write to the given fd when messages are available in the receive
+// queue (so that a caller's event loop may use serialqueue_pull_pending)
+void
+serialqueue_set_receive_notify(struct serialqueue *sq, int fd)
+{
+    pthread_mutex_lock(&sq->lock);
+    sq->receive_notify_fd = fd;
+    sq->receive_notified = 0;
+    if (fd >= 0 && !list_empty(&sq->receive_queue))
+        check_wake_receive(sq);
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Return a message read from the serial port (or wait for one if none
+// available)
+void
+serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm)
+{
+    if (serialqueue_pull_batch(sq, pqm, 1) < 0)
+        pqm->len = -1;
+}
+
 void
 serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust)
 {
@@ -1033,10 +1336,8 @@ serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
 void
 serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
 {
-    struct serialqueue stats;
-    pthread_mutex_lock(&sq->lock);
-    memcpy(&stats, sq, sizeof(stats));
-    pthread_mutex_unlock(&sq->lock);
+    struct serialqueue_stats stats;
+    serialqueue_fill_stats(sq, &stats);
 
     snprintf(buf, len, "bytes_write=%u bytes_read=%u"
              " bytes_retransmit=%u bytes_invalid=%u"
@@ -1051,6 +1352,62 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
              , stats.ready_bytes, stats.stalled_bytes);
 }
 
+// Fill a 'struct serialqueue_stats' with the current statistics
+void
+serialqueue_fill_stats(struct serialqueue *sq, struct serialqueue_stats *stats)
+{
+    pthread_mutex_lock(&sq->lock);
+    stats->bytes_write = sq->bytes_write;
+    stats->bytes_read = sq->bytes_read;
+    stats->bytes_retransmit = sq->bytes_retransmit;
+    stats->bytes_invalid = sq->bytes_invalid;
+    stats->send_seq = sq->send_seq;
+    stats->receive_seq = sq->receive_seq;
+    stats->retransmit_seq = sq->retransmit_seq;
+    stats->srtt = sq->srtt;
+    stats->rttvar = sq->rttvar;
+    stats->rto = sq->rto;
+    stats->ready_bytes = sq->ready_bytes;
+    stats->stalled_bytes = sq->stalled_bytes;
+    stats->need_ack_bytes = sq->need_ack_bytes;
+    stats->send_window = stats->receive_window = stats->pending_queues = 0;
+    struct queue_message *qm;
+    list_for_each_entry(qm, &sq->sent_queue, node) {
+        stats->send_window++;
+    }
+    list_for_each_entry(qm, &sq->receive_queue, node) {
+        stats->receive_window++;
+    }
+    struct command_queue *cq;
+    list_for_each_entry(cq, &sq->pending_queues, node) {
+        stats->pending_queues++;
+    }
+    stats->rtt_count = sq->rtt_count;
+    memcpy(stats->rtt_hist, sq->rtt_hist, sizeof(stats->rtt_hist));
+    pthread_mutex_unlock(&sq->lock);
+}
+
+// Fill a 'struct commandqueue_stats' with the messages pending on a
+// command queue
+void
+serialqueue_fill_commandqueue_stats(struct serialqueue *sq
+                                    , struct command_queue *cq
+                                    , struct commandqueue_stats *stats)
+{
+    memset(stats, 0, sizeof(*stats));
+    pthread_mutex_lock(&sq->lock);
+    struct queue_message *qm;
+    list_for_each_entry(qm, &cq->ready_queue, node) {
+        stats->ready_msgs++;
+        stats->ready_bytes += qm->len;
+    }
+    list_for_each_entry(qm, &cq->stalled_queue, node) {
+        stats->stalled_msgs++;
+        stats->stalled_bytes += qm->len;
+    }
+    pthread_mutex_unlock(&sq->lock);
+}
+
 // Extract old messages stored in the debug queues
 int
 serialqueue_extract_old(struct serialqueue *sq, int sentq
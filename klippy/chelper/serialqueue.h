@@ -44,8 +44,32 @@ struct pull_queue_message {
     double sent_time, receive_time;
 };
 
+#define SQ_RTT_BUCKETS 32
+#define SQ_RTT_BASE 0.000100
+
+struct serialqueue_stats {
+    uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint64_t send_seq, receive_seq, retransmit_seq;
+    double srtt, rttvar, rto;
+    int ready_bytes, stalled_bytes, need_ack_bytes;
+    int send_window, receive_window, pending_queues;
+    // Histogram of send to ack times - bucket i counts times less than
+    // SQ_RTT_BASE * sqrt(2)**i (the last bucket counts all others)
+    uint32_t rtt_count, rtt_hist[SQ_RTT_BUCKETS];
+};
+
+struct commandqueue_stats {
+    int ready_msgs, ready_bytes, stalled_msgs, stalled_bytes;
+};
+
+struct serialengine;
+struct serialengine *serialengine_alloc(void);
+void serialengine_free(struct serialengine *se);
+
 struct serialqueue;
 struct serialqueue *serialqueue_alloc(int serial_fd, int write_only);
+struct serialqueue *serialqueue_alloc_engine(int serial_fd, int write_only
+                                             , struct serialengine *se);
 void serialqueue_exit(struct serialqueue *sq);
 void serialqueue_free(struct serialqueue *sq);
 struct command_queue *serialqueue_alloc_commandqueue(void);
@@ -58,11 +82,21 @@ void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
 void serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
                                  , uint32_t *data, int len
                                  , uint64_t min_clock, uint64_t req_clock);
+int serialqueue_pull_batch(struct serialqueue *sq
+                           , struct pull_queue_message *pqm, int max);
+int serialqueue_pull_pending(struct serialqueue *sq
+                             , struct pull_queue_message *pqm, int max);
+void serialqueue_set_receive_notify(struct serialqueue *sq, int fd);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
 void serialqueue_set_baud_adjust(struct serialqueue *sq, double baud_adjust);
 void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
                                , double last_clock_time, uint64_t last_clock);
 void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
+void serialqueue_fill_stats(struct serialqueue *sq
+                            , struct serialqueue_stats *stats);
+void serialqueue_fill_commandqueue_stats(struct serialqueue *sq
+                                         , struct command_queue *cq
+                                         , struct commandqueue_stats *stats);
 int serialqueue_extract_old(struct serialqueue *sq, int sentq
                             , struct pull_queue_message *q, int max);
 
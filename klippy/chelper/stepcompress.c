@@ -15,6 +15,7 @@
 // efficiency - the repetitive integer math is vastly faster in C.
 
 #include <math.h> // sqrt
+#include <pthread.h> // pthread_create
 #include <stddef.h> // offsetof
 #include <stdint.h> // uint32_t
 #include <stdio.h> // fprintf
@@ -22,9 +23,12 @@
 #include <string.h> // memset
 #include "pyhelper.h" // errorf
 #include "serialqueue.h" // struct queue_message
+#include "stepcompress.h" // struct queue_append
 
 #define CHECK_LINES 1
-#define QUEUE_START_SIZE 1024
+// Number of step times that may be pending in a stepcompress queue
+// (must be larger than the 64K step window of queue_append_slow())
+#define QUEUE_SIZE (64*1024 + 4*1024)
 
 struct stepcompress {
     // Buffer management
@@ -36,9 +40,29 @@ struct stepcompress {
     uint64_t last_step_clock, homing_clock;
     struct list_head msg_queue;
     uint32_t queue_step_msgid, set_next_step_dir_msgid, oid;
-    int sdir, invert_sdir;
+    int sdir, invert_sdir, fast_mode;
+    // Deferred step generation
+    struct step_job *jobs;
+    int job_count, job_alloc, defer_jobs;
+    // Statistics
+    uint32_t peak_step_error, queue_peak, queue_moves, queue_flushes;
+    uint32_t stat_steps, stat_step_msgs, stat_dir_msgs, stat_bytes;
+    // Step time capture
+    FILE *capture;
+    uint32_t *capture_next;
 };
 
+// Step time capture record types
+enum {
+    CAP_INIT, CAP_STEPS, CAP_FLUSH, CAP_FLUSH_FAR, CAP_DIR, CAP_RESET,
+    CAP_HOMING, CAP_MSG, CAP_MAX_ERROR,
+};
+
+static void capture_steps(struct stepcompress *sc);
+static void capture_event(struct stepcompress *sc, uint32_t type
+                          , uint64_t clock);
+static void capture_msg(struct stepcompress *sc, uint32_t *data, int len);
+
 
 /****************************************************************
  * Step compression
@@ -87,34 +111,52 @@ struct step_move {
     int16_t add;
 };
 
+// Maximum number of 'add' values checked by compress_bisect_add() in
+// "fast" mode (which results in slightly more queue_step commands)
+#define FAST_MODE_TRIES 3
+
 // Find a 'step_move' that covers a series of step times
 static struct step_move
 compress_bisect_add(struct stepcompress *sc)
 {
-    uint32_t *qlast = sc->queue_next;
-    if (qlast > sc->queue_pos + 65535)
-        qlast = sc->queue_pos + 65535;
-    struct points point = minmax_point(sc, sc->queue_pos);
+    uint32_t *qpos = sc->queue_pos, lsc = sc->last_step_clock;
+    uint32_t max_error = sc->max_error;
+    int32_t qcount = sc->queue_next - qpos;
+    if (qcount > 65535)
+        qcount = 65535;
+    struct points point = minmax_point(sc, qpos);
     int32_t outer_mininterval = point.minp, outer_maxinterval = point.maxp;
     int32_t add = 0, minadd = -0x8000, maxadd = 0x7fff;
     int32_t bestinterval = 0, bestcount = 1, bestadd = 1, bestreach = INT32_MIN;
     int32_t zerointerval = 0, zerocount = 0;
+    int tries = sc->fast_mode ? FAST_MODE_TRIES : INT32_MAX;
 
     for (;;) {
         // Find longest valid sequence with the given 'add'
         struct points nextpoint;
         int32_t nextmininterval = outer_mininterval;
         int32_t nextmaxinterval = outer_maxinterval, interval = nextmaxinterval;
-        int32_t nextcount = 1;
+        int32_t nextcount = 1, nextaddsum = 0, addstep = 0;
+        uint32_t prevpoint = point.maxp;
         for (;;) {
             nextcount++;
-            if (&sc->queue_pos[nextcount-1] >= qlast) {
+            if (nextcount > qcount) {
                 int32_t count = nextcount - 1;
                 return (struct step_move){ interval, count, add };
             }
-            nextpoint = minmax_point(sc, sc->queue_pos + nextcount - 1);
-            int32_t nextaddfactor = nextcount*(nextcount-1)/2;
-            int32_t c = add*nextaddfactor;
+            // Same as minmax_point(), but without rereading the
+            // previous step time
+            uint32_t nextp = qpos[nextcount-1] - lsc;
+            uint32_t nexterr = (nextp - prevpoint) / 2;
+            if (nexterr > max_error)
+                nexterr = max_error;
+            nextpoint.minp = nextp - nexterr;
+            nextpoint.maxp = nextp;
+            prevpoint = nextp;
+            // Calculate 'add*nextaddfactor' incrementally
+            addstep += add;
+            nextaddsum += addstep;
+            int32_t c = nextaddsum;
             if (nextmininterval*nextcount < nextpoint.minp - c)
                 nextmininterval = DIV_UP(nextpoint.minp - c, nextcount);
             if (nextmaxinterval*nextcount > nextpoint.maxp - c)
@@ -172,7 +214,7 @@ compress_bisect_add(struct stepcompress *sc)
             maxadd = idiv_down(nextpoint.maxp - c, nextaddfactor);
 
         // Bisect valid add range and try again with new 'add'
-        if (minadd > maxadd)
+        if (minadd > maxadd || !--tries)
             break;
         add = maxadd - (maxadd - minadd) / 4;
     }
@@ -187,8 +229,6 @@ compress_bisect_add(struct stepcompress *sc)
  * Step compress checking
  ****************************************************************/
 
-#define ERROR_RET -989898989
-
 // Verify that a given 'step_move' matches the actual step times
 static int
 check_line(struct stepcompress *sc, struct step_move move)
@@ -201,7 +241,7 @@ check_line(struct stepcompress *sc, struct step_move move)
                , sc->oid, move.interval, move.count, move.add);
         return ERROR_RET;
     }
-    uint32_t interval = move.interval, p = 0;
+    uint32_t interval = move.interval, p = 0, peak_error = 0;
     uint16_t i;
     for (i=0; i<move.count; i++) {
         struct points point = minmax_point(sc, sc->queue_pos + i);
@@ -212,6 +252,8 @@ check_line(struct stepcompress *sc, struct step_move move)
                    , i+1, p, point.minp, point.maxp);
             return ERROR_RET;
         }
+        if (point.maxp - p > peak_error)
+            peak_error = point.maxp - p;
         if (interval >= 0x80000000) {
             errorf("stepcompress o=%d i=%d c=%d a=%d:"
                    " Point %d: interval overflow %d"
@@ -221,6 +263,8 @@ check_line(struct stepcompress *sc, struct step_move move)
         }
         interval += move.add;
     }
+    if (peak_error > sc->peak_step_error)
+        sc->peak_step_error = peak_error;
     return 0;
 }
 
@@ -253,17 +297,25 @@ stepcompress_free(struct stepcompress *sc)
 {
     if (!sc)
         return;
+    if (sc->capture)
+        fclose(sc->capture);
     free(sc->queue);
+    free(sc->jobs);
     message_queue_free(&sc->msg_queue);
     free(sc);
 }
 
 // Convert previously scheduled steps into commands for the mcu
-static int
+int
 stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
 {
     if (sc->queue_pos >= sc->queue_next)
         return 0;
+    uint32_t in_use = sc->queue_next - sc->queue_pos;
+    if (in_use > sc->queue_peak)
+        sc->queue_peak = in_use;
+    if (unlikely(sc->capture))
+        capture_event(sc, CAP_FLUSH, move_clock);
     while (sc->last_step_clock < move_clock) {
         struct step_move move = compress_bisect_add(sc);
         int ret = check_line(sc, move);
@@ -275,6 +327,9 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
         };
         struct queue_message *qm = message_alloc_and_encode(msg, 5);
         qm->min_clock = qm->req_clock = sc->last_step_clock;
+        sc->stat_steps += move.count;
+        sc->stat_step_msgs++;
+        sc->stat_bytes += qm->len;
         int32_t addfactor = move.count*(move.count-1)/2;
         uint32_t ticks = move.add*addfactor + move.interval*move.count;
         sc->last_step_clock += ticks;
@@ -284,7 +339,7 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
         list_add_tail(&qm->node, &sc->msg_queue);
 
         if (sc->queue_pos + move.count >= sc->queue_next) {
-            sc->queue_pos = sc->queue_next = sc->queue;
+            sc->queue_pos = sc->queue_next = sc->capture_next = sc->queue;
             break;
         }
         sc->queue_pos += move.count;
@@ -296,11 +351,16 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
 static int
 stepcompress_flush_far(struct stepcompress *sc, uint64_t abs_step_clock)
 {
+    if (unlikely(sc->capture))
+        capture_event(sc, CAP_FLUSH_FAR, abs_step_clock);
     uint32_t msg[5] = {
         sc->queue_step_msgid, sc->oid, abs_step_clock - sc->last_step_clock, 1, 0
     };
     struct queue_message *qm = message_alloc_and_encode(msg, 5);
     qm->min_clock = sc->last_step_clock;
+    sc->stat_steps++;
+    sc->stat_step_msgs++;
+    sc->stat_bytes += qm->len;
     sc->last_step_clock = qm->req_clock = abs_step_clock;
     if (sc->homing_clock)
         // When homing, all steps should be sent prior to homing_clock
@@ -319,11 +379,15 @@ set_next_step_dir(struct stepcompress *sc, int sdir)
     int ret = stepcompress_flush(sc, UINT64_MAX);
     if (ret)
         return ret;
+    if (unlikely(sc->capture))
+        capture_event(sc, CAP_DIR, sdir);
     uint32_t msg[3] = {
         sc->set_next_step_dir_msgid, sc->oid, sdir ^ sc->invert_sdir
     };
     struct queue_message *qm = message_alloc_and_encode(msg, 3);
     qm->req_clock = sc->homing_clock ?: sc->last_step_clock;
+    sc->stat_dir_msgs++;
+    sc->stat_bytes += qm->len;
     list_add_tail(&qm->node, &sc->msg_queue);
     return 0;
 }
@@ -332,11 +396,16 @@ set_next_step_dir(struct stepcompress *sc, int sdir)
 int
 stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock)
 {
-    int ret = stepcompress_flush(sc, UINT64_MAX);
+    int ret = stepcompress_run_jobs(sc);
+    if (ret)
+        return ret;
+    ret = stepcompress_flush(sc, UINT64_MAX);
     if (ret)
         return ret;
     sc->last_step_clock = last_step_clock;
     sc->sdir = -1;
+    if (unlikely(sc->capture))
+        capture_event(sc, CAP_RESET, last_step_clock);
     return 0;
 }
 
@@ -344,10 +413,15 @@ stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock)
 int
 stepcompress_set_homing(struct stepcompress *sc, uint64_t homing_clock)
 {
-    int ret = stepcompress_flush(sc, UINT64_MAX);
+    int ret = stepcompress_run_jobs(sc);
+    if (ret)
+        return ret;
+    ret = stepcompress_flush(sc, UINT64_MAX);
     if (ret)
         return ret;
     sc->homing_clock = homing_clock;
+    if (unlikely(sc->capture))
+        capture_event(sc, CAP_HOMING, homing_clock);
     return 0;
 }
 
@@ -355,9 +429,14 @@ stepcompress_set_homing(struct stepcompress *sc, uint64_t homing_clock)
 int
 stepcompress_queue_msg(struct stepcompress *sc, uint32_t *data, int len)
 {
-    int ret = stepcompress_flush(sc, UINT64_MAX);
+    int ret = stepcompress_run_jobs(sc);
     if (ret)
         return ret;
+    ret = stepcompress_flush(sc, UINT64_MAX);
+    if (ret)
+        return ret;
+    if (unlikely(sc->capture))
+        capture_msg(sc, data, len);
 
     struct queue_message *qm = message_alloc_and_encode(data, len);
     qm->req_clock = sc->homing_clock ?: sc->last_step_clock;
@@ -365,6 +444,49 @@ stepcompress_queue_msg(struct stepcompress *sc, uint32_t *data, int len)
     return 0;
 }
 
+// Change the maximum error (in clock ticks) of future step commands
+void
+stepcompress_set_max_error(struct stepcompress *sc, uint32_t max_error)
+{
+    if (sc->max_error == max_error)
+        return;
+    if (unlikely(sc->capture))
+        capture_event(sc, CAP_MAX_ERROR, max_error);
+    sc->max_error = max_error;
+}
+
+// Enable (or disable) the "fast" compression mode
+void
+stepcompress_set_fast_mode(struct stepcompress *sc, int fast_mode)
+{
+    sc->fast_mode = fast_mode;
+}
+
+// Report the compression statistics of a stepcompress object
+void
+stepcompress_get_stats(struct stepcompress *sc, char *buf, int len)
+{
+    snprintf(buf, len, "steps=%u queue_step=%u avg_count=%.1f"
+             " dir_changes=%u bytes=%u"
+             , sc->stat_steps, sc->stat_step_msgs
+             , (double)sc->stat_steps / (sc->stat_step_msgs ?: 1)
+             , sc->stat_dir_msgs, sc->stat_bytes);
+}
+
+// Return the current step direction (or -1 if not yet known)
+int
+stepcompress_get_step_dir(struct stepcompress *sc)
+{
+    return sc->sdir;
+}
+
+// Return the mcu clock frequency
+double
+stepcompress_get_mcu_freq(struct stepcompress *sc)
+{
+    return sc->mcu_freq;
+}
+
 // Set the conversion rate of 'print_time' to mcu clock
 static void
 stepcompress_set_time(struct stepcompress *sc
@@ -379,17 +501,11 @@ stepcompress_set_time(struct stepcompress *sc
  * Queue management
  ****************************************************************/
 
-struct queue_append {
-    struct stepcompress *sc;
-    uint32_t *qnext, *qend, last_step_clock_32;
-    double clock_offset;
-};
-
 // Maximium clock delta between messages in the queue
 #define CLOCK_DIFF_MAX (3<<28)
 
 // Create a cursor for inserting clock times into the queue
-static inline struct queue_append
+inline struct queue_append
 queue_append_start(struct stepcompress *sc, double print_time, double adjust)
 {
     double print_clock = (print_time - sc->mcu_time_offset) * sc->mcu_freq;
@@ -400,12 +516,41 @@ queue_append_start(struct stepcompress *sc, double print_time, double adjust)
 }
 
 // Finalize a cursor created with queue_append_start()
-static inline void
+inline void
 queue_append_finish(struct queue_append qa)
 {
     qa.sc->queue_next = qa.qnext;
 }
 
+// Make room at the end of the queue.  The queue has a fixed size -
+// once the end is reached the pending step times are moved to the
+// start of the queue (they are not wrapped around as the compression
+// code needs the pending step times to be in contiguous memory).
+static int
+queue_expand(struct stepcompress *sc)
+{
+    if (!sc->queue) {
+        sc->queue = malloc(QUEUE_SIZE * sizeof(*sc->queue));
+        sc->queue_pos = sc->queue_next = sc->capture_next = sc->queue;
+        sc->queue_end = sc->queue + QUEUE_SIZE;
+        return 0;
+    }
+    if (sc->queue_pos == sc->queue) {
+        errorf("stepcompress o=%d: step queue overflow", sc->oid);
+        return ERROR_RET;
+    }
+    if (unlikely(sc->capture))
+        capture_steps(sc);
+    int in_use = sc->queue_next - sc->queue_pos;
+    if (in_use) {
+        memmove(sc->queue, sc->queue_pos, in_use * sizeof(*sc->queue));
+        sc->queue_moves++;
+    }
+    sc->queue_pos = sc->queue;
+    sc->queue_next = sc->capture_next = sc->queue + in_use;
+    return 0;
+}
+
 // Slow path for queue_append()
 static int
 queue_append_slow(struct stepcompress *sc, double rel_sc)
@@ -427,26 +572,13 @@ queue_append_slow(struct stepcompress *sc, double rel_sc)
         int ret = stepcompress_flush(sc, sc->last_step_clock + flush);
         if (ret)
             return ret;
+        sc->queue_flushes++;
     }
 
     if (sc->queue_next >= sc->queue_end) {
-        // Make room in the queue
-        int in_use = sc->queue_next - sc->queue_pos;
-        if (sc->queue_pos > sc->queue) {
-            // Shuffle the internal queue to avoid having to allocate more ram
-            memmove(sc->queue, sc->queue_pos, in_use * sizeof(*sc->queue));
-        } else {
-            // Expand the internal queue of step times
-            int alloc = sc->queue_end - sc->queue;
-            if (!alloc)
-                alloc = QUEUE_START_SIZE;
-            while (in_use >= alloc)
-                alloc *= 2;
-            sc->queue = realloc(sc->queue, alloc * sizeof(*sc->queue));
-            sc->queue_end = sc->queue + alloc;
-        }
-        sc->queue_pos = sc->queue;
-        sc->queue_next = sc->queue + in_use;
+        int ret = queue_expand(sc);
+        if (ret)
+            return ret;
     }
 
     *sc->queue_next++ = abs_step_clock;
@@ -454,7 +586,7 @@ queue_append_slow(struct stepcompress *sc, double rel_sc)
 }
 
 // Add a clock time to the queue (flushing the queue if needed)
-static inline int
+inline int
 queue_append(struct queue_append *qa, double step_clock)
 {
     double rel_sc = step_clock + qa->clock_offset;
@@ -476,6 +608,23 @@ queue_append(struct queue_append *qa, double step_clock)
     return 0;
 }
 
+// Change the step direction while using a queue_append cursor
+int
+queue_append_set_next_step_dir(struct queue_append *qa, int sdir)
+{
+    struct stepcompress *sc = qa->sc;
+    uint64_t old_last_step_clock = sc->last_step_clock;
+    sc->queue_next = qa->qnext;
+    int ret = set_next_step_dir(sc, sdir);
+    if (ret)
+        return ret;
+    qa->qnext = sc->queue_next;
+    qa->qend = sc->queue_end;
+    qa->last_step_clock_32 = sc->last_step_clock;
+    qa->clock_offset -= sc->last_step_clock - old_last_step_clock;
+    return 0;
+}
+
 
 /****************************************************************
  * Motion to step conversions
@@ -503,8 +652,8 @@ static inline double safe_sqrt(double v) {
 }
 
 // Schedule a step event at the specified step_clock time
-int32_t
-stepcompress_push(struct stepcompress *sc, double print_time, int32_t sdir)
+static int32_t
+push_step(struct stepcompress *sc, double print_time, int32_t sdir)
 {
     int ret = set_next_step_dir(sc, !!sdir);
     if (ret)
@@ -523,10 +672,9 @@ stepcompress_push(struct stepcompress *sc, double print_time, int32_t sdir)
 // Otherwise it uses the formula:
 //  step_time = (print_time + sqrt(2*step_num/accel + (start_sv/accel)**2)
 //               - start_sv/accel)
-int32_t
-stepcompress_push_const(
-    struct stepcompress *sc, double print_time
-    , double step_offset, double steps, double start_sv, double accel)
+static int32_t
+push_const(struct stepcompress *sc, double print_time, double step_offset
+           , double steps, double start_sv, double accel, int count_only)
 {
     // Calculate number of steps to take
     int sdir = 1;
@@ -545,10 +693,12 @@ stepcompress_push_const(
         }
         return 0;
     }
+    int res = sdir ? count : -count;
+    if (count_only)
+        return res;
     int ret = set_next_step_dir(sc, sdir);
     if (ret)
         return ret;
-    int res = sdir ? count : -count;
 
     // Calculate each step time
     if (!accel) {
@@ -585,10 +735,10 @@ stepcompress_push_const(
 
 // Schedule steps using delta kinematics
 static int32_t
-_stepcompress_push_delta(
-    struct stepcompress *sc, int sdir
-    , double print_time, double move_sd, double start_sv, double accel
-    , double height, double startxy_sd, double arm_sd, double movez_r)
+_push_delta(struct stepcompress *sc, int sdir
+            , double print_time, double move_sd, double start_sv, double accel
+            , double height, double startxy_sd, double arm_sd, double movez_r
+            , int count_only)
 {
     // Calculate number of steps to take
     double movexy_r = movez_r ? sqrt(1. - movez_r*movez_r) : 1.;
@@ -605,10 +755,12 @@ _stepcompress_push_delta(
         }
         return 0;
     }
+    int res = sdir ? count : -count;
+    if (count_only)
+        return res;
     int ret = set_next_step_dir(sc, sdir);
     if (ret)
         return ret;
-    int res = sdir ? count : -count;
 
     // Calculate each step time
     height += (sdir ? .5 : -.5);
@@ -673,39 +825,464 @@ _stepcompress_push_delta(
     return res;
 }
 
-int32_t
-stepcompress_push_delta(
-    struct stepcompress *sc, double print_time, double move_sd
-    , double start_sv, double accel
-    , double height, double startxy_sd, double arm_sd, double movez_r)
+static int32_t
+push_delta(struct stepcompress *sc, double print_time, double move_sd
+           , double start_sv, double accel, double height, double startxy_sd
+           , double arm_sd, double movez_r, int count_only)
 {
     double reversexy_sd = startxy_sd + arm_sd*movez_r;
     if (reversexy_sd <= 0.)
         // All steps are in down direction
-        return _stepcompress_push_delta(
-            sc, 0, print_time, move_sd, start_sv, accel
-            , height, startxy_sd, arm_sd, movez_r);
+        return _push_delta(sc, 0, print_time, move_sd, start_sv, accel
+                           , height, startxy_sd, arm_sd, movez_r, count_only);
     double movexy_r = movez_r ? sqrt(1. - movez_r*movez_r) : 1.;
     if (reversexy_sd >= move_sd * movexy_r)
         // All steps are in up direction
-        return _stepcompress_push_delta(
-            sc, 1, print_time, move_sd, start_sv, accel
-            , height, startxy_sd, arm_sd, movez_r);
+        return _push_delta(sc, 1, print_time, move_sd, start_sv, accel
+                           , height, startxy_sd, arm_sd, movez_r, count_only);
     // Steps in both up and down direction
-    int res1 = _stepcompress_push_delta(
-        sc, 1, print_time, reversexy_sd / movexy_r, start_sv, accel
-        , height, startxy_sd, arm_sd, movez_r);
+    int res1 = _push_delta(sc, 1, print_time, reversexy_sd / movexy_r
+                           , start_sv, accel, height, startxy_sd, arm_sd
+                           , movez_r, count_only);
     if (res1 == ERROR_RET)
         return res1;
-    int res2 = _stepcompress_push_delta(
-        sc, 0, print_time, move_sd, start_sv, accel
-        , height + res1, startxy_sd, arm_sd, movez_r);
+    int res2 = _push_delta(sc, 0, print_time, move_sd, start_sv, accel
+                           , height + res1, startxy_sd, arm_sd, movez_r
+                           , count_only);
     if (res2 == ERROR_RET)
         return res2;
     return res1 + res2;
 }
 
 
+/****************************************************************
+ * Deferred step generation
+ ****************************************************************/
+
+// When a steppersync has worker threads, the step time calculations
+// of the functions below are recorded as "jobs" and only performed
+// (in one of the worker threads) during steppersync_flush().  The
+// number of steps is still calculated immediately so that the caller
+// can track the stepper position.
+
+enum { SJ_STEP, SJ_CONST, SJ_DELTA };
+
+struct step_job {
+    int type;
+    double print_time, params[7];
+};
+
+// Add a job to the list of deferred step time calculations (returns
+// NULL on an allocation failure)
+static struct step_job *
+add_job(struct stepcompress *sc, int type, double print_time)
+{
+    if (sc->job_count >= sc->job_alloc) {
+        int alloc = sc->job_alloc ? sc->job_alloc * 2 : 64;
+        struct step_job *jobs = realloc(sc->jobs, alloc * sizeof(*sc->jobs));
+        if (!jobs) {
+            errorf("stepcompress o=%d: unable to allocate %d jobs"
+                   , sc->oid, alloc);
+            return NULL;
+        }
+        sc->jobs = jobs;
+        sc->job_alloc = alloc;
+    }
+    struct step_job *j = &sc->jobs[sc->job_count++];
+    j->type = type;
+    j->print_time = print_time;
+    return j;
+}
+
+// Perform any deferred step time calculations
+int
+stepcompress_run_jobs(struct stepcompress *sc)
+{
+    struct step_job *j = sc->jobs, *end = &sc->jobs[sc->job_count];
+    sc->job_count = 0;
+    for (; j<end; j++) {
+        double *p = j->params;
+        int32_t ret;
+        if (j->type == SJ_STEP)
+            ret = push_step(sc, j->print_time, p[0]);
+        else if (j->type == SJ_CONST)
+            ret = push_const(sc, j->print_time, p[0], p[1], p[2], p[3], 0);
+        else
+            ret = push_delta(sc, j->print_time, p[0], p[1], p[2], p[3], p[4]
+                             , p[5], p[6], 0);
+        if (ret == ERROR_RET)
+            return ret;
+    }
+    return 0;
+}
+
+int32_t
+stepcompress_push(struct stepcompress *sc, double print_time, int32_t sdir)
+{
+    if (!sc->defer_jobs)
+        return push_step(sc, print_time, sdir);
+    struct step_job *j = add_job(sc, SJ_STEP, print_time);
+    if (!j)
+        return ERROR_RET;
+    j->params[0] = sdir;
+    return sdir ? 1 : -1;
+}
+
+int32_t
+stepcompress_push_const(
+    struct stepcompress *sc, double print_time
+    , double step_offset, double steps, double start_sv, double accel)
+{
+    if (!sc->defer_jobs)
+        return push_const(sc, print_time, step_offset, steps, start_sv, accel
+                          , 0);
+    int32_t res = push_const(sc, print_time, step_offset, steps, start_sv
+                             , accel, 1);
+    if (res && res != ERROR_RET) {
+        struct step_job *j = add_job(sc, SJ_CONST, print_time);
+        if (!j)
+            return ERROR_RET;
+        double *p = j->params;
+        p[0] = step_offset;
+        p[1] = steps;
+        p[2] = start_sv;
+        p[3] = accel;
+    }
+    return res;
+}
+
+int32_t
+stepcompress_push_delta(
+    struct stepcompress *sc, double print_time, double move_sd
+    , double start_sv, double accel
+    , double height, double startxy_sd, double arm_sd, double movez_r)
+{
+    if (!sc->defer_jobs)
+        return push_delta(sc, print_time, move_sd, start_sv, accel, height
+                          , startxy_sd, arm_sd, movez_r, 0);
+    int32_t res = push_delta(sc, print_time, move_sd, start_sv, accel, height
+                             , startxy_sd, arm_sd, movez_r, 1);
+    if (res != ERROR_RET) {
+        // Note that 'res' may be zero if there are steps in both directions
+        struct step_job *j = add_job(sc, SJ_DELTA, print_time);
+        if (!j)
+            return ERROR_RET;
+        double *p = j->params;
+        p[0] = move_sd;
+        p[1] = start_sv;
+        p[2] = accel;
+        p[3] = height;
+        p[4] = startxy_sd;
+        p[5] = arm_sd;
+        p[6] = movez_r;
+    }
+    return res;
+}
+
+
+/****************************************************************
+ * Per-move step generation
+ ****************************************************************/
+
+// The functions below schedule the steps of all the steppers of a
+// kinematic move with a single call.  The 'sparams' array contains
+// the parameters of each stepper (starting with the stepper's
+// commanded step position and inverse step distance) - the commanded
+// step position of each stepper is updated on return.
+
+// Schedule steps for the accel, cruise, and decel phases of a move
+// on cartesian style steppers.  The per stepper parameters are:
+// step_pos, inv_step_dist, start_pos, axis_d
+int32_t
+stepcompress_push_move(
+    struct stepcompress **sc_list, int sc_num, double *sparams
+    , double print_time, double move_d, double accel
+    , double start_v, double cruise_v
+    , double accel_r, double cruise_r, double decel_r
+    , double accel_t, double cruise_t)
+{
+    int i;
+    for (i=0; i<sc_num; i++, sparams += 4) {
+        double axis_d = sparams[3];
+        if (!axis_d)
+            continue;
+        struct stepcompress *sc = sc_list[i];
+        double step_pos = sparams[0], inv_step_dist = sparams[1];
+        double start_pos = sparams[2], move_time = print_time;
+        double axis_r = fabs(axis_d) / move_d;
+        double axis_accel = accel * axis_r, axis_cruise_v = cruise_v * axis_r;
+        int32_t count;
+        if (accel_r) {
+            double accel_d = accel_r * axis_d;
+            count = stepcompress_push_const(
+                sc, move_time, step_pos - start_pos * inv_step_dist
+                , accel_d * inv_step_dist, start_v * axis_r * inv_step_dist
+                , axis_accel * inv_step_dist);
+            if (count == ERROR_RET)
+                return count;
+            step_pos += count;
+            start_pos += accel_d;
+            move_time += accel_t;
+        }
+        if (cruise_r) {
+            double cruise_d = cruise_r * axis_d;
+            count = stepcompress_push_const(
+                sc, move_time, step_pos - start_pos * inv_step_dist
+                , cruise_d * inv_step_dist, axis_cruise_v * inv_step_dist
+                , 0.);
+            if (count == ERROR_RET)
+                return count;
+            step_pos += count;
+            start_pos += cruise_d;
+            move_time += cruise_t;
+        }
+        if (decel_r) {
+            double decel_d = decel_r * axis_d;
+            count = stepcompress_push_const(
+                sc, move_time, step_pos - start_pos * inv_step_dist
+                , decel_d * inv_step_dist, axis_cruise_v * inv_step_dist
+                , -axis_accel * inv_step_dist);
+            if (count == ERROR_RET)
+                return count;
+            step_pos += count;
+        }
+        sparams[0] = step_pos;
+    }
+    return 0;
+}
+
+// Schedule steps for the accel, cruise, and decel phases of a move
+// on delta style steppers.  The per stepper parameters are:
+// step_pos, inv_step_dist, height_base, startxy_d, arm_d
+int32_t
+stepcompress_push_delta_move(
+    struct stepcompress **sc_list, int sc_num, double *sparams
+    , double print_time, double accel, double start_v, double cruise_v
+    , double accel_d, double cruise_d, double decel_d
+    , double accel_t, double cruise_t, double movexy_r, double movez_r)
+{
+    int i;
+    for (i=0; i<sc_num; i++, sparams += 5) {
+        struct stepcompress *sc = sc_list[i];
+        double step_pos = sparams[0], inv_step_dist = sparams[1];
+        double height_base = sparams[2], startxy_d = sparams[3];
+        double arm_sd = sparams[4] * inv_step_dist, move_time = print_time;
+        int32_t count;
+        if (accel_d) {
+            count = stepcompress_push_delta(
+                sc, move_time, accel_d * inv_step_dist
+                , start_v * inv_step_dist, accel * inv_step_dist
+                , step_pos - height_base * inv_step_dist
+                , startxy_d * inv_step_dist, arm_sd, movez_r);
+            if (count == ERROR_RET)
+                return count;
+            step_pos += count;
+            height_base += accel_d * movez_r;
+            startxy_d -= accel_d * movexy_r;
+            move_time += accel_t;
+        }
+        if (cruise_d) {
+            count = stepcompress_push_delta(
+                sc, move_time, cruise_d * inv_step_dist
+                , cruise_v * inv_step_dist, 0.
+                , step_pos - height_base * inv_step_dist
+                , startxy_d * inv_step_dist, arm_sd, movez_r);
+            if (count == ERROR_RET)
+                return count;
+            step_pos += count;
+            height_base += cruise_d * movez_r;
+            startxy_d -= cruise_d * movexy_r;
+            move_time += cruise_t;
+        }
+        if (decel_d) {
+            count = stepcompress_push_delta(
+                sc, move_time, decel_d * inv_step_dist
+                , cruise_v * inv_step_dist, -accel * inv_step_dist
+                , step_pos - height_base * inv_step_dist
+                , startxy_d * inv_step_dist, arm_sd, movez_r);
+            if (count == ERROR_RET)
+                return count;
+            step_pos += count;
+        }
+        sparams[0] = step_pos;
+    }
+    return 0;
+}
+
+
+/****************************************************************
+ * Step time capture and replay
+ ****************************************************************/
+
+// The step times added to a stepcompress object (along with the
+// flush, direction, and reset events that determine how they are
+// compressed) may be written to a capture file.  Replaying the
+// capture file reproduces the exact compressor input, which is useful
+// for benchmarking and regression testing the compression code (see
+// scripts/stepcompress_bench.py).  The capture file is a series of
+// records of native endian uint32_t words - each record starts with a
+// type (CAP_xxx) followed by its parameters.
+
+// Write any step times not yet in the capture file
+static void
+capture_steps(struct stepcompress *sc)
+{
+    if (sc->capture_next < sc->queue_pos)
+        sc->capture_next = sc->queue_pos;
+    int count = sc->queue_next - sc->capture_next;
+    if (count <= 0)
+        return;
+    uint32_t hdr[2] = { CAP_STEPS, count };
+    fwrite(hdr, sizeof(hdr), 1, sc->capture);
+    fwrite(sc->capture_next, sizeof(*sc->capture_next), count, sc->capture);
+    sc->capture_next = sc->queue_next;
+}
+
+// Write an event record (after any pending step times)
+static void
+capture_event(struct stepcompress *sc, uint32_t type, uint64_t clock)
+{
+    capture_steps(sc);
+    uint32_t rec[3] = { type, clock, clock >> 32 };
+    fwrite(rec, sizeof(rec), 1, sc->capture);
+}
+
+// Write a record for a command queued with stepcompress_queue_msg()
+static void
+capture_msg(struct stepcompress *sc, uint32_t *data, int len)
+{
+    capture_steps(sc);
+    uint32_t hdr[2] = { CAP_MSG, len };
+    fwrite(hdr, sizeof(hdr), 1, sc->capture);
+    fwrite(data, sizeof(*data), len, sc->capture);
+}
+
+// Start (or stop if 'filename' is empty) capturing step times to a file
+int
+stepcompress_set_capture(struct stepcompress *sc, const char *filename)
+{
+    if (sc->capture) {
+        capture_steps(sc);
+        fclose(sc->capture);
+        sc->capture = NULL;
+    }
+    if (!filename || !filename[0])
+        return 0;
+    sc->capture = fopen(filename, "wb");
+    if (!sc->capture) {
+        report_errno("fopen", -1);
+        return -1;
+    }
+    sc->capture_next = sc->queue_next;
+    uint32_t rec[3] = { CAP_INIT, sc->oid, sc->max_error };
+    fwrite(rec, sizeof(rec), 1, sc->capture);
+    return 0;
+}
+
+struct stepcompress_replay {
+    uint32_t oid, max_error, peak_error;
+    uint64_t steps, messages, bytes;
+};
+
+// Move messages from the stepcompress message queue to the replay output
+static void
+replay_drain(struct stepcompress *sc, FILE *out
+             , struct stepcompress_replay *res)
+{
+    while (!list_empty(&sc->msg_queue)) {
+        struct queue_message *qm = list_first_entry(
+            &sc->msg_queue, struct queue_message, node);
+        list_del(&qm->node);
+        res->messages++;
+        res->bytes += qm->len;
+        if (out) {
+            uint64_t hdr[2] = { qm->req_clock, qm->min_clock };
+            fwrite(hdr, sizeof(hdr), 1, out);
+            fwrite(&qm->len, sizeof(qm->len), 1, out);
+            fwrite(qm->msg, 1, qm->len, out);
+        }
+        free(qm);
+    }
+}
+
+// Run the step times of a capture file through the compressor.  The
+// generated messages are written to 'out_filename' (if not empty).
+int
+stepcompress_replay(uint32_t *data, int len, const char *out_filename
+                    , int fast_mode, struct stepcompress_replay *res)
+{
+    memset(res, 0, sizeof(*res));
+    if (len < 3 || data[0] != CAP_INIT)
+        return -1;
+    struct stepcompress *sc = stepcompress_alloc(data[2], 0, 1, 0, data[1]);
+    sc->fast_mode = fast_mode;
+    res->oid = data[1];
+    res->max_error = data[2];
+    FILE *out = NULL;
+    if (out_filename && out_filename[0]) {
+        out = fopen(out_filename, "wb");
+        if (!out) {
+            report_errno("fopen", -1);
+            stepcompress_free(sc);
+            return -1;
+        }
+    }
+    uint32_t *p = &data[3], *end = &data[len];
+    int ret = 0;
+    while (!ret && p < end) {
+        uint32_t type = *p++;
+        if (type == CAP_STEPS || type == CAP_MSG) {
+            if (p >= end || p[0] > end - p - 1) {
+                ret = -1;
+                break;
+            }
+            uint32_t count = *p++;
+            if (type == CAP_STEPS) {
+                if (sc->queue_end - sc->queue_next < count)
+                    ret = queue_expand(sc);
+                if (ret || sc->queue_end - sc->queue_next < count) {
+                    ret = -1;
+                    break;
+                }
+                memcpy(sc->queue_next, p, count * sizeof(*p));
+                sc->queue_next += count;
+                res->steps += count;
+            } else {
+                ret = stepcompress_queue_msg(sc, p, count);
+            }
+            p += count;
+        } else {
+            if (end - p < 2) {
+                ret = -1;
+                break;
+            }
+            uint64_t clock = p[0] | ((uint64_t)p[1] << 32);
+            p += 2;
+            switch (type) {
+            case CAP_FLUSH: ret = stepcompress_flush(sc, clock); break;
+            case CAP_FLUSH_FAR: ret = stepcompress_flush_far(sc, clock); break;
+            case CAP_DIR: ret = set_next_step_dir(sc, clock); break;
+            case CAP_RESET: ret = stepcompress_reset(sc, clock); break;
+            case CAP_HOMING: ret = stepcompress_set_homing(sc, clock); break;
+            case CAP_MAX_ERROR: stepcompress_set_max_error(sc, clock); break;
+            default: ret = -1; break;
+            }
+        }
+        replay_drain(sc, out, res);
+    }
+    if (ret == -1)
+        errorf("stepcompress_replay: invalid capture data");
+    if (!ret)
+        ret = stepcompress_flush(sc, UINT64_MAX);
+    replay_drain(sc, out, res);
+    res->peak_error = sc->peak_step_error;
+    if (out)
+        fclose(out);
+    stepcompress_free(sc);
+    return ret;
+}
+
+
 /****************************************************************
  * Step compress synchronization
  ****************************************************************/
@@ -717,6 +1294,12 @@ stepcompress_push_delta(
 // mcu step queue is ordered between steppers so that no stepper
 // starves the other steppers of space in the mcu step queue.
 
+// The next pending message of a stepcompress object
+struct msg_heap_entry {
+    uint64_t req_clock;
+    int sc_pos;
+};
+
 struct steppersync {
     // Serial port
     struct serialqueue *sq;
@@ -727,9 +1310,18 @@ struct steppersync {
     // Storage for list of pending move clocks
     uint64_t *move_clocks;
     int num_move_clocks;
+    // Storage for merging the messages of each stepcompress
+    struct msg_heap_entry *msg_heap;
+    // Worker threads
+    pthread_mutex_t lock; // protects variables below
+    pthread_cond_t cond, done_cond;
+    pthread_t *threads;
+    int num_threads, exit_threads, next_task, pending_tasks, task_ret;
+    uint64_t task_clock;
 };
 
-// Allocate a new 'steppersync' object
+// Allocate a new 'steppersync' object.  If 'sq' is NULL the generated
+// commands are discarded (this is used for benchmarking).
 struct steppersync *
 steppersync_alloc(struct serialqueue *sq, struct stepcompress **sc_list
                   , int sc_num, int move_num)
@@ -747,30 +1339,154 @@ steppersync_alloc(struct serialqueue *sq, struct stepcompress **sc_list
     memset(ss->move_clocks, 0, sizeof(*ss->move_clocks)*move_num);
     ss->num_move_clocks = move_num;
 
+    ss->msg_heap = malloc(sizeof(*ss->msg_heap)*sc_num);
+
+    pthread_mutex_init(&ss->lock, NULL);
+    pthread_cond_init(&ss->cond, NULL);
+    pthread_cond_init(&ss->done_cond, NULL);
+    ss->num_threads = 1;
+
     return ss;
 }
 
+// Run pending flush tasks (one task per stepcompress object).  The
+// lock must be held by the caller.
+static void
+steppersync_run_tasks(struct steppersync *ss)
+{
+    while (ss->next_task < ss->sc_num) {
+        struct stepcompress *sc = ss->sc_list[ss->next_task++];
+        uint64_t move_clock = ss->task_clock;
+        pthread_mutex_unlock(&ss->lock);
+        int ret = stepcompress_run_jobs(sc);
+        if (!ret)
+            ret = stepcompress_flush(sc, move_clock);
+        pthread_mutex_lock(&ss->lock);
+        if (ret)
+            ss->task_ret = ret;
+        if (!--ss->pending_tasks)
+            pthread_cond_signal(&ss->done_cond);
+    }
+}
+
+// Main code for worker threads
+static void *
+steppersync_worker(void *data)
+{
+    struct steppersync *ss = data;
+    pthread_mutex_lock(&ss->lock);
+    while (!ss->exit_threads) {
+        steppersync_run_tasks(ss);
+        pthread_cond_wait(&ss->cond, &ss->lock);
+    }
+    pthread_mutex_unlock(&ss->lock);
+    return NULL;
+}
+
+// Stop and free any worker threads
+static void
+steppersync_stop_threads(struct steppersync *ss)
+{
+    pthread_mutex_lock(&ss->lock);
+    ss->exit_threads = 1;
+    pthread_cond_broadcast(&ss->cond);
+    pthread_mutex_unlock(&ss->lock);
+    int i;
+    for (i=0; i<ss->num_threads-1; i++)
+        pthread_join(ss->threads[i], NULL);
+    free(ss->threads);
+    ss->threads = NULL;
+    ss->num_threads = 1;
+    ss->exit_threads = 0;
+}
+
+// Set the number of threads used to generate and compress step times
+// in steppersync_flush().  With more than one thread the step time
+// calculations of the associated stepcompress objects are deferred
+// until the flush.
+int
+steppersync_set_threads(struct steppersync *ss, int num_threads)
+{
+    steppersync_stop_threads(ss);
+    if (num_threads < 1)
+        num_threads = 1;
+    int i;
+    for (i=0; i<ss->sc_num; i++) {
+        struct stepcompress *sc = ss->sc_list[i];
+        int ret = stepcompress_run_jobs(sc);
+        if (ret)
+            return ret;
+        sc->defer_jobs = num_threads > 1;
+    }
+    if (num_threads <= 1)
+        return 0;
+    // Workers must not find any tasks until the next steppersync_flush()
+    pthread_mutex_lock(&ss->lock);
+    ss->next_task = ss->sc_num;
+    ss->pending_tasks = 0;
+    pthread_mutex_unlock(&ss->lock);
+    ss->threads = malloc(sizeof(*ss->threads) * (num_threads-1));
+    for (i=0; i<num_threads-1; i++) {
+        int ret = pthread_create(&ss->threads[i], NULL
+                                 , steppersync_worker, ss);
+        if (ret) {
+            report_errno("pthread_create", ret);
+            break;
+        }
+        ss->num_threads++;
+    }
+    return 0;
+}
+
 // Free memory associated with a 'steppersync' object
 void
 steppersync_free(struct steppersync *ss)
 {
     if (!ss)
         return;
+    steppersync_stop_threads(ss);
+    pthread_mutex_destroy(&ss->lock);
+    pthread_cond_destroy(&ss->cond);
+    pthread_cond_destroy(&ss->done_cond);
     free(ss->sc_list);
+    free(ss->msg_heap);
     free(ss->move_clocks);
     serialqueue_free_commandqueue(ss->cq);
     free(ss);
 }
 
-// Set the conversion rate of 'print_time' to mcu clock
-void
+// Set the conversion rate of 'print_time' to mcu clock.  Any deferred
+// step time calculations are run first so that they use the
+// conversion that was in effect when they were added.
+int
 steppersync_set_time(struct steppersync *ss, double time_offset, double mcu_freq)
 {
     int i;
     for (i=0; i<ss->sc_num; i++) {
         struct stepcompress *sc = ss->sc_list[i];
+        int ret = stepcompress_run_jobs(sc);
+        if (ret)
+            return ret;
         stepcompress_set_time(sc, time_offset, mcu_freq);
     }
+    return 0;
+}
+
+// Report the step queue statistics of the associated stepcompress objects
+void
+steppersync_get_stats(struct steppersync *ss, char *buf, int len)
+{
+    uint32_t queue_peak = 0, queue_moves = 0, queue_flushes = 0;
+    int i;
+    for (i=0; i<ss->sc_num; i++) {
+        struct stepcompress *sc = ss->sc_list[i];
+        if (sc->queue_peak > queue_peak)
+            queue_peak = sc->queue_peak;
+        queue_moves += sc->queue_moves;
+        queue_flushes += sc->queue_flushes;
+    }
+    snprintf(buf, len, "step_queue_peak=%u step_queue_moves=%u"
+             " step_queue_flushes=%u", queue_peak, queue_moves, queue_flushes);
 }
 
 // Implement a binary heap algorithm to track when the next available
@@ -798,37 +1514,89 @@ heap_replace(struct steppersync *ss, uint64_t req_clock)
     }
 }
 
+// Check if heap entry 'a' should be transmitted before entry 'b'
+static inline int
+msg_heap_less(struct msg_heap_entry *a, struct msg_heap_entry *b)
+{
+    // Messages with the same reqclock are ordered by stepper position
+    // in sc_list
+    return (a->req_clock < b->req_clock
+            || (a->req_clock == b->req_clock && a->sc_pos < b->sc_pos));
+}
+
+// Move the heap entry at 'pos' down to its place in the heap
+static void
+msg_heap_sift_down(struct msg_heap_entry *mh, int nmh, int pos)
+{
+    struct msg_heap_entry e = mh[pos];
+    for (;;) {
+        int child_pos = 2*pos+1;
+        if (child_pos >= nmh)
+            break;
+        if (child_pos + 1 < nmh
+            && msg_heap_less(&mh[child_pos + 1], &mh[child_pos]))
+            child_pos++;
+        if (!msg_heap_less(&mh[child_pos], &e))
+            break;
+        mh[pos] = mh[child_pos];
+        pos = child_pos;
+    }
+    mh[pos] = e;
+}
+
 // Find and transmit any scheduled steps prior to the given 'move_clock'
 int
 steppersync_flush(struct steppersync *ss, uint64_t move_clock)
 {
     // Flush each stepcompress to the specified move_clock
     int i;
-    for (i=0; i<ss->sc_num; i++) {
-        int ret = stepcompress_flush(ss->sc_list[i], move_clock);
+    if (ss->num_threads > 1) {
+        pthread_mutex_lock(&ss->lock);
+        ss->next_task = ss->task_ret = 0;
+        ss->pending_tasks = ss->sc_num;
+        ss->task_clock = move_clock;
+        pthread_cond_broadcast(&ss->cond);
+        steppersync_run_tasks(ss);
+        while (ss->pending_tasks)
+            pthread_cond_wait(&ss->done_cond, &ss->lock);
+        int ret = ss->task_ret;
+        pthread_mutex_unlock(&ss->lock);
         if (ret)
             return ret;
+    } else {
+        for (i=0; i<ss->sc_num; i++) {
+            int ret = stepcompress_flush(ss->sc_list[i], move_clock);
+            if (ret)
+                return ret;
+        }
+    }
+
+    // Build a heap of the first pending message of each stepcompress
+    struct msg_heap_entry *mh = ss->msg_heap;
+    int nmh = 0;
+    for (i=0; i<ss->sc_num; i++) {
+        struct stepcompress *sc = ss->sc_list[i];
+        if (list_empty(&sc->msg_queue))
+            continue;
+        struct queue_message *m = list_first_entry(
+            &sc->msg_queue, struct queue_message, node);
+        mh[nmh].req_clock = m->req_clock;
+        mh[nmh].sc_pos = i;
+        nmh++;
     }
+    for (i=nmh/2-1; i>=0; i--)
+        msg_heap_sift_down(mh, nmh, i);
 
     // Order commands by the reqclock of each pending command
     struct list_head msgs;
     list_init(&msgs);
-    for (;;) {
+    while (nmh) {
         // Find message with lowest reqclock
-        uint64_t req_clock = MAX_CLOCK;
-        struct queue_message *qm = NULL;
-        for (i=0; i<ss->sc_num; i++) {
-            struct stepcompress *sc = ss->sc_list[i];
-            if (!list_empty(&sc->msg_queue)) {
-                struct queue_message *m = list_first_entry(
-                    &sc->msg_queue, struct queue_message, node);
-                if (m->req_clock < req_clock) {
-                    qm = m;
-                    req_clock = m->req_clock;
-                }
-            }
-        }
-        if (!qm || (qm->min_clock && req_clock > move_clock))
+        struct stepcompress *sc = ss->sc_list[mh[0].sc_pos];
+        struct queue_message *qm = list_first_entry(
+            &sc->msg_queue, struct queue_message, node);
+        uint64_t req_clock = qm->req_clock;
+        if (qm->min_clock && req_clock > move_clock)
             break;
 
         uint64_t next_avail = ss->move_clocks[0];
@@ -843,10 +1611,22 @@ steppersync_flush(struct steppersync *ss, uint64_t move_clock)
         // Batch this command
         list_del(&qm->node);
         list_add_tail(&qm->node, &msgs);
+
+        // Update heap with the next message of this stepcompress
+        if (list_empty(&sc->msg_queue)) {
+            mh[0] = mh[--nmh];
+        } else {
+            struct queue_message *m = list_first_entry(
+                &sc->msg_queue, struct queue_message, node);
+            mh[0].req_clock = m->req_clock;
+        }
+        msg_heap_sift_down(mh, nmh, 0);
     }
 
     // Transmit commands
-    if (!list_empty(&msgs))
+    if (!ss->sq)
+        message_queue_free(&msgs);
+    else if (!list_empty(&msgs))
         serialqueue_send_batch(ss->sq, ss->cq, &msgs);
     return 0;
 }
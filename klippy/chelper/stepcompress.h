@@ -0,0 +1,24 @@
+#ifndef STEPCOMPRESS_H
+#define STEPCOMPRESS_H
+
+#include <stdint.h> // uint32_t
+
+#define ERROR_RET -989898989
+
+struct queue_append {
+    struct stepcompress *sc;
+    uint32_t *qnext, *qend, last_step_clock_32;
+    double clock_offset;
+};
+
+struct queue_append queue_append_start(
+    struct stepcompress *sc, double print_time, double adjust);
+void queue_append_finish(struct queue_append qa);
+int queue_append(struct queue_append *qa, double step_clock);
+int queue_append_set_next_step_dir(struct queue_append *qa, int sdir);
+
+int stepcompress_run_jobs(struct stepcompress *sc);
+int stepcompress_get_step_dir(struct stepcompress *sc);
+double stepcompress_get_mcu_freq(struct stepcompress *sc);
+
+#endif // stepcompress.h
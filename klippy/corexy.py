@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math
-import stepper, homing
+import stepper, homing, mcu
 
 StepList = (0, 1, 2)
 
@@ -33,6 +33,19 @@ class CoreXYKinematics:
         self.steppers[1].set_max_jerk(max_xy_halt_velocity, max_accel)
         self.steppers[2].set_max_jerk(
             min(max_halt_velocity, self.max_z_velocity), self.max_z_accel)
+        # Setup step generation
+        self.use_itersolve = config.getchoice(
+            'step_solver', {'analytic': False, 'iterative': True}, 'analytic')
+        if self.use_itersolve:
+            self.steppers[0].mcu_stepper.setup_itersolve(
+                'corexy_stepper_alloc', '+')
+            self.steppers[1].mcu_stepper.setup_itersolve(
+                'corexy_stepper_alloc', '-')
+            for mcu_stepper in self.steppers[2].get_mcu_steppers():
+                mcu_stepper.setup_itersolve('cartesian_stepper_alloc', 'z')
+        self.step_group = mcu.StepperGroup([
+            (s, i) for i in StepList
+            for s in self.steppers[i].get_mcu_steppers()])
     def get_steppers(self, flags=""):
         if flags == "Z":
             return [self.steppers[2]]
@@ -124,6 +137,9 @@ class CoreXYKinematics:
     def move(self, print_time, move):
         if self.need_motor_enable:
             self._check_motor_enable(print_time, move)
+        if self.use_itersolve:
+            self.step_group.step_itersolve(print_time, move)
+            return
         sxp = move.start_pos[0]
         syp = move.start_pos[1]
         move_start_pos = (sxp + syp, sxp - syp, move.start_pos[2])
@@ -131,31 +147,4 @@ class CoreXYKinematics:
         eyp = move.end_pos[1]
         axes_d = ((exp + eyp) - move_start_pos[0],
                   (exp - eyp) - move_start_pos[1], move.axes_d[2])
-        for i in StepList:
-            axis_d = axes_d[i]
-            if not axis_d:
-                continue
-            step_const = self.steppers[i].step_const
-            move_time = print_time
-            start_pos = move_start_pos[i]
-            axis_r = abs(axis_d) / move.move_d
-            accel = move.accel * axis_r
-            cruise_v = move.cruise_v * axis_r
-
-            # Acceleration steps
-            if move.accel_r:
-                accel_d = move.accel_r * axis_d
-                step_const(move_time, start_pos, accel_d,
-                           move.start_v * axis_r, accel)
-                start_pos += accel_d
-                move_time += move.accel_t
-            # Cruising steps
-            if move.cruise_r:
-                cruise_d = move.cruise_r * axis_d
-                step_const(move_time, start_pos, cruise_d, cruise_v, 0.)
-                start_pos += cruise_d
-                move_time += move.cruise_t
-            # Deceleration steps
-            if move.decel_r:
-                decel_d = move.decel_r * axis_d
-                step_const(move_time, start_pos, decel_d, cruise_v, -accel)
+        self.step_group.step_move(print_time, move, move_start_pos, axes_d)
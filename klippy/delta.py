@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, logging
-import stepper, homing
+import stepper, homing, mcu
 
 StepList = (0, 1, 2)
 
@@ -71,6 +71,15 @@ class DeltaKinematics:
             "Delta max build radius %.2fmm (moves slowed past %.2fmm and %.2fmm)"
             % (math.sqrt(self.max_xy2), math.sqrt(self.slow_xy2),
                math.sqrt(self.very_slow_xy2)))
+        # Setup step generation
+        self.use_itersolve = config.getchoice(
+            'step_solver', {'analytic': False, 'iterative': True}, 'analytic')
+        if self.use_itersolve:
+            for s, arm2, tower in zip(self.steppers, self.arm2, self.towers):
+                s.mcu_stepper.setup_itersolve(
+                    'delta_stepper_alloc', arm2, tower[0], tower[1])
+        self.step_group = mcu.StepperGroup([
+            (s.mcu_stepper, i) for i, s in enumerate(self.steppers)])
         self.set_position([0., 0., 0.], ())
     def get_steppers(self, flags=""):
         return list(self.steppers)
@@ -153,6 +162,9 @@ class DeltaKinematics:
     def move(self, print_time, move):
         if self.need_motor_enable:
             self._check_motor_enable(print_time)
+        if self.use_itersolve:
+            self.step_group.step_itersolve(print_time, move)
+            return
         axes_d = move.axes_d
         move_d = move.move_d
         movexy_r = 1.
@@ -171,12 +183,11 @@ class DeltaKinematics:
 
         origx, origy, origz = move.start_pos[:3]
 
-        accel = move.accel
-        cruise_v = move.cruise_v
         accel_d = move.accel_r * move_d
         cruise_d = move.cruise_r * move_d
         decel_d = move.decel_r * move_d
 
+        towers = []
         for i in StepList:
             # Calculate a virtual tower along the line of movement at
             # the point closest to this stepper's tower.
@@ -185,26 +196,12 @@ class DeltaKinematics:
             vt_startxy_d = (towerx_d*axes_d[0] + towery_d*axes_d[1])*inv_movexy_d
             tangentxy_d2 = towerx_d**2 + towery_d**2 - vt_startxy_d**2
             vt_arm_d = math.sqrt(self.arm2[i] - tangentxy_d2)
-            vt_startz = origz
+            towers.append((origz, vt_startxy_d, vt_arm_d))
 
-            # Generate steps
-            step_delta = self.steppers[i].step_delta
-            move_time = print_time
-            if accel_d:
-                step_delta(move_time, accel_d, move.start_v, accel,
-                           vt_startz, vt_startxy_d, vt_arm_d, movez_r)
-                vt_startz += accel_d * movez_r
-                vt_startxy_d -= accel_d * movexy_r
-                move_time += move.accel_t
-            if cruise_d:
-                step_delta(move_time, cruise_d, cruise_v, 0.,
-                           vt_startz, vt_startxy_d, vt_arm_d, movez_r)
-                vt_startz += cruise_d * movez_r
-                vt_startxy_d -= cruise_d * movexy_r
-                move_time += move.cruise_t
-            if decel_d:
-                step_delta(move_time, decel_d, cruise_v, -accel,
-                           vt_startz, vt_startxy_d, vt_arm_d, movez_r)
+        # Generate steps
+        self.step_group.step_delta_move(
+            print_time, move, towers, accel_d, cruise_d, decel_d,
+            movexy_r, movez_r)
     # Helper functions for DELTA_CALIBRATE script
     def get_stable_position(self):
         return [int((ep - s.mcu_stepper.get_commanded_position())
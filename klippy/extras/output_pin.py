@@ -51,15 +51,18 @@ class PrinterOutputPin:
             raise self.gcode.error("Static pin can not be changed at run-time")
         value = self.gcode.get_float('VALUE', params, minval=0., maxval=1.)
         value /= self.scale
+        if not self.is_pwm and value not in [0., 1.]:
+            raise self.gcode.error("Invalid pin value")
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.register_lookahead_callback(
+            (lambda print_time: self._set_pin(print_time, value)))
+    def _set_pin(self, print_time, value):
         if value == self.last_value:
             return
-        print_time = self.printer.lookup_object('toolhead').get_last_move_time()
         print_time = max(print_time, self.last_value_time + PIN_MIN_TIME)
         if self.is_pwm:
             self.mcu_pin.set_pwm(print_time, value)
         else:
-            if value not in [0., 1.]:
-                raise self.gcode.error("Invalid pin value")
             self.mcu_pin.set_digital(print_time, value)
         self.last_value = value
         self.last_value_time = print_time
@@ -0,0 +1,26 @@
+# Report timer lateness and the run time of reactor callbacks
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
+
+class ReactorProfile:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.profiler = self.printer.get_reactor().enable_profiling()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command(
+            "REACTOR_PROFILE", self.cmd_REACTOR_PROFILE, when_not_ready=True,
+            desc=self.cmd_REACTOR_PROFILE_help)
+    def printer_state(self, state):
+        if state == 'shutdown':
+            logging.info("Dumping reactor profile:\n%s", self.profiler.dump())
+    cmd_REACTOR_PROFILE_help = "Report reactor callback timing statistics"
+    def cmd_REACTOR_PROFILE(self, params):
+        self.gcode.respond_info(self.profiler.dump())
+        if self.gcode.get_int('RESET', params, 0):
+            self.profiler.reset()
+
+def load_config(config):
+    return ReactorProfile(config)
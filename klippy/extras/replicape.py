@@ -74,14 +74,15 @@ class pca9685_pwm:
                 self._mcu.seconds_to_clock(self._max_duration)))
         cmd_queue = self._mcu.alloc_command_queue()
         self._set_cmd = self._mcu.lookup_command(
-            "schedule_pca9685_out oid=%c clock=%u value=%hu", cq=cmd_queue)
+            "schedule_pca9685_out oid=%c clock=%u value=%hu",
+            cq=cmd_queue).prepare([self._oid])
     def set_pwm(self, print_time, value):
         clock = self._mcu.print_time_to_clock(print_time)
         if self._invert:
             value = 1. - value
         value = int(max(0., min(1., value)) * self._pwm_max + 0.5)
         self._replicape.note_pwm_enable(print_time, self._channel, value)
-        self._set_cmd.send([self._oid, clock, value],
+        self._set_cmd.send([clock, value],
                            minclock=self._last_clock, reqclock=clock)
         self._last_clock = clock
     def set_digital(self, print_time, value):
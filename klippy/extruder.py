@@ -44,6 +44,7 @@ class PrinterExtruder:
             'pressure_advance', 0., minval=0.)
         self.pressure_advance_lookahead_time = config.getfloat(
             'pressure_advance_lookahead_time', 0.010, minval=0.)
+        self.last_pa_move = None
         self.need_motor_enable = True
         self.extrude_pos = 0.
         self.printer.lookup_object('gcode').register_command(
@@ -65,6 +66,10 @@ class PrinterExtruder:
     def check_move(self, move):
         move.extrude_r = move.axes_d[3] / move.move_d
         move.extrude_max_corner_v = 0.
+        # Pressure advance settings are captured when the move is queued
+        move.pressure_advance = self.pressure_advance
+        move.pressure_advance_lookahead_time = (
+            self.pressure_advance_lookahead_time)
         if not self.heater.can_extrude:
             raise homing.EndstopError(
                 "Extrude below minimum temp\n"
@@ -83,6 +88,7 @@ class PrinterExtruder:
             if move.axes_d[3] <= self.nozzle_diameter * self.max_extrude_ratio:
                 # Permit extrusion if amount extruded is tiny
                 move.extrude_r = self.max_extrude_ratio
+                self._note_pa_move(move)
                 return
             area = move.axes_d[3] * self.filament_area / move.move_d
             logging.debug("Overextrude: %s vs %s (area=%.3f dist=%.3f)",
@@ -92,6 +98,14 @@ class PrinterExtruder:
                 "Move exceeds maximum extrusion (%.3fmm^2 vs %.3fmm^2)\n"
                 "See the 'max_extrude_cross_section' config option for details"
                 % (area, self.max_extrude_ratio * self.filament_area))
+        self._note_pa_move(move)
+    def _note_pa_move(self, move):
+        # Track the last queued move that uses pressure advance
+        if move.pressure_advance and move.pressure_advance_lookahead_time:
+            self.last_pa_move = move
+    def reset_lookahead(self):
+        # The look-ahead queue was discarded
+        self.last_pa_move = None
     def calc_junction(self, prev_move, move):
         extrude = move.axes_d[3]
         prev_extrude = prev_move.axes_d[3]
@@ -107,14 +121,16 @@ class PrinterExtruder:
             move.extrude_r = prev_move.extrude_r
         return move.max_cruise_v2
     def lookahead(self, moves, flush_count, lazy):
-        lookahead_t = self.pressure_advance_lookahead_time
-        if not self.pressure_advance or not lookahead_t:
+        if self.last_pa_move is None:
             return flush_count
         # Calculate max_corner_v - the speed the head will accelerate
         # to after cornering.
         for i in range(flush_count):
             move = moves[i]
-            if not move.decel_t:
+            if not move.decel_t or not move.axes_d[3]:
+                continue
+            lookahead_t = move.pressure_advance_lookahead_time
+            if not move.pressure_advance or not lookahead_t:
                 continue
             cruise_v = move.cruise_v
             max_corner_v = 0.
@@ -147,6 +163,8 @@ class PrinterExtruder:
         if self.need_motor_enable:
             self.stepper.motor_enable(print_time, 1)
             self.need_motor_enable = False
+        if move is self.last_pa_move:
+            self.last_pa_move = None
         axis_d = move.axes_d[3]
         axis_r = abs(axis_d) / move.move_d
         accel = move.accel * axis_r
@@ -164,9 +182,9 @@ class PrinterExtruder:
         # Update for pressure advance
         start_pos = self.extrude_pos
         if (axis_d >= 0. and (move.axes_d[0] or move.axes_d[1])
-            and self.pressure_advance):
+            and move.pressure_advance):
             # Increase accel_d and start_v when accelerating
-            pressure_advance = self.pressure_advance * move.extrude_r
+            pressure_advance = move.pressure_advance * move.extrude_r
             prev_pressure_d = start_pos - move.start_pos[3]
             if accel_d:
                 npd = move.cruise_v * pressure_advance
@@ -226,8 +244,9 @@ class PrinterExtruder:
         self.extrude_pos = start_pos
     cmd_SET_PRESSURE_ADVANCE_help = "Set pressure advance parameters"
     def cmd_SET_PRESSURE_ADVANCE(self, params):
-        self.printer.lookup_object('toolhead').get_last_move_time()
         gcode = self.printer.lookup_object('gcode')
+        if gcode.get_int('SYNC', params, 0, minval=0, maxval=1):
+            self.printer.lookup_object('toolhead').get_last_move_time()
         pressure_advance = gcode.get_float(
             'ADVANCE', params, self.pressure_advance, minval=0.)
         pressure_advance_lookahead_time = gcode.get_float(
@@ -254,6 +273,8 @@ class DummyExtruder:
         return move.max_cruise_v2
     def lookahead(self, moves, flush_count, lazy):
         return flush_count
+    def reset_lookahead(self):
+        pass
 
 def add_printer_objects(printer, config):
     for i in range(99):
@@ -39,6 +39,7 @@ class GCodeParser:
             self.register_command(cmd, func, wnr, desc)
             for a in getattr(self, 'cmd_' + cmd + '_aliases', []):
                 self.register_command(a, func, wnr)
+        self.move_handler = self.ready_gcode_handlers['G1']
         # G-Code coordinate manipulation
         self.absolutecoord = self.absoluteextrude = True
         self.base_position = [0.0, 0.0, 0.0, 0.0]
@@ -127,28 +128,51 @@ class GCodeParser:
         logging.info("\n".join(out))
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    move_args = {'X': 0, 'Y': 1, 'Z': 2, 'E': 3, 'F': 4}
+    def parse_move(self, parts):
+        # Parse the parameters of a plain "G1 X1.0 Y2.0 ..." command
+        coords = [None] * 5
+        for arg in parts[1:]:
+            pos = self.move_args.get(arg[:1])
+            value = arg[1:]
+            if pos is None or not value or value.strip('0123456789.-+'):
+                return None
+            coords[pos] = value
+        return coords
     def process_commands(self, commands, need_ack=True):
+        move_handler = self.move_handler
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
             cpos = line.find(';')
             if cpos >= 0:
                 line = line[:cpos]
-            # Break command into parts
-            parts = self.args_r.split(line.upper())[1:]
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(0, len(parts), 2) }
-            params['#original'] = origline
-            if parts and parts[0] == 'N':
-                # Skip line number at start of command
-                del parts[:2]
-            if not parts:
-                # Treat empty line as empty command
-                parts = ['', '']
-            params['#command'] = cmd = parts[0] + parts[1].strip()
+            # Handle G0/G1 moves (most of a typical gcode file) without
+            # the general parser
+            parts = line.split()
+            coords = None
+            if parts and self.gcode_handlers.get(parts[0]) is move_handler:
+                coords = self.parse_move(parts)
+            if coords is not None:
+                cmd = parts[0]
+                handler = self.move
+                params = (coords, origline)
+            else:
+                # Break command into parts
+                parts = self.args_r.split(line.upper())[1:]
+                params = { parts[i]: parts[i+1].strip()
+                           for i in range(0, len(parts), 2) }
+                params['#original'] = origline
+                if parts and parts[0] == 'N':
+                    # Skip line number at start of command
+                    del parts[:2]
+                if not parts:
+                    # Treat empty line as empty command
+                    parts = ['', '']
+                params['#command'] = cmd = parts[0] + parts[1].strip()
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
             # Invoke handler for command
             self.need_ack = need_ack
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
                 handler(params)
             except error as e:
@@ -337,20 +361,26 @@ class GCodeParser:
             if temp > 0.:
                 self.respond_error("Heater not configured")
             return
-        print_time = self.toolhead.get_last_move_time()
         try:
-            heater.set_temp(print_time, temp)
+            heater.check_temp(temp)
         except heater.error as e:
             raise error(str(e))
         if wait and temp:
+            print_time = self.toolhead.get_last_move_time()
+            heater.set_temp(print_time, temp)
             self.bg_temp(heater)
+            return
+        # Update the target after the pending moves without draining
+        # the lookahead queue
+        self.toolhead.register_lookahead_callback(
+            (lambda print_time: heater.set_temp(print_time, temp)))
     def set_fan_speed(self, speed):
         if self.fan is None:
             if speed and not self.is_fileinput:
                 self.respond_info("Fan not configured")
             return
-        print_time = self.toolhead.get_last_move_time()
-        self.fan.set_speed(print_time, speed)
+        self.toolhead.register_lookahead_callback(
+            (lambda print_time: self.fan.set_speed(print_time, speed)))
     # G-Code special command handlers
     def cmd_default(self, params):
         if not self.is_printer_ready:
@@ -391,32 +421,36 @@ class GCodeParser:
     cmd_G1_aliases = ['G0']
     def cmd_G1(self, params):
         # Move
+        self.move(([params.get(a) for a in 'XYZEF'], params['#original']))
+    def move(self, params):
+        # Params are ([X, Y, Z, E, F], original line) - see parse_move()
+        coords, origline = params
         try:
-            for axis in 'XYZ':
-                if axis in params:
-                    v = float(params[axis])
-                    pos = self.axis2pos[axis]
+            for pos in range(3):
+                v = coords[pos]
+                if v is not None:
+                    v = float(v)
                     if not self.absolutecoord:
                         # value relative to position of last move
                         self.last_position[pos] += v
                     else:
                         # value relative to base coordinate position
                         self.last_position[pos] = v + self.base_position[pos]
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
+            if coords[3] is not None:
+                v = float(coords[3]) * self.extrude_factor
                 if not self.absolutecoord or not self.absoluteextrude:
                     # value relative to position of last move
                     self.last_position[3] += v
                 else:
                     # value relative to base coordinate position
                     self.last_position[3] = v + self.base_position[3]
-            if 'F' in params:
-                speed = float(params['F']) * self.speed_factor
+            if coords[4] is not None:
+                speed = float(coords[4]) * self.speed_factor
                 if speed <= 0.:
-                    raise error("Invalid speed in '%s'" % (params['#original'],))
+                    raise error("Invalid speed in '%s'" % (origline,))
                 self.speed = speed
         except ValueError as e:
-            raise error("Unable to parse move '%s'" % (params['#original'],))
+            raise error("Unable to parse move '%s'" % (origline,))
         try:
             self.move_with_transform(self.last_position, self.speed)
         except homing.EndstopError as e:
@@ -79,10 +79,12 @@ class Heater:
             self.control.temperature_callback(read_time, temp)
         #logging.debug("temp: %.3f %f = %f", read_time, temp)
     # External commands
-    def set_temp(self, print_time, degrees):
+    def check_temp(self, degrees):
         if degrees and (degrees < self.min_temp or degrees > self.max_temp):
             raise error("Requested temperature (%.1f) out of range (%.1f:%.1f)"
                         % (degrees, self.min_temp, self.max_temp))
+    def set_temp(self, print_time, degrees):
+        self.check_temp(degrees)
         with self.lock:
             self.target_temp = degrees
     def get_temp(self, eventtime):
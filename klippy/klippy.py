@@ -328,6 +328,8 @@ def main():
     opts.add_option("-d", "--dictionary", dest="dictionary", type="string",
                     action="callback", callback=arg_dictionary,
                     help="file to read for mcu protocol dictionary")
+    opts.add_option("-c", "--capture-steps", dest="capturesteps",
+                    help="write stepper step times to files with given prefix")
     options, args = opts.parse_args()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
@@ -347,6 +349,8 @@ def main():
     if options.debugoutput:
         start_args['debugoutput'] = options.debugoutput
         start_args.update(options.dictionary)
+    if options.capturesteps:
+        start_args['capture_steps'] = options.capturesteps
     if options.logfile:
         bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel)
     else:
@@ -368,6 +372,7 @@ def main():
             bglogger.set_rollover_info('versions', versions)
         printer = Printer(input_fd, bglogger, start_args)
         res = printer.run()
+        printer.get_reactor().finalize()
         if res == 'exit':
             break
         time.sleep(1.)
@@ -11,20 +11,31 @@ class error(Exception):
 
 STEPCOMPRESS_ERROR_RET = -989898989
 
+# Serial link load thresholds for the automatic max_stepper_error scaling
+STEPPER_ERROR_BUSY = .80
+STEPPER_ERROR_IDLE = .50
+
 class MCU_stepper:
     def __init__(self, mcu, pin_params):
         self._mcu = mcu
         self._oid = self._mcu.create_oid()
+        self._name = "oid%d" % (self._oid,)
         self._step_pin = pin_params['pin']
         self._invert_step = pin_params['invert']
         self._dir_pin = self._invert_dir = None
         self._commanded_pos = self._mcu_position_offset = 0.
         self._step_dist = self._inv_step_dist = 1.
         self._min_stop_interval = 0.
+        self._max_error = None
         self._reset_cmd_id = self._get_position_cmd = None
         self._ffi_lib = self._stepqueue = None
+        self._stepper_kinematics = None
     def get_mcu(self):
         return self._mcu
+    def setup_name(self, name):
+        self._name = name
+    def get_name(self):
+        return self._name
     def setup_dir_pin(self, pin_params):
         if pin_params['chip'] is not self._mcu:
             raise pins.error("Stepper dir pin must be on same mcu as step pin")
@@ -32,12 +43,24 @@ class MCU_stepper:
         self._invert_dir = pin_params['invert']
     def setup_min_stop_interval(self, min_stop_interval):
         self._min_stop_interval = min_stop_interval
+    def setup_max_error(self, max_error):
+        self._max_error = max_error
     def setup_step_distance(self, step_dist):
         self._step_dist = step_dist
         self._inv_step_dist = 1. / step_dist
+    def setup_itersolve(self, alloc_func, *params):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self._stepper_kinematics = ffi_main.gc(
+            getattr(ffi_lib, alloc_func)(*params), ffi_lib.free)
     def build_config(self):
-        max_error = self._mcu.get_max_stepper_error()
-        min_stop_interval = max(0., self._min_stop_interval - max_error)
+        max_error = self._max_error
+        if max_error is None:
+            max_error = self._mcu.get_max_stepper_error()
+        # The stop interval check must allow for the widest error that
+        # may be selected by the automatic max_stepper_error scaling
+        max_scale = self._mcu.get_max_stepper_error_scale()
+        min_stop_interval = max(
+            0., self._min_stop_interval - max_error * max_scale)
         self._mcu.add_config_cmd(
             "config_stepper oid=%d step_pin=%s dir_pin=%s"
             " min_stop_interval=%d invert_step=%d" % (
@@ -59,7 +82,11 @@ class MCU_stepper:
             self._mcu.seconds_to_clock(max_error), step_cmd_id, dir_cmd_id,
             self._invert_dir, self._oid),
                                       self._ffi_lib.stepcompress_free)
-        self._mcu.register_stepqueue(self._stepqueue)
+        self._mcu.register_stepqueue(
+            self._stepqueue, self._name, self._mcu.seconds_to_clock(max_error))
+        if self._stepper_kinematics is not None:
+            self._ffi_lib.itersolve_set_stepcompress(
+                self._stepper_kinematics, self._stepqueue, self._step_dist)
     def get_oid(self):
         return self._oid
     def get_step_dist(self):
@@ -127,6 +154,80 @@ class MCU_stepper:
             raise error("Internal error in stepcompress")
         self._commanded_pos += count
 
+# Helper to generate the steps of a move on a group of steppers with a
+# single call into the C code
+class StepperGroup:
+    def __init__(self, steppers):
+        # steppers is a list of (mcu_stepper, axis) tuples
+        self._steppers = steppers
+        self._ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._sc_list = self._sk_list = self._cmove = None
+        self._sparams = self._ffi_main.new('double[]', 5 * len(steppers))
+    def _check_setup(self):
+        if self._sc_list is None:
+            self._sc_list = self._ffi_main.new('struct stepcompress *[]', [
+                s._stepqueue for s, axis in self._steppers])
+    def _check_itersolve_setup(self):
+        if self._sk_list is None:
+            self._sk_list = self._ffi_main.new(
+                'struct stepper_kinematics *[]', [
+                    s._stepper_kinematics for s, axis in self._steppers])
+            self._cmove = self._ffi_main.gc(
+                self._ffi_lib.move_alloc(), self._ffi_lib.free)
+    def _note_step_positions(self, stride):
+        sparams = self._sparams
+        for i, (s, axis) in enumerate(self._steppers):
+            s._commanded_pos = sparams[i * stride]
+    def step_move(self, print_time, move, start_pos, axes_d):
+        self._check_setup()
+        sparams = []
+        for s, axis in self._steppers:
+            sparams.extend((s._commanded_pos, s._inv_step_dist,
+                            start_pos[axis], axes_d[axis]))
+        self._sparams[0:len(sparams)] = sparams
+        ret = self._ffi_lib.stepcompress_push_move(
+            self._sc_list, len(self._steppers), self._sparams, print_time,
+            move.move_d, move.accel, move.start_v, move.cruise_v,
+            move.accel_r, move.cruise_r, move.decel_r,
+            move.accel_t, move.cruise_t)
+        if ret:
+            raise error("Internal error in stepcompress")
+        self._note_step_positions(4)
+    def step_delta_move(self, print_time, move, towers, accel_d, cruise_d,
+                        decel_d, movexy_r, movez_r):
+        # towers contains (height_base, startxy_d, arm_d) for each axis
+        self._check_setup()
+        sparams = []
+        for s, axis in self._steppers:
+            sparams.append(s._commanded_pos)
+            sparams.append(s._inv_step_dist)
+            sparams.extend(towers[axis])
+        self._sparams[0:len(sparams)] = sparams
+        ret = self._ffi_lib.stepcompress_push_delta_move(
+            self._sc_list, len(self._steppers), self._sparams, print_time,
+            move.accel, move.start_v, move.cruise_v, accel_d, cruise_d,
+            decel_d, move.accel_t, move.cruise_t, movexy_r, movez_r)
+        if ret:
+            raise error("Internal error in stepcompress")
+        self._note_step_positions(5)
+    def step_itersolve(self, print_time, move):
+        # Steps are found using the steppers' setup_itersolve() kinematics
+        self._check_itersolve_setup()
+        start_pos = move.start_pos
+        axes_d = move.axes_d
+        self._ffi_lib.move_fill(
+            self._cmove, print_time, move.accel_t, move.cruise_t, move.decel_t,
+            start_pos[0], start_pos[1], start_pos[2],
+            axes_d[0], axes_d[1], axes_d[2],
+            move.start_v, move.cruise_v, move.accel)
+        sparams = [s._commanded_pos for s, axis in self._steppers]
+        self._sparams[0:len(sparams)] = sparams
+        ret = self._ffi_lib.itersolve_gen_steps_move(
+            self._sk_list, len(self._steppers), self._sparams, self._cmove)
+        if ret:
+            raise error("Internal error in stepcompress")
+        self._note_step_positions(1)
+
 class MCU_endstop:
     class TimeoutError(Exception):
         pass
@@ -164,9 +265,9 @@ class MCU_endstop:
         cmd_queue = self._mcu.alloc_command_queue()
         self._home_cmd = self._mcu.lookup_command(
             "end_stop_home oid=%c clock=%u sample_ticks=%u sample_count=%c"
-            " rest_ticks=%u pin_value=%c", cq=cmd_queue)
-        self._query_cmd = self._mcu.lookup_command("end_stop_query oid=%c",
-                                                   cq=cmd_queue)
+            " rest_ticks=%u pin_value=%c", cq=cmd_queue).prepare([self._oid])
+        self._query_cmd = self._mcu.lookup_command(
+            "end_stop_query oid=%c", cq=cmd_queue).prepare([self._oid])
         self._mcu.register_msg(self._handle_end_stop_state, "end_stop_state"
                                , self._oid)
     def home_prepare(self):
@@ -178,7 +279,7 @@ class MCU_endstop:
         self._min_query_time = self._mcu.monotonic()
         self._next_query_time = self._min_query_time + self.RETRY_QUERY
         self._home_cmd.send(
-            [self._oid, clock, self._mcu.seconds_to_clock(sample_time),
+            [clock, self._mcu.seconds_to_clock(sample_time),
              sample_count, rest_ticks, 1 ^ self._invert], reqclock=clock)
         for s in self._steppers:
             s.note_homing_start(clock)
@@ -208,13 +309,13 @@ class MCU_endstop:
                 for s in self._steppers:
                     s.note_homing_end()
                 self._homing = False
-                self._home_cmd.send([self._oid, 0, 0, 0, 0, 0])
+                self._home_cmd.send([0, 0, 0, 0, 0])
                 raise self.TimeoutError("Timeout during endstop homing")
         if self._mcu.is_shutdown():
             raise error("MCU is shutdown")
         if eventtime >= self._next_query_time:
             self._next_query_time = eventtime + self.RETRY_QUERY
-            self._query_cmd.send([self._oid])
+            self._query_cmd.send()
         return True
     def query_endstop(self, print_time):
         self._homing = False
@@ -259,10 +360,11 @@ class MCU_digital_out:
                 self._mcu.seconds_to_clock(self._max_duration)))
         cmd_queue = self._mcu.alloc_command_queue()
         self._set_cmd = self._mcu.lookup_command(
-            "schedule_digital_out oid=%c clock=%u value=%c", cq=cmd_queue)
+            "schedule_digital_out oid=%c clock=%u value=%c",
+            cq=cmd_queue).prepare([self._oid])
     def set_digital(self, print_time, value):
         clock = self._mcu.print_time_to_clock(print_time)
-        self._set_cmd.send([self._oid, clock, (not not value) ^ self._invert],
+        self._set_cmd.send([clock, (not not value) ^ self._invert],
                            minclock=self._last_clock, reqclock=clock)
         self._last_clock = clock
     def set_pwm(self, print_time, value):
@@ -318,7 +420,8 @@ class MCU_pwm:
                     self._shutdown_value * self._pwm_max,
                     self._mcu.seconds_to_clock(self._max_duration)))
             self._set_cmd = self._mcu.lookup_command(
-                "schedule_pwm_out oid=%c clock=%u value=%hu", cq=cmd_queue)
+                "schedule_pwm_out oid=%c clock=%u value=%hu",
+                cq=cmd_queue).prepare([self._oid])
         else:
             if (self._start_value not in [0., 1.]
                 or self._shutdown_value not in [0., 1.]):
@@ -337,13 +440,14 @@ class MCU_pwm:
                     self._start_value >= 0.5, self._shutdown_value >= 0.5,
                     self._mcu.seconds_to_clock(self._max_duration)))
             self._set_cmd = self._mcu.lookup_command(
-                "schedule_soft_pwm_out oid=%c clock=%u value=%hu", cq=cmd_queue)
+                "schedule_soft_pwm_out oid=%c clock=%u value=%hu",
+                cq=cmd_queue).prepare([self._oid])
     def set_pwm(self, print_time, value):
         clock = self._mcu.print_time_to_clock(print_time)
         if self._invert:
             value = 1. - value
         value = int(max(0., min(1., value)) * self._pwm_max + 0.5)
-        self._set_cmd.send([self._oid, clock, value],
+        self._set_cmd.send([clock, value],
                            minclock=self._last_clock, reqclock=clock)
         self._last_clock = clock
 
@@ -412,8 +516,16 @@ class MCU:
         if not (self._serialport.startswith("/dev/rpmsg_")
                 or self._serialport.startswith("/tmp/klipper_host_")):
             baud = config.getint('baud', 250000, minval=2400)
+        engine = None
+        if config.getboolean('shared_io_thread', False):
+            engine = printer.lookup_object('serial_engine', None)
+            if engine is None:
+                engine = serialhdl.SerialEngine()
+                printer.add_object('serial_engine', engine)
         self._serial = serialhdl.SerialReader(
-            self._reactor, self._serialport, baud)
+            self._reactor, self._serialport, baud,
+            config.getboolean('reactor_dispatch', False), engine)
+        self._baud = baud
         # Restarts
         self._restart_method = 'command'
         if baud:
@@ -435,10 +547,22 @@ class MCU:
         self._custom = config.get('custom', '')
         self._mcu_freq = 0.
         # Move command queuing
-        ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._stats_buf = self._ffi_main.new('char[512]')
         self._max_stepper_error = config.getfloat(
             'max_stepper_error', 0.000025, minval=0.)
+        self._max_stepper_error_scale = config.getfloat(
+            'max_stepper_error_scale', 1., minval=1.)
+        self._stepper_error_scale = 1.
+        self._last_bytes_write = self._last_bytes_time = 0.
+        self._bytes_write_rate = 0.
+        self._step_threads = config.getint('step_threads', 1, minval=1)
+        self._fast_step_compress = config.getchoice(
+            'step_compress', {'exact': False, 'fast': True}, 'exact')
+        self._stepper_stats = config.getboolean('stepper_stats', False)
         self._stepqueues = []
+        self._stepqueue_names = []
+        self._stepqueue_errors = []
         self._steppersync = None
         # Stats
         self._stats_sumsq_base = 0.
@@ -571,8 +695,14 @@ class MCU:
             self._serial.serialqueue, self._stepqueues, len(self._stepqueues),
             move_count)
         self._ffi_lib.steppersync_set_time(self._steppersync, 0., self._mcu_freq)
+        if self._step_threads > 1:
+            self._ffi_lib.steppersync_set_threads(
+                self._steppersync, self._step_threads)
         for c in self._init_cmds:
             self._serial.send(c)
+        if self._max_stepper_error_scale > 1. and self._baud:
+            self._reactor.register_timer(
+                self._update_stepper_error, self._reactor.NOW)
     def _connect(self):
         if self.is_fileoutput():
             self._connect_file()
@@ -623,12 +753,48 @@ class MCU:
         slot = self.seconds_to_clock(oid * .01)
         t = int(self.estimated_print_time(self.monotonic()) + 1.5)
         return self.print_time_to_clock(t) + slot
-    def register_stepqueue(self, stepqueue):
+    def register_stepqueue(self, stepqueue, name, max_error):
+        capture = self._printer.get_start_args().get('capture_steps')
+        if capture is not None:
+            fname = "%s.%s.%d" % (capture, self._name, len(self._stepqueues))
+            self._ffi_lib.stepcompress_set_capture(stepqueue, fname)
+        if self._fast_step_compress:
+            self._ffi_lib.stepcompress_set_fast_mode(stepqueue, 1)
         self._stepqueues.append(stepqueue)
+        self._stepqueue_names.append(name)
+        self._stepqueue_errors.append(max_error)
     def seconds_to_clock(self, time):
         return int(time * self._mcu_freq)
     def get_max_stepper_error(self):
         return self._max_stepper_error
+    def get_max_stepper_error_scale(self):
+        return self._max_stepper_error_scale
+    def _update_stepper_error(self, eventtime):
+        # Widen the stepper error bound while the serial link is busy
+        if self._steppersync is None:
+            return self._reactor.NEVER
+        bytes_write = self._serial.get_stat_info().bytes_write
+        if self._last_bytes_time:
+            self._bytes_write_rate = (
+                ((bytes_write - self._last_bytes_write) & 0xffffffff)
+                / (eventtime - self._last_bytes_time))
+        self._last_bytes_write = bytes_write
+        self._last_bytes_time = eventtime
+        load = self._bytes_write_rate / (self._baud / 10.)
+        scale = self._stepper_error_scale
+        if load > STEPPER_ERROR_BUSY:
+            scale = min(scale * 2., self._max_stepper_error_scale)
+        elif load < STEPPER_ERROR_IDLE:
+            scale = max(scale * .5, 1.)
+        if scale != self._stepper_error_scale:
+            logging.info("MCU '%s' stepper error scale %.2f (%.0f bytes/s)",
+                         self._name, scale, self._bytes_write_rate)
+            self._stepper_error_scale = scale
+            for stepqueue, max_error in zip(self._stepqueues,
+                                            self._stepqueue_errors):
+                self._ffi_lib.stepcompress_set_max_error(
+                    stepqueue, int(max_error * scale))
+        return eventtime + 1.
     # Wrapper functions
     def register_msg(self, cb, msg, oid=None):
         self._serial.register_callback(cb, msg, oid)
@@ -723,7 +889,12 @@ class MCU:
         if self._steppersync is None:
             return
         offset, freq = self._clocksync.calibrate_clock(print_time, eventtime)
-        self._ffi_lib.steppersync_set_time(self._steppersync, offset, freq)
+        ret = self._ffi_lib.steppersync_set_time(self._steppersync,
+                                                 offset, freq)
+        if ret:
+            self._printer.invoke_shutdown(
+                "Internal error in MCU '%s' stepcompress" % (self._name,))
+            return
         if (self._clocksync.is_active(eventtime) or self.is_fileoutput()
             or self._is_timeout):
             return
@@ -736,8 +907,26 @@ class MCU:
         msg = "%s: mcu_awake=%.03f mcu_task_avg=%.06f mcu_task_stddev=%.06f" % (
             self._name, self._mcu_tick_awake, self._mcu_tick_avg,
             self._mcu_tick_stddev)
-        return False, ' '.join([msg, self._serial.stats(eventtime),
-                                self._clocksync.stats(eventtime)])
+        stats = [msg, self._serial.stats(eventtime),
+                 self._clocksync.stats(eventtime)]
+        if self._steppersync is not None:
+            self._ffi_lib.steppersync_get_stats(
+                self._steppersync, self._stats_buf, len(self._stats_buf))
+            stats.append(self._ffi_main.string(self._stats_buf))
+        if self._max_stepper_error_scale > 1.:
+            stats.append("stepper_error_scale=%.2f bytes_write_rate=%.0f" % (
+                self._stepper_error_scale, self._bytes_write_rate))
+        if self._stepper_stats:
+            stats.extend(self.get_stepper_stats())
+        return False, ' '.join(stats)
+    def get_stepper_stats(self):
+        out = []
+        for name, stepqueue in zip(self._stepqueue_names, self._stepqueues):
+            self._ffi_lib.stepcompress_get_stats(
+                stepqueue, self._stats_buf, len(self._stats_buf))
+            out.append("%s: %s" % (
+                name, self._ffi_main.string(self._stats_buf)))
+        return out
     def printer_state(self, state):
         if state == 'connect':
             self._connect()
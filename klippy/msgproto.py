@@ -3,7 +3,11 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib, logging
+import json, zlib, logging, threading
+try:
+    import chelper
+except ImportError:
+    chelper = None
 
 DefaultMessages = {
     0: "identify_response offset=%u data=%.*s",
@@ -36,8 +40,28 @@ def crc16_ccitt(buf):
     crc = chr(crc >> 8) + chr(crc & 0xff)
     return crc
 
+# Load the optional C message encoding and parsing code (msgblock.c)
+def get_c_codec():
+    if chelper is None:
+        return None, None
+    try:
+        return chelper.get_ffi()
+    except OSError as e:
+        logging.info("Unable to load C message codec: %s", str(e))
+        return None, None
+
+MB_PT_UINT32, MB_PT_INT32, MB_PT_BUFFER = 0, 1, 2
+
+# Per-thread storage for the C message codec
+c_codec_buffers = threading.local()
+
+# The C parser has a higher fixed cost than the python parser, so it
+# is only used for C buffers with at least this many parameter bytes
+C_PARSE_MIN_LENGTH = 10
+
 class PT_uint32:
     is_int = 1
+    c_type = MB_PT_UINT32
     max_length = 5
     signed = 0
     def encode(self, out, v):
@@ -62,6 +86,7 @@ class PT_uint32:
 
 class PT_int32(PT_uint32):
     signed = 1
+    c_type = MB_PT_INT32
 class PT_uint16(PT_uint32):
     max_length = 3
 class PT_int16(PT_int32):
@@ -72,6 +97,7 @@ class PT_byte(PT_uint32):
 
 class PT_string:
     is_int = 0
+    c_type = MB_PT_BUFFER
     max_length = 64
     def encode(self, out, v):
         out.append(len(v))
@@ -127,6 +153,58 @@ class MessageFormat:
             v, pos = t.parse(s, pos)
             out[name] = v
         return out, pos
+    def setup_c_codec(self, ffi_main, ffi_lib):
+        # Replace the encode() and parse() methods with C versions
+        self._ffi_main = ffi_main
+        self._ffi_lib = ffi_lib
+        self._c_types = ffi_main.new(
+            'uint8_t[]', [t.c_type for t in self.param_types])
+        self._c_count = len(self.param_types)
+        self._c_names = [name for name, t in self.param_names]
+        self._c_buffers = [name for name, t in self.param_names
+                           if not t.is_int]
+        self._py_encode = self.encode
+        self._py_parse = self.parse
+        if min([t.is_int for t in self.param_types] + [1]):
+            self.encode = self._c_encode
+        max_length = sum([t.max_length for t in self.param_types])
+        if max_length >= C_PARSE_MIN_LENGTH:
+            self.parse = self._c_parse
+    def _c_encode(self, params):
+        if len(params) < self._c_count:
+            return self._py_encode(params)
+        try:
+            buf = c_codec_buffers.encode
+        except AttributeError:
+            buf = c_codec_buffers.encode = self._ffi_main.new(
+                'uint8_t[]', MESSAGE_PAYLOAD_MAX)
+        try:
+            l = self._ffi_lib.msgblock_encode(
+                self.msgid, self._c_types, self._c_count, params,
+                buf, MESSAGE_PAYLOAD_MAX)
+        except (OverflowError, TypeError):
+            l = -1
+        if l < 0:
+            return self._py_encode(params)
+        return self._ffi_main.unpack(buf, l)
+    def _c_parse(self, s, pos):
+        ffi_main = self._ffi_main
+        if not isinstance(s, ffi_main.CData):
+            return self._py_parse(s, pos)
+        try:
+            vals = c_codec_buffers.parse
+        except AttributeError:
+            vals = c_codec_buffers.parse = ffi_main.new(
+                'int64_t[]', MESSAGE_PAYLOAD_MAX)
+        newpos = self._ffi_lib.msgblock_parse(
+            self._c_types, self._c_count, s, pos + 1, len(s), vals)
+        if newpos < 0:
+            return self._py_parse(s, pos)
+        out = dict(zip(self._c_names, ffi_main.unpack(vals, self._c_count)))
+        for name in self._c_buffers:
+            v = out[name]
+            out[name] = str(bytearray(s[v:v+s[v-1]]))
+        return out, newpos
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
@@ -181,7 +259,10 @@ class UnknownFormat:
 
 class MessageParser:
     error = error
-    def __init__(self):
+    def __init__(self, use_c_codec=True):
+        self.ffi_main = self.ffi_lib = None
+        if use_c_codec:
+            self.ffi_main, self.ffi_lib = get_c_codec()
         self.unknown = UnknownFormat()
         self.command_ids = []
         self.messages_by_id = {}
@@ -206,11 +287,17 @@ class MessageParser:
         if s[msglen-MESSAGE_TRAILER_SYNC] != MESSAGE_SYNC:
             return -1
         msgcrc = s[msglen-MESSAGE_TRAILER_CRC:msglen-MESSAGE_TRAILER_CRC+2]
-        crc = crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
+        crc = self.crc16_ccitt(s[:msglen-MESSAGE_TRAILER_SIZE])
         if crc != msgcrc:
             #logging.debug("got crc %s vs %s", repr(crc), repr(msgcrc))
             return -1
         return msglen
+    def crc16_ccitt(self, buf):
+        if self.ffi_lib is None:
+            return crc16_ccitt(buf)
+        crc = self.ffi_lib.msgblock_crc16_ccitt(self.ffi_main.cast(
+            'uint8_t *', self.ffi_main.from_buffer(buf)), len(buf))
+        return chr(crc >> 8) + chr(crc & 0xff)
     def dump(self, s):
         msgseq = s[MESSAGE_POS_SEQ]
         out = ["seq: %02x" % (msgseq,)]
@@ -247,7 +334,7 @@ class MessageParser:
         msglen = MESSAGE_MIN + len(cmd)
         seq = (seq & MESSAGE_SEQ_MASK) | MESSAGE_DEST
         out = [chr(msglen), chr(seq), cmd]
-        out.append(crc16_ccitt(''.join(out)))
+        out.append(self.crc16_ccitt(''.join(out)))
         out.append(MESSAGE_SYNC)
         return ''.join(out)
     def _parse_buffer(self, value):
@@ -301,6 +388,8 @@ class MessageParser:
                 self.messages_by_id[msgid] = OutputFormat(msgid, msgformat)
                 continue
             msg = MessageFormat(msgid, msgformat)
+            if self.ffi_lib is not None:
+                msg.setup_c_codec(self.ffi_main, self.ffi_lib)
             self.messages_by_id[msgid] = msg
             self.messages_by_name[msg.name] = msg
     def process_identify(self, data, decompress=True):
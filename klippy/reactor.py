@@ -3,14 +3,55 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import select, math, time
+import os, select, math, time, heapq, errno, Queue
 import greenlet
-import chelper
+import chelper, util
+
+_NEVER = 9999999999999999.
 
 class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.heap_entry = None
+        self.registered = True
+        self.profile_stats = None
+
+class ReactorCompletion:
+    class sentinel: pass
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.result = self.sentinel
+        self.waiting = []
+    def test(self):
+        return self.result is not self.sentinel
+    def complete(self, result):
+        self.result = result
+        for wait in self.waiting:
+            timer = getattr(wait, 'timer', None)
+            if timer is not None:
+                self.reactor.update_timer(timer, self.reactor.NOW)
+    def wait(self, waketime=_NEVER, waketime_result=None):
+        if self.result is self.sentinel:
+            wait = greenlet.getcurrent()
+            self.waiting.append(wait)
+            self.reactor.pause(waketime)
+            self.waiting.remove(wait)
+            if self.result is self.sentinel:
+                return waketime_result
+        return self.result
+
+class ReactorCallback:
+    def __init__(self, reactor, callback, waketime):
+        self.reactor = reactor
+        self.timer = reactor.register_timer(self.invoke, waketime)
+        self.callback = callback
+        self.completion = ReactorCompletion(reactor)
+    def invoke(self, eventtime):
+        self.reactor.unregister_timer(self.timer)
+        res = self.callback(eventtime)
+        self.completion.complete(res)
+        return self.reactor.NEVER
 
 class ReactorFileHandler:
     def __init__(self, fd, callback):
@@ -24,52 +65,282 @@ class ReactorGreenlet(greenlet.greenlet):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
 
+# Histogram of durations (in seconds) with log2 spaced buckets
+class ReactorHistogram:
+    BASE = .000010
+    INV_BASE = 1. / BASE
+    BUCKETS = 24
+    def __init__(self):
+        self.reset()
+    def reset(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = self.max = 0.
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        # Bucket i holds values less than BASE * 2**i
+        bucket = math.frexp(value * self.INV_BASE)[1]
+        if bucket >= self.BUCKETS:
+            bucket = self.BUCKETS - 1
+        elif bucket < 0:
+            bucket = 0
+        self.counts[bucket] += 1
+    def percentile(self, fraction):
+        target = fraction * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= target:
+                return min(self.max, self.BASE * 2**i)
+        return self.max
+    def summary(self):
+        if not self.count:
+            return "count=0"
+        return "count=%d avg=%.6f p50=%.6f p99=%.6f max=%.6f" % (
+            self.count, self.total / self.count, self.percentile(.50),
+            self.percentile(.99), self.max)
+
+# Record timer lateness and the wall and cpu time of reactor callbacks
+class ReactorProfiler:
+    def __init__(self, reactor):
+        self.monotonic = reactor.monotonic
+        self.cputime = chelper.get_ffi()[1].get_thread_cputime
+        self.lateness = ReactorHistogram()
+        self.callbacks = {}
+        self.fd_stats = {}
+        self.active = None
+    def reset(self):
+        self.lateness.reset()
+        for stats in self.callbacks.values():
+            for hist in stats:
+                if hist is not None:
+                    hist.reset()
+    def _lookup(self, callback):
+        name = getattr(callback, '__name__', None)
+        if name is None:
+            name = type(callback).__name__
+        obj = getattr(callback, '__self__', None)
+        if obj is not None:
+            name = "%s.%s" % (obj.__class__.__name__, name)
+        else:
+            name = "%s.%s" % (getattr(callback, '__module__', None), name)
+        stats = self.callbacks.get(name)
+        if stats is None:
+            if isinstance(obj, greenlet.greenlet):
+                # Resuming a paused greenlet (time is charged to the
+                # callback that paused)
+                stats = (ReactorHistogram(), None, None)
+            else:
+                stats = (ReactorHistogram(), ReactorHistogram(),
+                         ReactorHistogram())
+            self.callbacks[name] = stats
+        return stats
+    def _run(self, callback, eventtime, stats):
+        # Frame is [stats, wall start, cpu start, wall total, cpu total]
+        frame = self.active = [stats, self.monotonic(), self.cputime(), 0., 0.]
+        res = callback(eventtime)
+        stats[1].add(frame[3] + self.monotonic() - frame[1])
+        stats[2].add(frame[4] + self.cputime() - frame[2])
+        self.active = None
+        return res
+    def run_timer(self, t, waketime, eventtime):
+        stats = t.profile_stats
+        if stats is None:
+            stats = t.profile_stats = self._lookup(t.callback)
+        if waketime:
+            late = eventtime - waketime
+            self.lateness.add(late)
+            stats[0].add(late)
+        if stats[1] is None:
+            return t.callback(eventtime)
+        return self._run(t.callback, eventtime, stats)
+    def run_fd(self, fd, callback, eventtime):
+        callback_stats = self.fd_stats.get(fd)
+        if callback_stats is None or callback_stats[0] is not callback:
+            callback_stats = self.fd_stats[fd] = (
+                callback, self._lookup(callback))
+        return self._run(callback, eventtime, callback_stats[1])
+    def switch(self, g, *args):
+        # Don't charge time spent while paused to the active callback
+        frame = self.active
+        if frame is not None:
+            frame[3] += self.monotonic() - frame[1]
+            frame[4] += self.cputime() - frame[2]
+            self.active = None
+        res = g.switch(*args)
+        if frame is not None:
+            frame[1] = self.monotonic()
+            frame[2] = self.cputime()
+        self.active = frame
+        return res
+    def dump(self):
+        out = ["Reactor timer lateness: %s" % (self.lateness.summary(),)]
+        callbacks = sorted(self.callbacks.items(),
+                           key=(lambda i: i[1][1] and i[1][1].total),
+                           reverse=True)
+        for name, (late, wall, cpu) in callbacks:
+            msg = ""
+            if wall is not None and wall.count:
+                msg += " wall %s cpu %s" % (wall.summary(), cpu.summary())
+            if late.count:
+                msg += " late %s" % (late.summary(),)
+            if msg:
+                out.append("Reactor callback %s:%s" % (name, msg))
+        return "\n".join(out)
+
 class SelectReactor:
     NOW = 0.
-    NEVER = 9999999999999999.
+    NEVER = _NEVER
     def __init__(self):
         self._fds = []
-        self._timers = []
-        self._next_timer = self.NEVER
+        # Callbacks scheduled from other threads
+        self._pipe_fds = None
+        self._async_queue = Queue.Queue()
+        # Timers are kept in a heap of [waketime, seq, timer] entries.
+        # Entries are invalidated (timer set to None) instead of removed
+        # and are discarded when they reach the top of the heap.
+        self._timer_heap = [[self.NEVER, 0, None]]
+        self._timer_seq = 0
+        self._stale_timers = 0
+        self._deferred_timers = []
+        self._profiler = None
         self._process = False
         self._g_dispatch = None
         self._greenlets = []
         self.monotonic = chelper.get_ffi()[1].get_monotonic
     # Timers
-    def _note_time(self, t):
-        nexttime = t.waketime
-        if nexttime < self._next_timer:
-            self._next_timer = nexttime
+    def _invalidate_timer(self, t):
+        entry = t.heap_entry
+        if entry is not None:
+            entry[2] = t.heap_entry = None
+            self._stale_timers += 1
+            heap = self._timer_heap
+            if self._stale_timers > 64 and 2*self._stale_timers > len(heap):
+                # Stale entries in _deferred_timers are not in the heap
+                # and remain counted until they are popped
+                count = len(heap)
+                heap[:] = [e for e in heap if e[2] is not None or not e[1]]
+                heapq.heapify(heap)
+                self._stale_timers -= count - len(heap)
     def update_timer(self, t, nexttime):
         t.waketime = nexttime
-        self._note_time(t)
+        entry = t.heap_entry
+        if entry is not None:
+            if entry[0] == nexttime:
+                return
+            self._invalidate_timer(t)
+        if nexttime >= self.NEVER or not t.registered:
+            return
+        self._timer_seq += 1
+        t.heap_entry = entry = [nexttime, self._timer_seq, t]
+        heapq.heappush(self._timer_heap, entry)
     def register_timer(self, callback, waketime = NEVER):
         handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(handler)
-        self._timers = timers
-        self._note_time(handler)
+        self.update_timer(handler, waketime)
         return handler
     def unregister_timer(self, handler):
-        timers = list(self._timers)
-        timers.pop(timers.index(handler))
-        self._timers = timers
+        handler.registered = False
+        self._invalidate_timer(handler)
+    def _restore_deferred_timers(self):
+        heap = self._timer_heap
+        deferred = self._deferred_timers
+        for entry in deferred:
+            heapq.heappush(heap, entry)
+        del deferred[:]
     def _check_timers(self, eventtime):
-        if eventtime < self._next_timer:
-            return min(1., max(.001, self._next_timer - eventtime))
-        self._next_timer = self.NEVER
+        heap = self._timer_heap
+        if self._deferred_timers:
+            # A timer callback paused during an earlier call
+            self._restore_deferred_timers()
+        if eventtime < heap[0][0]:
+            return min(1., max(.001, heap[0][0] - eventtime))
+        # Run each timer at most once per call (a timer rescheduled
+        # during this call is run on the next call)
+        seq_limit = self._timer_seq
+        deferred = self._deferred_timers
+        profiler = self._profiler
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            if eventtime >= t.waketime:
-                t.waketime = self.NEVER
-                t.waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._note_time(t)
-        if eventtime >= self._next_timer:
+        while eventtime >= heap[0][0]:
+            entry = heapq.heappop(heap)
+            t = entry[2]
+            if t is None:
+                self._stale_timers -= 1
+                continue
+            if entry[1] > seq_limit:
+                deferred.append(entry)
+                continue
+            t.heap_entry = None
+            t.waketime = self.NEVER
+            if profiler is None:
+                waketime = t.callback(eventtime)
+            else:
+                waketime = profiler.run_timer(t, entry[0], eventtime)
+            if (waketime <= eventtime and t.heap_entry is None
+                and t.registered):
+                # Timer is already due again - run it on the next call
+                t.waketime = entry[0] = waketime
+                self._timer_seq += 1
+                entry[1] = self._timer_seq
+                t.heap_entry = entry
+                deferred.append(entry)
+            else:
+                self.update_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._restore_deferred_timers()
+                self._end_greenlet(g_dispatch)
+                return 0.
+        if deferred:
+            self._restore_deferred_timers()
             return 0.
-        return min(1., max(.001, self._next_timer - self.monotonic()))
+        return min(1., max(.001, heap[0][0] - self.monotonic()))
+    # Callbacks and completions
+    def completion(self):
+        return ReactorCompletion(self)
+    def register_callback(self, callback, waketime=NOW):
+        rcb = ReactorCallback(self, callback, waketime)
+        return rcb.completion
+    def register_async_callback(self, callback, waketime=NOW):
+        # Thread safe - may be called from any thread
+        self._async_queue.put_nowait(
+            (ReactorCallback, (self, callback, waketime)))
+        if self._pipe_fds is None:
+            # Queued callbacks are run when the reactor is started
+            return
+        try:
+            os.write(self._pipe_fds[1], '.')
+        except os.error:
+            pass
+    def _got_pipe_signal(self, eventtime):
+        try:
+            os.read(self._pipe_fds[0], 4096)
+        except os.error:
+            pass
+        while 1:
+            try:
+                func, args = self._async_queue.get_nowait()
+            except Queue.Empty:
+                break
+            func(*args)
+    def _setup_async_callbacks(self):
+        if self._pipe_fds is not None:
+            return
+        self._pipe_fds = os.pipe()
+        util.set_nonblock(self._pipe_fds[0])
+        util.set_nonblock(self._pipe_fds[1])
+        self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
+        # Run any callbacks queued before the reactor was started
+        self._got_pipe_signal(self.NOW)
+    def wait_fd(self, fd, waketime=NEVER):
+        # Pause until the fd is readable - returns False on timeout
+        completion = ReactorCompletion(self)
+        handler = self.register_fd(fd, completion.complete)
+        try:
+            return completion.wait(waketime, False) is not False
+        finally:
+            self.unregister_fd(handler)
     # Greenlets
     def _sys_pause(self, waketime):
         # Pause using system sleep for when reactor not running
@@ -82,6 +353,8 @@ class SelectReactor:
         if g is not self._g_dispatch:
             if self._g_dispatch is None:
                 return self._sys_pause(waketime)
+            if self._profiler is not None:
+                return self._profiler.switch(self._g_dispatch, waketime)
             return self._g_dispatch.switch(waketime)
         if self._greenlets:
             g_next = self._greenlets.pop()
@@ -89,6 +362,8 @@ class SelectReactor:
             g_next = ReactorGreenlet(run=self._dispatch_loop)
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
+        if self._profiler is not None:
+            return self._profiler.switch(g_next)
         return g_next.switch()
     def _end_greenlet(self, g_old):
         self._greenlets.append(g_old)
@@ -112,18 +387,34 @@ class SelectReactor:
             res = select.select(self._fds, [], [], timeout)
             eventtime = self.monotonic()
             for fd in res[0]:
-                fd.callback(eventtime)
+                if self._profiler is None:
+                    fd.callback(eventtime)
+                else:
+                    self._profiler.run_fd(fd.fd, fd.callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
         self._g_dispatch = None
     def run(self):
+        self._setup_async_callbacks()
         self._process = True
         g_next = ReactorGreenlet(run=self._dispatch_loop)
         g_next.switch()
     def end(self):
         self._process = False
+    def finalize(self):
+        if self._pipe_fds is not None:
+            os.close(self._pipe_fds[0])
+            os.close(self._pipe_fds[1])
+            self._pipe_fds = None
+    # Profiling
+    def enable_profiling(self):
+        if self._profiler is None:
+            self._profiler = ReactorProfiler(self)
+        return self._profiler
+    def get_profiler(self):
+        return self._profiler
 
 class PollReactor(SelectReactor):
     def __init__(self):
@@ -152,7 +443,10 @@ class PollReactor(SelectReactor):
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
+                if self._profiler is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._profiler.run_fd(fd, self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -164,16 +458,48 @@ class EPollReactor(SelectReactor):
         SelectReactor.__init__(self)
         self._epoll = select.epoll()
         self._fds = {}
+        # Wake up for timers using a timerfd (for sub-millisecond
+        # precision) if it is available
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self._set_timerfd = ffi_lib.set_timerfd
+        self._timerfd = ffi_lib.create_timerfd()
+        self._timerfd_waketime = None
+        # Files that epoll can not wait on (such as regular files)
+        self._ready_fds = []
+        if self._timerfd >= 0:
+            self._fds[self._timerfd] = self._timerfd_event
+            self._epoll.register(self._timerfd, select.EPOLLIN)
+    # Timers
+    def _timerfd_event(self, eventtime):
+        # The timerfd is cleared when it is next armed
+        self._timerfd_waketime = None
+    def _arm_timerfd(self):
+        waketime = self._timer_heap[0][0]
+        if waketime != self._timerfd_waketime:
+            self._timerfd_waketime = waketime
+            if waketime >= self.NEVER:
+                waketime = 0.
+            self._set_timerfd(self._timerfd, waketime)
     # File descriptors
     def register_fd(self, fd, callback):
         handler = ReactorFileHandler(fd, callback)
         fds = self._fds.copy()
         fds[fd] = callback
         self._fds = fds
-        self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        try:
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        except IOError as e:
+            if e.errno != errno.EPERM:
+                raise
+            # Regular files are always readable (as reported by poll)
+            self._ready_fds = self._ready_fds + [fd]
         return handler
     def unregister_fd(self, handler):
-        self._epoll.unregister(handler.fd)
+        if handler.fd in self._ready_fds:
+            self._ready_fds = [
+                fd for fd in self._ready_fds if fd != handler.fd]
+        else:
+            self._epoll.unregister(handler.fd)
         fds = self._fds.copy()
         del fds[handler.fd]
         self._fds = fds
@@ -183,19 +509,46 @@ class EPollReactor(SelectReactor):
         eventtime = self.monotonic()
         while self._process:
             timeout = self._check_timers(eventtime)
+            if not self._process:
+                # A timer callback requested exit (don't block in epoll)
+                break
+            ready_fds = self._ready_fds
+            if ready_fds:
+                timeout = 0.
+            elif timeout and self._timerfd >= 0:
+                # Sleep until the timerfd (or an fd) is ready.  Still wake
+                # at least once a second (as the other reactors do) so that
+                # an end() from another thread is noticed.
+                self._arm_timerfd()
+                timeout = 1.
             res = self._epoll.poll(timeout)
+            if ready_fds:
+                res.extend([(fd, select.EPOLLIN) for fd in ready_fds])
             eventtime = self.monotonic()
             for fd, event in res:
-                self._fds[fd](eventtime)
+                if self._profiler is None:
+                    self._fds[fd](eventtime)
+                else:
+                    self._profiler.run_fd(fd, self._fds[fd], eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
         self._g_dispatch = None
+    def finalize(self):
+        SelectReactor.finalize(self)
+        self._epoll.close()
+        if self._timerfd >= 0:
+            os.close(self._timerfd)
+            self._timerfd = -1
 
-# Use the poll based reactor if it is available
+# Use the epoll based reactor on Linux, otherwise poll (or select)
 try:
-    select.poll
-    Reactor = PollReactor
+    select.epoll
+    Reactor = EPollReactor
 except:
-    Reactor = SelectReactor
+    try:
+        select.poll
+        Reactor = PollReactor
+    except:
+        Reactor = SelectReactor
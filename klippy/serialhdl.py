@@ -3,7 +3,7 @@
 # Copyright (C) 2016,2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading
+import logging, threading, os, math
 import serial
 
 import msgproto, chelper, util
@@ -11,12 +11,18 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+RTT_BASE = 0.000100 # See SQ_RTT_BASE in serialqueue.h
+
 class SerialReader:
     BITS_PER_BYTE = 10.
-    def __init__(self, reactor, serialport, baud):
+    PULL_BATCH = 32
+    def __init__(self, reactor, serialport, baud, reactor_dispatch=False,
+                 engine=None):
         self.reactor = reactor
         self.serialport = serialport
         self.baud = baud
+        self.reactor_dispatch = reactor_dispatch
+        self.engine = engine
         # Serial port
         self.ser = None
         self.msgparser = msgproto.MessageParser()
@@ -25,32 +31,79 @@ class SerialReader:
         self.serialqueue = None
         self.default_cmd_queue = self.alloc_command_queue()
         self.stats_buf = self.ffi_main.new('char[4096]')
+        self.stats_info = self.ffi_main.new('struct serialqueue_stats *')
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
+        # Reactor dispatch
+        self.notify_fds = self.notify_handle = None
+        self.pull_responses = None
         # Message handlers
         handlers = {
             '#unknown': self.handle_unknown, '#output': self.handle_output,
             'shutdown': self.handle_output, 'is_shutdown': self.handle_output
         }
         self.handlers = { (k, None): v for k, v in handlers.items() }
-    def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
-        while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
-            if count <= 0:
-                break
-            params = self.msgparser.parse(response.msg[0:count])
+    def _process_responses(self, responses, count):
+        msgs = []
+        for i in range(count):
+            response = responses[i]
+            params = self.msgparser.parse(response.msg[0:response.len])
             params['#sent_time'] = response.sent_time
             params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            with self.lock:
-                hdl = self.handlers.get(hdl, self.handle_default)
+            msgs.append(params)
+        with self.lock:
+            hdls = [self.handlers.get((p['#name'], p.get('oid')),
+                                      self.handle_default)
+                    for p in msgs]
+        for params, hdl in zip(msgs, hdls):
             try:
                 hdl(params)
             except:
                 logging.exception("Exception in serial callback")
+    def _bg_thread(self):
+        responses = self.ffi_main.new('struct pull_queue_message[%d]' % (
+            self.PULL_BATCH,))
+        while 1:
+            count = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, self.PULL_BATCH)
+            if count <= 0:
+                break
+            self._process_responses(responses, count)
+    def _pull_pending(self):
+        while 1:
+            count = self.ffi_lib.serialqueue_pull_pending(
+                self.serialqueue, self.pull_responses, self.PULL_BATCH)
+            if count > 0:
+                self._process_responses(self.pull_responses, count)
+            if count < self.PULL_BATCH:
+                break
+    def _notify_event(self, eventtime):
+        try:
+            os.read(self.notify_fds[0], 4096)
+        except os.error:
+            pass
+        self._pull_pending()
+    def _start_dispatch(self):
+        if not self.reactor_dispatch and self.engine is None:
+            # Pull and dispatch responses from a background thread
+            self.background_thread = threading.Thread(target=self._bg_thread)
+            self.background_thread.start()
+            return
+        self.pull_responses = self.ffi_main.new(
+            'struct pull_queue_message[%d]' % (self.PULL_BATCH,))
+        if not self.reactor_dispatch:
+            # Dispatch responses from the shared engine thread
+            self.engine.add_reader(self)
+            return
+        # Dispatch responses from the reactor when the notify pipe is ready
+        self.notify_fds = os.pipe()
+        for fd in self.notify_fds:
+            util.set_nonblock(fd)
+        self.notify_handle = self.reactor.register_fd(
+            self.notify_fds[0], self._notify_event)
+        self.ffi_lib.serialqueue_set_receive_notify(
+            self.serialqueue, self.notify_fds[1])
     def connect(self):
         # Initial connection
         logging.info("Starting serial connect")
@@ -68,10 +121,13 @@ class SerialReader:
                 continue
             if self.baud:
                 stk500v2_leave(self.ser, self.reactor)
-            self.serialqueue = self.ffi_lib.serialqueue_alloc(
-                self.ser.fileno(), 0)
-            self.background_thread = threading.Thread(target=self._bg_thread)
-            self.background_thread.start()
+            if self.engine is not None:
+                self.serialqueue = self.engine.alloc_serialqueue(
+                    self.ser.fileno(), 0)
+            else:
+                self.serialqueue = self.ffi_lib.serialqueue_alloc(
+                    self.ser.fileno(), 0)
+            self._start_dispatch()
             # Obtain and load the data dictionary from the firmware
             sbs = SerialBootStrap(self)
             identify_data = sbs.get_identify_data(starttime + 5.)
@@ -99,11 +155,18 @@ class SerialReader:
             self.serialqueue, freq, last_time, last_clock)
     def disconnect(self):
         if self.serialqueue is not None:
+            if self.engine is not None:
+                self.engine.remove_reader(self)
             self.ffi_lib.serialqueue_exit(self.serialqueue)
             if self.background_thread is not None:
                 self.background_thread.join()
             self.ffi_lib.serialqueue_free(self.serialqueue)
             self.background_thread = self.serialqueue = None
+        if self.notify_fds is not None:
+            self.reactor.unregister_fd(self.notify_handle)
+            for fd in self.notify_fds:
+                os.close(fd)
+            self.notify_fds = self.notify_handle = None
         if self.ser is not None:
             self.ser.close()
             self.ser = None
@@ -112,7 +175,33 @@ class SerialReader:
             return ""
         self.ffi_lib.serialqueue_get_stats(
             self.serialqueue, self.stats_buf, len(self.stats_buf))
-        return self.ffi_main.string(self.stats_buf)
+        msg = self.ffi_main.string(self.stats_buf)
+        info = self.get_stat_info()
+        if info.rtt_count:
+            msg += " rtt_p50=%.6f rtt_p90=%.6f rtt_p99=%.6f" % tuple(
+                [self.get_rtt_percentile(info, p) for p in (.50, .90, .99)])
+        return msg
+    def get_stat_info(self):
+        # Note the returned struct is reused on the next call
+        if self.serialqueue is None:
+            return None
+        self.ffi_lib.serialqueue_fill_stats(self.serialqueue, self.stats_info)
+        return self.stats_info
+    def get_rtt_percentile(self, info, fraction):
+        # Return the upper bound of the histogram bucket for a percentile
+        hist = self.ffi_main.unpack(info.rtt_hist, len(info.rtt_hist))
+        target = fraction * sum(hist)
+        total = 0
+        for i, count in enumerate(hist[:-1]):
+            total += count
+            if total >= target:
+                return RTT_BASE * math.sqrt(2.)**i
+        return float('inf')
+    def get_command_queue_stats(self, cmd_queue):
+        info = self.ffi_main.new('struct commandqueue_stats *')
+        self.ffi_lib.serialqueue_fill_commandqueue_stats(
+            self.serialqueue, cmd_queue, info)
+        return info
     # Serial response callbacks
     def register_callback(self, callback, name, oid=None):
         with self.lock:
@@ -170,6 +259,56 @@ class SerialReader:
     def __del__(self):
         self.disconnect()
 
+# Run the serialqueues of several serial ports from a single C thread
+# and dispatch their responses from a single python thread
+class SerialEngine:
+    def __init__(self):
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.engine = self.ffi_main.gc(self.ffi_lib.serialengine_alloc(),
+                                       self.ffi_lib.serialengine_free)
+        self.lock = threading.Lock()
+        self.readers = []
+        self.notify_fds = None
+        self.background_thread = None
+    def alloc_serialqueue(self, serial_fd, write_only):
+        return self.ffi_lib.serialqueue_alloc_engine(
+            serial_fd, write_only, self.engine)
+    def _bg_thread(self):
+        while 1:
+            try:
+                os.read(self.notify_fds[0], 4096)
+            except os.error:
+                continue
+            with self.lock:
+                if not self.readers:
+                    break
+                for reader in self.readers:
+                    reader._pull_pending()
+    def add_reader(self, reader):
+        if self.notify_fds is None:
+            self.notify_fds = os.pipe()
+            util.set_nonblock(self.notify_fds[1])
+            self.background_thread = threading.Thread(target=self._bg_thread)
+            self.background_thread.start()
+        with self.lock:
+            self.readers.append(reader)
+            self.ffi_lib.serialqueue_set_receive_notify(
+                reader.serialqueue, self.notify_fds[1])
+    def remove_reader(self, reader):
+        with self.lock:
+            if reader not in self.readers:
+                return
+            self.ffi_lib.serialqueue_set_receive_notify(reader.serialqueue, -1)
+            self.readers.remove(reader)
+            if self.readers:
+                return
+        # Stop the dispatch thread when no readers remain
+        os.write(self.notify_fds[1], '.')
+        self.background_thread.join()
+        for fd in self.notify_fds:
+            os.close(fd)
+        self.notify_fds = self.background_thread = None
+
 # Wrapper around command sending
 class SerialCommand:
     def __init__(self, serial, cmd_queue, cmd):
@@ -183,6 +322,31 @@ class SerialCommand:
         cmd = self.cmd.encode(data)
         src = SerialRetryCommand(self.serial, cmd, response, response_oid)
         return src.get_response()
+    def prepare(self, fixed=()):
+        return SerialPreparedCommand(
+            self.serial, self.cmd_queue, self.cmd, fixed)
+
+# Command with fixed leading parameters that is encoded by the C code
+class SerialPreparedCommand:
+    def __init__(self, serial, cmd_queue, cmd, fixed):
+        if not min([t.is_int for t in cmd.param_types] + [1]):
+            raise error("Can not prepare command '%s'" % (cmd.msgformat,))
+        self.serial = serial
+        self.cmd_queue = cmd_queue
+        self.ffi_lib = serial.ffi_lib
+        self.count = len(cmd.param_types) + 1
+        self.var_pos = len(fixed) + 1
+        self.data = serial.ffi_main.new('uint32_t[]', self.count)
+        self.data[0:self.var_pos] = [cmd.msgid] + [
+            v & 0xffffffff for v in fixed]
+    def send(self, data=(), minclock=0, reqclock=0):
+        # Parameters are truncated to 32 bits - the encoding of a value
+        # above 32 bits (eg, a 64bit clock) is shorter than the one from
+        # MessageFormat.encode(), but the mcu decodes it to the same value
+        self.data[self.var_pos:self.count] = [v & 0xffffffff for v in data]
+        self.ffi_lib.serialqueue_encode_and_send(
+            self.serial.serialqueue, self.cmd_queue, self.data, self.count,
+            minclock, reqclock)
 
 # Class to retry sending of a query command until a given response is received
 class SerialRetryCommand:
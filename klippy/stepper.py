@@ -42,10 +42,14 @@ class PrinterStepper:
         # Stepper definition
         ppins = printer.lookup_object('pins')
         self.mcu_stepper = ppins.setup_pin('stepper', config.get('step_pin'))
+        self.mcu_stepper.setup_name(self.name)
         dir_pin_params = ppins.lookup_pin('digital_out', config.get('dir_pin'))
         self.mcu_stepper.setup_dir_pin(dir_pin_params)
         self.step_dist = config.getfloat('step_distance', above=0.)
         self.mcu_stepper.setup_step_distance(self.step_dist)
+        max_error = config.getfloat('max_stepper_error', None, minval=0.)
+        if max_error is not None:
+            self.mcu_stepper.setup_max_error(max_error)
         self.step = self.mcu_stepper.step
         self.step_const = self.mcu_stepper.step_const
         self.step_delta = self.mcu_stepper.step_delta
@@ -62,6 +66,8 @@ class PrinterStepper:
             2. * self.step_dist, max_halt_velocity, max_accel)
         min_stop_interval = second_last_step_time - last_step_time
         self.mcu_stepper.setup_min_stop_interval(min_stop_interval)
+    def get_mcu_steppers(self):
+        return [self.mcu_stepper]
     def set_position(self, pos):
         self.mcu_stepper.set_position(pos)
     def motor_enable(self, print_time, enable=0):
@@ -190,6 +196,9 @@ class PrinterMultiStepper(PrinterHomingStepper):
         PrinterHomingStepper.set_max_jerk(self, max_halt_velocity, max_accel)
         for extra in self.extras:
             extra.set_max_jerk(max_halt_velocity, max_accel)
+    def get_mcu_steppers(self):
+        return ([self.mcu_stepper]
+                + [extra.mcu_stepper for extra in self.extras])
     def set_position(self, pos):
         PrinterHomingStepper.set_position(self, pos)
         for extra in self.extras:
@@ -4,22 +4,34 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math, logging
-import mcu, homing, cartesian, corexy, delta, extruder
+import mcu, homing, chelper, cartesian, corexy, delta, extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
-# Class to track each move request
-class Move:
+# Class to track each move request.  A Move is allocated for every
+# G1 command, so it uses fixed slots to avoid a per-instance dict.
+class Move(object):
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'is_kinematic_move',
+        'axes_d', 'move_d', 'min_move_t', 'max_start_v2', 'max_cruise_v2',
+        'delta_v2', 'max_smoothed_v2', 'smooth_delta_v2',
+        'accel_r', 'cruise_r', 'decel_r', 'start_v', 'cruise_v', 'end_v',
+        'accel_t', 'cruise_t', 'decel_t',
+        'extrude_r', 'extrude_max_corner_v', 'pressure_advance',
+        'pressure_advance_lookahead_time', 'timing_callbacks')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
-        self.start_pos = tuple(start_pos)
-        self.end_pos = tuple(end_pos)
+        self.start_pos = start_pos = tuple(start_pos)
+        self.end_pos = end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        self.axes_d = axes_d = (
+            end_pos[0] - start_pos[0], end_pos[1] - start_pos[1],
+            end_pos[2] - start_pos[2], end_pos[3] - start_pos[3])
+        self.move_d = move_d = math.sqrt(
+            axes_d[0]*axes_d[0] + axes_d[1]*axes_d[1] + axes_d[2]*axes_d[2])
         if not move_d:
             # Extrude only move
             self.move_d = move_d = abs(axes_d[3])
@@ -33,6 +45,7 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+        self.timing_callbacks = []
     def limit_speed(self, speed, accel):
         speed2 = speed**2
         if speed2 < self.max_cruise_v2:
@@ -96,30 +109,47 @@ class Move:
             self.toolhead.extruder.move(next_move_time, self)
         self.toolhead.update_move_time(
             self.accel_t + self.cruise_t + self.decel_t)
+        for cb in self.timing_callbacks:
+            cb(self.toolhead.print_time)
 
 LOOKAHEAD_FLUSH_TIME = 0.250
+JUNCTION_FIELDS = 9
 
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
 class MoveQueue:
     def __init__(self):
-        self.extruder_lookahead = None
+        self.extruder_lookahead = self.extruder_reset = None
         self.queue = []
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        self.moves_added = self.moves_examined = 0
     def reset(self):
         del self.queue[:]
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        if self.extruder_reset is not None:
+            self.extruder_reset()
+    def get_last(self):
+        if self.queue:
+            return self.queue[-1]
+        return None
+    def stats(self):
+        # Report the number of moves examined by the lookahead for
+        # each move added to the queue
+        return "lookahead_scan=%.3f" % (
+            float(self.moves_examined) / max(self.moves_added, 1),)
     def set_flush_time(self, flush_time):
         self.junction_flush = flush_time
     def set_extruder(self, extruder):
         self.extruder_lookahead = extruder.lookahead
+        self.extruder_reset = extruder.reset_lookahead
     def flush(self, lazy=False):
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
         update_flush_count = lazy
         queue = self.queue
         flush_count = len(queue)
+        self.moves_examined += flush_count - self.leftover
         # Traverse queue from last to first move and determine maximum
         # junction speed assuming the robot comes to a complete stop
         # after the last move.
@@ -172,6 +202,7 @@ class MoveQueue:
         del queue[:move_count]
     def add_move(self, move):
         self.queue.append(move)
+        self.moves_added += 1
         if len(self.queue) == 1:
             return
         move.calc_junction(self.queue[-2])
@@ -182,6 +213,81 @@ class MoveQueue:
             # least one move can be flushed.
             self.flush(lazy=True)
 
+# Variant of MoveQueue that performs the junction and look-ahead
+# calculations in C (see chelper/lookahead.c).  The results are
+# identical to the python MoveQueue class.
+class CMoveQueue(MoveQueue):
+    def __init__(self):
+        MoveQueue.__init__(self)
+        self.extruder_junction = None
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.cqueue = self.ffi_main.gc(self.ffi_lib.lookahead_alloc(),
+                                       self.ffi_lib.lookahead_free)
+        self.junctions = self.ffi_main.new('double[]', JUNCTION_FIELDS * 64)
+    def reset(self):
+        MoveQueue.reset(self)
+        self.ffi_lib.lookahead_reset(self.cqueue)
+    def set_extruder(self, extruder):
+        MoveQueue.set_extruder(self, extruder)
+        self.extruder_junction = extruder.calc_junction
+    def flush(self, lazy=False):
+        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        queue = self.queue
+        leftover = self.leftover
+        self.moves_examined += len(queue) - leftover
+        flush_count = self.ffi_lib.lookahead_flush(self.cqueue, leftover, lazy)
+        if flush_count < 0:
+            return
+        # Copy the calculated junctions back to the queued moves
+        count = (flush_count - leftover) * JUNCTION_FIELDS
+        if count > len(self.junctions):
+            self.junctions = self.ffi_main.new('double[]', count)
+        self.ffi_lib.lookahead_get_junctions(
+            self.cqueue, leftover, flush_count, self.junctions)
+        junctions = self.junctions[0:count]
+        pos = 0
+        for move in queue[leftover:flush_count]:
+            (move.accel_r, move.cruise_r, move.decel_r,
+             move.start_v, move.cruise_v, move.end_v,
+             move.accel_t, move.cruise_t, move.decel_t) = junctions[
+                 pos:pos+JUNCTION_FIELDS]
+            pos += JUNCTION_FIELDS
+        # Allow extruder to do its lookahead
+        move_count = self.extruder_lookahead(queue, flush_count, lazy)
+        # Generate step times for all moves ready to be flushed
+        for move in queue[:move_count]:
+            move.move()
+        # Remove processed moves from the queue
+        self.leftover = flush_count - move_count
+        del queue[:move_count]
+        self.ffi_lib.lookahead_pop(self.cqueue, move_count)
+    def add_move(self, move):
+        queue = self.queue
+        queue.append(move)
+        self.moves_added += 1
+        extruder_v2 = 0.
+        if len(queue) > 1:
+            prev_move = queue[-2]
+            if move.is_kinematic_move and prev_move.is_kinematic_move:
+                # Allow extruder to calculate its maximum junction
+                extruder_v2 = self.extruder_junction(prev_move, move)
+        axes_d = move.axes_d
+        move.max_start_v2 = self.ffi_lib.lookahead_add_move(
+            self.cqueue, move.move_d, move.accel, axes_d[0], axes_d[1],
+            axes_d[2], move.is_kinematic_move, move.max_cruise_v2,
+            move.delta_v2, move.smooth_delta_v2,
+            move.toolhead.junction_deviation, extruder_v2)
+        if move.max_start_v2 < 0.:
+            raise mcu.error("Internal error in lookahead")
+        if len(queue) == 1:
+            return
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # There are enough queued moves to return to zero velocity
+            # from the first move's maximum possible velocity, so at
+            # least one move can be flushed.
+            self.flush(lazy=True)
+
 STALL_TIME = 0.100
 
 # Main code to track events (and their timing) on the printer toolhead
@@ -202,7 +308,9 @@ class ToolHead:
         self.config_max_velocity = self.max_velocity
         self.config_max_accel = self.max_accel
         self.config_junction_deviation = self.junction_deviation
-        self.move_queue = MoveQueue()
+        move_queues = {'python': MoveQueue, 'c': CMoveQueue}
+        self.move_queue = config.getchoice(
+            'lookahead_planner', move_queues, 'python')()
         self.commanded_pos = [0., 0., 0., 0.]
         # Print time tracking
         self.buffer_time_low = config.getfloat(
@@ -238,6 +346,8 @@ class ToolHead:
         gcode = printer.lookup_object('gcode')
         gcode.register_command('SET_VELOCITY_LIMIT', self.cmd_SET_VELOCITY_LIMIT,
                                desc=self.cmd_SET_VELOCITY_LIMIT_help)
+        gcode.register_command('STEPPER_STATS', self.cmd_STEPPER_STATS,
+                               desc=self.cmd_STEPPER_STATS_help)
     # Print time tracking
     def update_move_time(self, movetime):
         self.print_time += movetime
@@ -269,6 +379,14 @@ class ToolHead:
     def get_last_move_time(self):
         self._flush_lookahead()
         return self.get_next_move_time()
+    def register_lookahead_callback(self, callback):
+        # Invoke callback(print_time) once all currently queued moves
+        # have been flushed (without forcing a lookahead flush)
+        last_move = self.move_queue.get_last()
+        if last_move is None:
+            callback(self.get_last_move_time())
+            return
+        last_move.timing_callbacks.append(callback)
     def reset_print_time(self, min_print_time=0.):
         self._flush_lookahead(must_sync=True)
         self.print_time = max(min_print_time, self.mcu.estimated_print_time(
@@ -378,8 +496,9 @@ class ToolHead:
             m.check_active(self.print_time, eventtime)
         buffer_time = self.print_time - self.mcu.estimated_print_time(eventtime)
         is_active = buffer_time > -60. or not self.sync_print_time
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
-            self.print_time, max(buffer_time, 0.), self.print_stall)
+        return is_active, ("print_time=%.3f buffer_time=%.3f print_stall=%d"
+                           " %s" % (self.print_time, max(buffer_time, 0.),
+                                    self.print_stall, self.move_queue.stats()))
     def get_status(self, eventtime):
         buffer_time = self.print_time - self.mcu.estimated_print_time(eventtime)
         if buffer_time > -1. or not self.sync_print_time:
@@ -409,8 +528,11 @@ class ToolHead:
                    math.sqrt(8. * self.junction_deviation * self.max_accel))
     cmd_SET_VELOCITY_LIMIT_help = "Set printer velocity limits"
     def cmd_SET_VELOCITY_LIMIT(self, params):
-        print_time = self.get_last_move_time()
+        # The limits are captured by each Move when it is queued, so
+        # the new limits only apply to subsequent moves
         gcode = self.printer.lookup_object('gcode')
+        if gcode.get_int('SYNC', params, 0, minval=0, maxval=1):
+            self.get_last_move_time()
         max_velocity = gcode.get_float(
             'VELOCITY', params, self.max_velocity,
             above=0., maxval=self.config_max_velocity)
@@ -434,6 +556,12 @@ class ToolHead:
                    junction_deviation))
         self.printer.set_rollover_info("toolhead", "toolhead: %s" % (msg,))
         gcode.respond_info(msg)
+    cmd_STEPPER_STATS_help = "Report step compression statistics"
+    def cmd_STEPPER_STATS(self, params):
+        msg = []
+        for m in self.all_mcus:
+            msg.extend(m.get_stepper_stats())
+        self.printer.lookup_object('gcode').respond_info("\n".join(msg))
 
 def add_printer_objects(printer, config):
     printer.add_object('toolhead', ToolHead(printer, config))
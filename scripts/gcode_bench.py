@@ -0,0 +1,55 @@
+#!/usr/bin/env python2
+# Benchmark klippy batch mode processing of a gcode file
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, subprocess
+
+# Klippy is run in batch mode (see docs/Debugging.md) with its output
+# discarded - the reported rate includes host startup and all the
+# move planning and step generation done for the gcode.
+
+def run_klippy(klippy, config, dictionary, gcode, logfile):
+    cmd = [sys.executable, klippy, config, "-i", gcode, "-o", "/dev/null",
+           "-d", dictionary, "-l", logfile]
+    start = time.time()
+    start_cpu = os.times()
+    ret = subprocess.call(cmd)
+    end_cpu = os.times()
+    duration = time.time() - start
+    if ret:
+        raise Exception("klippy exited with code %d" % (ret,))
+    return duration, (end_cpu[2] + end_cpu[3]) - (start_cpu[2] + start_cpu[3])
+
+def main():
+    usage = "%prog [options] <config file> <dictionary> <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of benchmark runs (best is reported)")
+    opts.add_option("-l", "--logfile", dest="logfile",
+                    default="/tmp/gcode_bench.log",
+                    help="klippy log file")
+    options, args = opts.parse_args()
+    if len(args) != 3:
+        opts.error("Incorrect number of arguments")
+    config, dictionary, gcode = args
+    klippy = os.path.join(os.path.dirname(__file__), '../klippy/klippy.py')
+    f = open(gcode, 'rb')
+    lines = len(f.readlines())
+    f.close()
+    best = best_cpu = None
+    for i in range(options.repeat):
+        if os.path.exists(options.logfile):
+            os.unlink(options.logfile)
+        duration, cpu = run_klippy(klippy, config, dictionary, gcode,
+                                   options.logfile)
+        if best is None or duration < best:
+            best = duration
+        if best_cpu is None or cpu < best_cpu:
+            best_cpu = cpu
+    print "lines=%d time=%.3fs lines/sec=%.0f cpu=%.3fs lines/cpusec=%.0f" % (
+        lines, best, lines / best, best_cpu, lines / best_cpu)
+
+if __name__ == '__main__':
+    main()
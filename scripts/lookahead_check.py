@@ -0,0 +1,209 @@
+#!/usr/bin/env python2
+# Check that the python and C look-ahead planners produce identical moves
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import toolhead, extruder
+
+# Each test feeds the same stream of moves to the toolhead.MoveQueue
+# and toolhead.CMoveQueue classes.  The junction fields of every
+# generated move (along with its max_start_v2 and the point at which
+# it was flushed) must match exactly.
+
+JUNCTION_ATTRS = ('accel_r', 'cruise_r', 'decel_r', 'start_v', 'cruise_v',
+                  'end_v', 'accel_t', 'cruise_t', 'decel_t', 'max_start_v2')
+
+# Extruder with the real junction, check, and look-ahead code, but
+# without a heater or stepper
+class CheckExtruder(extruder.PrinterExtruder):
+    def __init__(self, pressure_advance):
+        self.nozzle_diameter = .4
+        self.filament_area = math.pi * (1.75 * .5)**2
+        self.max_extrude_ratio = 4. * self.nozzle_diameter**2 / (
+            self.filament_area)
+        self.max_e_velocity = 300. * self.max_extrude_ratio
+        self.max_e_accel = 3000. * self.max_extrude_ratio
+        self.max_e_dist = 50.
+        self.pressure_advance = pressure_advance
+        self.pressure_advance_lookahead_time = .010
+        self.last_pa_move = None
+        self.heater = self
+        self.can_extrude = True
+    def move(self, print_time, move):
+        if move is self.last_pa_move:
+            self.last_pa_move = None
+
+# Toolhead that records the moves generated by a move queue
+class CheckToolHead:
+    def __init__(self, move_queue, pressure_advance):
+        self.max_velocity = 300.
+        self.max_accel = 3000.
+        self.max_accel_to_decel = 1500.
+        self.junction_deviation = .02
+        self.max_z_velocity, self.max_z_accel = 5., 100.
+        self.print_time = 0.
+        self.kin = self
+        self.extruder = CheckExtruder(pressure_advance)
+        self.move_queue = move_queue
+        move_queue.set_extruder(self.extruder)
+        move_queue.set_flush_time(.100)
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.results = []
+        self.flushes = 0
+    def get_next_move_time(self):
+        return self.print_time
+    def update_move_time(self, movetime):
+        self.print_time += movetime
+    def move(self, print_time, move):
+        # Kinematic step generation (not needed for the check)
+        pass
+    def add_move(self, newpos, speed):
+        move = CheckMove(self, self.commanded_pos, newpos, speed)
+        if move.axes_d[2]:
+            move.limit_speed(self.max_z_velocity, self.max_z_accel)
+        if move.axes_d[3]:
+            self.extruder.check_move(move)
+        self.commanded_pos[:] = newpos
+        self.move_queue.add_move(move)
+    def flush(self):
+        self.flushes += 1
+        self.move_queue.flush()
+
+# Move that records its junction fields when its steps are generated
+class CheckMove(toolhead.Move):
+    __slots__ = ()
+    def move(self):
+        th = self.toolhead
+        th.results.append((th.flushes,) + tuple([
+            getattr(self, a) for a in JUNCTION_ATTRS]))
+        toolhead.Move.move(self)
+
+######################################################################
+# Move streams
+######################################################################
+
+# Zig-zag of corners with random angles, speeds, and extrusion
+def gen_corners(rnd, th, count):
+    x, y, z, e = th.commanded_pos
+    for i in range(count):
+        angle = rnd.uniform(0., 2. * math.pi)
+        dist = rnd.choice([.1, .5, 1., 5., 20., 80.])
+        x += dist * math.cos(angle)
+        y += dist * math.sin(angle)
+        e += dist * rnd.choice([0., .03, .033, .05])
+        th.add_move([x, y, z, e], rnd.choice([20., 60., 150., 300.]))
+
+# Printing with retracts and unretracts (extrude only moves) and z hops
+def gen_retracts(rnd, th, count):
+    x, y, z, e = th.commanded_pos
+    for i in range(count):
+        e -= 1.
+        th.add_move([x, y, z, e], 40.)
+        z += .2
+        th.add_move([x, y, z, e], 5.)
+        x += rnd.uniform(-30., 30.)
+        y += rnd.uniform(-30., 30.)
+        th.add_move([x, y, z, e], 300.)
+        z -= .2
+        th.add_move([x, y, z, e], 5.)
+        e += 1.
+        th.add_move([x, y, z, e], 40.)
+        for j in range(rnd.randint(1, 8)):
+            dx, dy = rnd.uniform(-10., 10.), rnd.uniform(-10., 10.)
+            x += dx
+            y += dy
+            e += math.sqrt(dx**2 + dy**2) * .033
+            th.add_move([x, y, z, e], 60.)
+
+# Fast long moves followed by chains of short moves into a reversal
+# (these moves are fully decelerating and their junctions are delayed
+# until the peak cruise speed is known)
+def gen_decel_chains(rnd, th, count):
+    x, y, z, e = th.commanded_pos
+    for i in range(count):
+        angle = rnd.uniform(0., 2. * math.pi)
+        dx, dy = math.cos(angle), math.sin(angle)
+        x += 100. * dx
+        y += 100. * dy
+        th.add_move([x, y, z, e], 300.)
+        for j in range(rnd.randint(2, 30)):
+            # Short, slightly curved moves
+            angle += rnd.uniform(-.05, .05)
+            dist = rnd.uniform(.05, .5)
+            x += dist * math.cos(angle)
+            y += dist * math.sin(angle)
+            e += dist * .033
+            th.add_move([x, y, z, e], rnd.choice([150., 300.]))
+        # Reverse direction
+        x -= 50. * dx
+        y -= 50. * dy
+        th.add_move([x, y, z, e], 300.)
+
+# Arcs of tiny segments with occasional full (non-lazy) flushes
+def gen_arcs(rnd, th, count):
+    x, y, z, e = th.commanded_pos
+    for i in range(count):
+        radius = rnd.uniform(1., 40.)
+        segs = rnd.randint(8, 120)
+        cx, cy = x - radius, y
+        for j in range(1, segs + 1):
+            a = 2. * math.pi * j / segs
+            nx, ny = cx + radius * math.cos(a), cy + radius * math.sin(a)
+            e += math.sqrt((nx - x)**2 + (ny - y)**2) * .033
+            x, y = nx, ny
+            th.add_move([x, y, z, e], rnd.choice([30., 100., 250.]))
+        if rnd.random() < .3:
+            th.flush()
+
+STREAMS = [
+    ('corners', gen_corners), ('retracts', gen_retracts),
+    ('decel_chains', gen_decel_chains), ('arcs', gen_arcs),
+]
+
+def run_stream(move_queue_class, gen, seed, count, pressure_advance):
+    th = CheckToolHead(move_queue_class(), pressure_advance)
+    gen(random.Random(seed), th, count)
+    th.flush()
+    return th.results, th.move_queue.stats()
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count", default=200,
+                    help="number of move groups in each stream")
+    opts.add_option("-s", "--seed", type="int", dest="seed", default=1,
+                    help="random seed of the move streams")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    failures = []
+    for pressure_advance in [0., .05]:
+        for name, gen in STREAMS:
+            res_py, stats_py = run_stream(
+                toolhead.MoveQueue, gen, options.seed, options.count,
+                pressure_advance)
+            res_c, stats_c = run_stream(
+                toolhead.CMoveQueue, gen, options.seed, options.count,
+                pressure_advance)
+            desc = "%s pressure_advance=%.3f" % (name, pressure_advance)
+            mismatch = [i for i, (p, c) in enumerate(zip(res_py, res_c))
+                        if p != c]
+            if len(res_py) != len(res_c) or mismatch or stats_py != stats_c:
+                first = mismatch[0] if mismatch else min(
+                    len(res_py), len(res_c))
+                print "%s: MISMATCH at move %d (moves %d vs %d)" % (
+                    desc, first, len(res_py), len(res_c))
+                failures.append(desc)
+                continue
+            print "%s: %d moves match (%s)" % (desc, len(res_py), stats_py)
+    if failures:
+        print "Python and C look-ahead results differ: %s" % (
+            ", ".join(failures),)
+        sys.exit(1)
+    print "Python and C look-ahead results match"
+
+if __name__ == '__main__':
+    main()
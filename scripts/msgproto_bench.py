@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+# Benchmark the python and C message encoding and parsing code
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+# The data file is the serial output of klippy in batch mode (see the
+# "-o" option in docs/Debugging.md) along with its data dictionary.
+# Messages are parsed from C buffers (as is done in serialhdl.py).
+
+def read_blocks(mp, data):
+    blocks = []
+    while data:
+        l = mp.check_packet(data)
+        if l <= 0:
+            break
+        blocks.append(data[:l])
+        data = data[l:]
+    return blocks
+
+def split_messages(mp, blocks):
+    ffi_main, ffi_lib = msgproto.get_c_codec()
+    msgs = []
+    for block in blocks:
+        s = bytearray(block)
+        if ffi_main is not None:
+            s = ffi_main.new('uint8_t[]', list(s))
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < len(s) - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id[s[pos]]
+            params, next_pos = mid.parse(s, pos)
+            msgs.append((s, pos, mid.msgid,
+                         tuple([params[name] for name, t in mid.param_names])))
+            pos = next_pos
+    return msgs
+
+def bench(func, count):
+    best = None
+    for i in range(count):
+        start = time.time()
+        res = func()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return res, best
+
+def run(mp, blocks, msgs, count):
+    def check():
+        return [mp.check_packet(b) for b in blocks]
+    def parse():
+        by_id = mp.messages_by_id
+        return [by_id[msgid].parse(s, pos) for s, pos, msgid, params in msgs]
+    def encode():
+        by_id = mp.messages_by_id
+        return [by_id[msgid].encode(params) for s, pos, msgid, params in msgs]
+    return [bench(f, count) for f in [check, parse, encode]]
+
+def main():
+    usage = "%prog [options] <dictionary> <serial data file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=5,
+                    help="number of benchmark runs (best is reported)")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    dictionary = open(args[0], 'rb').read()
+    data = open(args[1], 'rb').read()
+
+    results = {}
+    for name, use_c_codec in [("python", False), ("c", True)]:
+        mp = msgproto.MessageParser(use_c_codec=use_c_codec)
+        mp.process_identify(dictionary, decompress=False)
+        if use_c_codec and mp.ffi_lib is None:
+            print "C message codec not available"
+            continue
+        blocks = read_blocks(mp, data)
+        msgs = split_messages(mp, blocks)
+        res = run(mp, blocks, msgs, options.repeat)
+        results[name] = [r for r, t in res]
+        (c, check_t), (p, parse_t), (e, encode_t) = res
+        print ("%s: blocks=%d messages=%d check_packet=%.0f blocks/sec"
+               " parse=%.0f msgs/sec encode=%.0f msgs/sec" % (
+                   name, len(blocks), len(msgs), len(blocks) / check_t,
+                   len(msgs) / parse_t, len(msgs) / encode_t))
+    if len(results) == 2 and results['python'] != results['c']:
+        print "Python and C results do not match"
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+# Benchmark the reactor main loop with a varying number of timers
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+# In the "idle" test one timer runs on every loop iteration while the
+# other timers wake up about once a second (as most klippy timers do).
+# In the "periodic" test the other timers wake up every 10ms.  In the
+# "jitter" test there is no busy timer and the lateness of a timer
+# with a 2.7ms period is measured (along with the cpu time used).
+
+REACTORS = {
+    'default': lambda: reactor.Reactor(), 'select': reactor.SelectReactor,
+    'poll': reactor.PollReactor, 'epoll': reactor.EPollReactor }
+
+def new_reactor(options):
+    r = REACTORS[options.reactor]()
+    if options.profile:
+        r.enable_profiling()
+    return r
+
+def add_timers(r, num_timers, period):
+    now = r.monotonic()
+    for i in range(num_timers):
+        def timer_event(eventtime):
+            return eventtime + period
+        r.register_timer(timer_event, now + period * i / num_timers)
+
+def run_loop(r, duration):
+    counts = [0]
+    def busy(eventtime):
+        counts[0] += 1
+        return r.NOW
+    def stop(eventtime):
+        r.end()
+        return r.NEVER
+    start = r.monotonic()
+    r.register_timer(busy, r.NOW)
+    r.register_timer(stop, start + duration)
+    r.run()
+    return counts[0] / (r.monotonic() - start)
+
+def bench_idle(num_timers, options):
+    r = new_reactor(options)
+    add_timers(r, num_timers - 1, 1.)
+    return run_loop(r, options.duration)
+
+def bench_periodic(num_timers, options):
+    r = new_reactor(options)
+    add_timers(r, num_timers - 1, .010)
+    return run_loop(r, options.duration)
+
+def bench_jitter(num_timers, options):
+    r = new_reactor(options)
+    add_timers(r, num_timers - 1, 1.)
+    lateness = []
+    def measure(eventtime):
+        lateness.append(eventtime - measure.waketime)
+        measure.waketime += .0027
+        return measure.waketime
+    def stop(eventtime):
+        r.end()
+        return r.NEVER
+    measure.waketime = r.monotonic() + .0027
+    r.register_timer(measure, measure.waketime)
+    r.register_timer(stop, r.monotonic() + options.duration)
+    start_cpu = sum(os.times()[:2])
+    r.run()
+    cpu = sum(os.times()[:2]) - start_cpu
+    lateness.sort()
+    return lateness, cpu / options.duration
+
+def main():
+    usage = "%prog [options] [<timer count> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=2., help="length of each benchmark run")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of benchmark runs (best is reported)")
+    opts.add_option("-p", "--profile", action="store_true", dest="profile",
+                    default=False, help="enable reactor profiling")
+    opts.add_option("-t", "--reactor", type="choice", dest="reactor",
+                    choices=sorted(REACTORS.keys()), default="default",
+                    help="reactor implementation to benchmark")
+    options, args = opts.parse_args()
+    counts = [int(a) for a in args] or [10, 100, 1000]
+    for num_timers in counts:
+        idle = max([bench_idle(num_timers, options)
+                    for i in range(options.repeat)])
+        periodic = max([bench_periodic(num_timers, options)
+                        for i in range(options.repeat)])
+        lateness, cpu = bench_jitter(num_timers, options)
+        count = len(lateness)
+        print ("timers=%d idle=%.0f loops/sec periodic=%.0f loops/sec"
+               " jitter avg=%.0fus p50=%.0fus p99=%.0fus max=%.0fus"
+               " cpu=%.1f%%" % (
+                   num_timers, idle, periodic,
+                   1000000. * sum(lateness) / count,
+                   1000000. * lateness[count // 2],
+                   1000000. * lateness[count * 99 // 100],
+                   1000000. * lateness[-1], 100. * cpu))
+
+if __name__ == '__main__':
+    main()
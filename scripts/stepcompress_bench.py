@@ -0,0 +1,504 @@
+#!/usr/bin/env python2
+# Benchmark and regression test the step compression code
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, array, filecmp, tempfile, shutil
+import math, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import chelper, mcu
+from toolhead import Move
+
+# The capture files are created by running klippy with the
+# "--capture-steps <prefix>" option - one file is created per stepper.
+
+def replay(ffi_main, ffi_lib, data, fast_mode, out_filename="", count=1):
+    cdata = ffi_main.cast('uint32_t *', ffi_main.from_buffer(data))
+    res = ffi_main.new('struct stepcompress_replay *')
+    best = None
+    for i in range(count):
+        start = time.time()
+        ret = ffi_lib.stepcompress_replay(cdata, len(data), out_filename,
+                                          fast_mode, res)
+        duration = time.time() - start
+        if ret:
+            raise Exception("Error %d during replay" % (ret,))
+        if best is None or duration < best:
+            best = duration
+    return res, best
+
+# The thread mode runs a synthetic multi-stepper workload through a
+# steppersync object (with its output discarded) to measure the
+# "step_threads" scaling.  It also checks that the generated step times
+# do not depend on the thread count - the clock conversion is updated
+# between pushing the steps of a move and flushing them (as is done
+# by the mcu clock synchronization).
+
+MCU_FREQ = 16000000.
+STEPCOMPRESS_ERROR_RET = -989898989
+
+# A group of stepcompress objects flushed by a steppersync object
+# (with the generated commands discarded - if 'send' is false they are
+# discarded before reaching a serialqueue)
+class StepSync:
+    def __init__(self, ffi_main, ffi_lib, steppers, capture="", send=True):
+        self.ffi_lib = ffi_lib
+        self.devnull = self.sq = None
+        if send:
+            self.devnull = os.open(os.devnull, os.O_WRONLY)
+            self.sq = ffi_lib.serialqueue_alloc(self.devnull, 1)
+            ffi_lib.serialqueue_set_clock_est(self.sq, 1000000000000., 0., 0)
+        self.scs = [ffi_main.gc(ffi_lib.stepcompress_alloc(
+            25 * 16, 1, 2, 0, oid), ffi_lib.stepcompress_free)
+                    for oid in range(steppers)]
+        if capture:
+            for oid, sc in enumerate(self.scs):
+                ffi_lib.stepcompress_set_capture(sc, "%s%d" % (capture, oid))
+        self.ss = ffi_lib.steppersync_alloc(
+            self.sq or ffi_main.NULL, self.scs, len(self.scs), 16)
+        self.offset, self.freq = 0., MCU_FREQ
+        self.set_time(self.offset, self.freq)
+    def set_time(self, offset, freq):
+        self.offset, self.freq = offset, freq
+        ret = self.ffi_lib.steppersync_set_time(self.ss, offset, freq)
+        if ret:
+            raise Exception("Error %d during steppersync_set_time" % (ret,))
+    def flush(self, print_time):
+        ret = self.ffi_lib.steppersync_flush(
+            self.ss, int((print_time - self.offset) * self.freq))
+        if ret:
+            raise Exception("Error %d during steppersync_flush" % (ret,))
+    def close(self):
+        ffi_lib = self.ffi_lib
+        for sc in self.scs:
+            ffi_lib.stepcompress_set_capture(sc, "")
+        if self.sq is not None:
+            ffi_lib.serialqueue_exit(self.sq)
+            ffi_lib.serialqueue_free(self.sq)
+        ffi_lib.steppersync_free(self.ss)
+        if self.devnull is not None:
+            os.close(self.devnull)
+
+def run_threads(ffi_main, ffi_lib, threads, steppers, moves, capture=""):
+    sync = StepSync(ffi_main, ffi_lib, steppers, capture)
+    ffi_lib.steppersync_set_threads(sync.ss, threads)
+    commanded_pos = [0.] * steppers
+    move_pos = [0.] * steppers
+    accel_t, cruise_t = 0.020, 0.040
+    print_time = 0.100
+    start = time.time()
+    for i in range(moves):
+        for oid, sc in enumerate(sync.scs):
+            # Trapezoidal move (in steps) alternating direction
+            sign = -1. if i & 1 else 1.
+            cruise_v = 1000. + 100. * oid
+            accel = cruise_v / accel_t
+            accel_d = sign * .5 * cruise_v * accel_t
+            pt = print_time
+            for dist, start_v, a, t in [
+                    (accel_d, 0., accel, accel_t),
+                    (sign * cruise_v * cruise_t, cruise_v, 0., cruise_t),
+                    (accel_d, cruise_v, -accel, accel_t)]:
+                count = ffi_lib.stepcompress_push_const(
+                    sc, pt, commanded_pos[oid] - move_pos[oid], dist,
+                    start_v, a)
+                if count == STEPCOMPRESS_ERROR_RET:
+                    raise Exception("Error during stepcompress_push_const")
+                commanded_pos[oid] += count
+                move_pos[oid] += dist
+                pt += t
+        print_time += 2. * accel_t + cruise_t
+        if i % 25 == 24:
+            # Simulate a clock synchronization update
+            sync.set_time(sync.offset - 0.000010, sync.freq + 0.5)
+        if i % 10 == 9 or i == moves - 1:
+            sync.flush(print_time)
+    duration = time.time() - start
+    sync.close()
+    return duration
+
+def bench_threads(ffi_main, ffi_lib, options):
+    thread_counts = [int(t) for t in options.threads.split(',')]
+    steppers, moves = options.steppers, options.moves
+    # Check that the output does not depend on the thread count
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for threads in thread_counts:
+            run_threads(ffi_main, ffi_lib, threads, steppers, moves,
+                        os.path.join(tmpdir, "t%d-" % (threads,)))
+        failures = []
+        for threads in thread_counts[1:]:
+            for oid in range(steppers):
+                ref = os.path.join(tmpdir, "t%d-%d" % (thread_counts[0], oid))
+                out = os.path.join(tmpdir, "t%d-%d" % (threads, oid))
+                if not filecmp.cmp(ref, out, shallow=False):
+                    failures.append("threads=%d oid=%d" % (threads, oid))
+    finally:
+        shutil.rmtree(tmpdir)
+    # Benchmark
+    for threads in thread_counts:
+        best = min([run_threads(ffi_main, ffi_lib, threads, steppers, moves)
+                    for i in range(options.repeat)])
+        print ("threads=%d steppers=%d moves=%d time=%.3fs" % (
+            threads, steppers, moves, best))
+    if failures:
+        print "Step times depend on the thread count: %s" % (
+            ", ".join(failures),)
+        sys.exit(1)
+    print "Step times match for all thread counts"
+
+######################################################################
+# Message merge benchmark
+######################################################################
+
+# The merge mode measures steppersync_flush() - the merging of the
+# queue_step commands of several steppers into a single clock ordered
+# stream.  The steps are compressed before the timed flush, so only
+# the merge (and, optionally, the hand off to a serialqueue) is timed.
+
+def run_merge(ffi_main, ffi_lib, steppers, steps, send, seed):
+    sync = StepSync(ffi_main, ffi_lib, steppers, send=send)
+    rnd = random.Random(seed)
+    print_time = 0.
+    for sc in sync.scs:
+        # Irregular step times (few of the steps can be combined)
+        pt = 0.100
+        for i in range(steps):
+            pt += rnd.uniform(.000100, .000500)
+            if ffi_lib.stepcompress_push(sc, pt, 1) != 1:
+                raise Exception("Error during stepcompress_push")
+        print_time = max(print_time, pt)
+    clock = int((print_time + .001) * MCU_FREQ)
+    for sc in sync.scs:
+        ret = ffi_lib.stepcompress_flush(sc, clock)
+        if ret:
+            raise Exception("Error %d during stepcompress_flush" % (ret,))
+    msgs = 0
+    buf = ffi_main.new("char[200]")
+    for sc in sync.scs:
+        ffi_lib.stepcompress_get_stats(sc, buf, 200)
+        stats = dict([p.split('=') for p in ffi_main.string(buf).split()])
+        msgs += int(stats['queue_step']) + int(stats['dir_changes'])
+    start = time.time()
+    ret = ffi_lib.steppersync_flush(sync.ss, clock)
+    duration = time.time() - start
+    if ret:
+        raise Exception("Error %d during steppersync_flush" % (ret,))
+    sync.close()
+    return msgs, duration
+
+def bench_merge(ffi_main, ffi_lib, options):
+    for steppers in [int(s) for s in options.merge.split(',')]:
+        for send in [False, True]:
+            res = [run_merge(ffi_main, ffi_lib, steppers, options.moves,
+                             send, options.seed)
+                   for i in range(options.repeat)]
+            msgs = res[0][0]
+            best = min([duration for m, duration in res])
+            print ("steppers=%d %s: msgs=%d time=%.3fs ns/msg=%.1f" % (
+                steppers, "merge+send" if send else "merge", msgs, best,
+                best * 1000000000. / msgs))
+
+######################################################################
+# Step solver comparison
+######################################################################
+
+# The solver mode generates the steps of a set of random moves with
+# both the "analytic" (stepcompress_push_move/push_delta_move) and the
+# "iterative" (itersolve) step_solver.  It reports the step generation
+# speed of each and the deviation between the step times they produce.
+
+CAP_INIT, CAP_STEPS, CAP_MSG = 0, 1, 7
+
+class BenchToolHead:
+    max_accel = 3000.
+    max_accel_to_decel = 1500.
+
+class BenchStepper:
+    def __init__(self, ffi_main, ffi_lib, sc, step_dist, alloc_func, *params):
+        self._stepqueue = sc
+        self._inv_step_dist = 1. / step_dist
+        self._commanded_pos = 0.
+        self._stepper_kinematics = ffi_main.gc(
+            getattr(ffi_lib, alloc_func)(*params), ffi_lib.free)
+        ffi_lib.itersolve_set_stepcompress(
+            self._stepper_kinematics, sc, step_dist)
+
+class CartesianSolver:
+    step_dists = [.0125, .0125, .0025]
+    def setup_steppers(self, ffi_main, ffi_lib, scs):
+        self.steppers = [
+            BenchStepper(ffi_main, ffi_lib, sc, step_dist,
+                         'cartesian_stepper_alloc', axis)
+            for sc, step_dist, axis in zip(scs, self.step_dists, 'xyz')]
+    def calc_position(self, i, pos):
+        return pos[i]
+    def gen_position(self, rnd, pos):
+        z = pos[2]
+        if rnd.random() < .2:
+            z = rnd.uniform(0., 50.)
+        return [rnd.uniform(0., 200.), rnd.uniform(0., 200.), z, 0.]
+    def analytic_move(self, group, print_time, move):
+        group.step_move(print_time, move, move.start_pos, move.axes_d)
+
+class DeltaSolver:
+    step_dists = [.0125, .0125, .0125]
+    def __init__(self):
+        self.arm2 = [250.**2] * 3
+        self.towers = [(math.cos(math.radians(angle)) * 120.,
+                        math.sin(math.radians(angle)) * 120.)
+                       for angle in [210., 330., 90.]]
+    def setup_steppers(self, ffi_main, ffi_lib, scs):
+        self.steppers = [
+            BenchStepper(ffi_main, ffi_lib, sc, step_dist,
+                         'delta_stepper_alloc', arm2, tower[0], tower[1])
+            for sc, step_dist, arm2, tower in zip(
+                    scs, self.step_dists, self.arm2, self.towers)]
+    def calc_position(self, i, pos):
+        return math.sqrt(self.arm2[i] - (self.towers[i][0] - pos[0])**2
+                         - (self.towers[i][1] - pos[1])**2) + pos[2]
+    def gen_position(self, rnd, pos):
+        if rnd.random() < .1:
+            # Z only move
+            return [pos[0], pos[1], rnd.uniform(0., 100.), 0.]
+        angle = rnd.uniform(0., 2. * math.pi)
+        radius = math.sqrt(rnd.random()) * 80.
+        z = pos[2]
+        if rnd.random() < .2:
+            z = rnd.uniform(0., 100.)
+        return [radius * math.cos(angle), radius * math.sin(angle), z, 0.]
+    def analytic_move(self, group, print_time, move):
+        # See delta.py
+        axes_d = move.axes_d
+        move_d = move.move_d
+        movexy_r = 1.
+        movez_r = 0.
+        inv_movexy_d = 1. / move_d
+        if not axes_d[0] and not axes_d[1]:
+            movez_r = axes_d[2] * inv_movexy_d
+            movexy_r = inv_movexy_d = 0.
+        elif axes_d[2]:
+            movexy_d = math.sqrt(axes_d[0]**2 + axes_d[1]**2)
+            movexy_r = movexy_d * inv_movexy_d
+            movez_r = axes_d[2] * inv_movexy_d
+            inv_movexy_d = 1. / movexy_d
+        origx, origy, origz = move.start_pos[:3]
+        towers = []
+        for i in range(3):
+            towerx_d = self.towers[i][0] - origx
+            towery_d = self.towers[i][1] - origy
+            vt_startxy_d = (towerx_d*axes_d[0] + towery_d*axes_d[1])*inv_movexy_d
+            tangentxy_d2 = towerx_d**2 + towery_d**2 - vt_startxy_d**2
+            vt_arm_d = math.sqrt(self.arm2[i] - tangentxy_d2)
+            towers.append((origz, vt_startxy_d, vt_arm_d))
+        group.step_delta_move(
+            print_time, move, towers, move.accel_r * move_d,
+            move.cruise_r * move_d, move.decel_r * move_d, movexy_r, movez_r)
+
+SOLVERS = {'cartesian': CartesianSolver, 'delta': DeltaSolver}
+
+def gen_moves(kin, count, seed):
+    rnd = random.Random(seed)
+    toolhead = BenchToolHead()
+    pos = kin.gen_position(rnd, [0., 0., 10., 0.])
+    moves = []
+    while len(moves) < count:
+        newpos = kin.gen_position(rnd, pos)
+        move = Move(toolhead, pos, newpos, rnd.choice([5., 50., 150., 300.]))
+        if not move.move_d:
+            continue
+        cruise_v2 = min(move.max_cruise_v2, .5 * move.delta_v2)
+        if rnd.random() < .3:
+            # Constant velocity move
+            move.set_junction(cruise_v2, cruise_v2, cruise_v2)
+        else:
+            move.set_junction(0., cruise_v2, 0.)
+        moves.append(move)
+        pos = newpos
+    return moves
+
+def run_solver(ffi_main, ffi_lib, kin, solver, moves, capture=""):
+    sync = StepSync(ffi_main, ffi_lib, 3, capture)
+    kin.setup_steppers(ffi_main, ffi_lib, sync.scs)
+    for i, s in enumerate(kin.steppers):
+        s._commanded_pos = (kin.calc_position(i, moves[0].start_pos)
+                            * s._inv_step_dist)
+    group = mcu.StepperGroup([(s, i) for i, s in enumerate(kin.steppers)])
+    gen_time = 0.
+    print_time = 0.100
+    for i, move in enumerate(moves):
+        start = time.time()
+        if solver == 'iterative':
+            group.step_itersolve(print_time, move)
+        else:
+            kin.analytic_move(group, print_time, move)
+        gen_time += time.time() - start
+        print_time += move.accel_t + move.cruise_t + move.decel_t
+        if i % 10 == 9:
+            sync.flush(print_time)
+    sync.flush(print_time + 1.)
+    sync.close()
+    return gen_time
+
+def read_capture_steps(fname):
+    data = array.array('I')
+    f = open(fname, 'rb')
+    data.fromstring(f.read())
+    f.close()
+    steps = array.array('I')
+    pos = 3
+    while pos < len(data):
+        rtype = data[pos]
+        if rtype == CAP_STEPS:
+            count = data[pos+1]
+            steps.extend(data[pos+2:pos+2+count])
+            pos += 2 + count
+        elif rtype == CAP_MSG:
+            pos += 2 + data[pos+1]
+        else:
+            pos += 3
+    return steps
+
+def bench_solvers(ffi_main, ffi_lib, options):
+    failures = []
+    for kin_name in options.solver.split(','):
+        kin = SOLVERS[kin_name]()
+        moves = gen_moves(kin, options.moves, options.seed)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            steps = {}
+            for solver in ['analytic', 'iterative']:
+                prefix = os.path.join(tmpdir, solver)
+                run_solver(ffi_main, ffi_lib, kin, solver, moves, prefix)
+                steps[solver] = [read_capture_steps("%s%d" % (prefix, oid))
+                                 for oid in range(3)]
+        finally:
+            shutil.rmtree(tmpdir)
+        total_steps = sum([len(s) for s in steps['analytic']])
+        for solver in ['analytic', 'iterative']:
+            best = min([run_solver(ffi_main, ffi_lib, kin, solver, moves)
+                        for i in range(options.repeat)])
+            print "%s %s: moves=%d steps=%d steps/sec=%.0f" % (
+                kin_name, solver, len(moves), total_steps,
+                total_steps / best)
+        # Compare the step times of the two solvers
+        differ = max_dev = 0
+        for oid, (asteps, isteps) in enumerate(zip(steps['analytic'],
+                                                   steps['iterative'])):
+            if len(asteps) != len(isteps):
+                failures.append("%s oid=%d step count %d vs %d" % (
+                    kin_name, oid, len(asteps), len(isteps)))
+                continue
+            for a, b in zip(asteps, isteps):
+                if a != b:
+                    differ += 1
+                    dev = abs(((a - b + 2**31) & 0xffffffff) - 2**31)
+                    max_dev = max(max_dev, dev)
+        print ("%s: %d of %d step times differ, max deviation %d clocks"
+               " (%.1fns)" % (kin_name, differ, total_steps, max_dev,
+                              max_dev * 1000000000. / MCU_FREQ))
+    if failures:
+        print "Step counts differ: %s" % (", ".join(failures),)
+        sys.exit(1)
+
+def main():
+    usage = "%prog [options] <capture files>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-g", "--golden", dest="golden",
+                    help="directory with golden output files")
+    opts.add_option("-u", "--update", action="store_true", dest="update",
+                    help="write golden output files instead of comparing")
+    opts.add_option("-f", "--fast", action="store_true", dest="fast",
+                    default=False,
+                    help="use the fast compression mode")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=5,
+                    help="number of benchmark runs (best is reported)")
+    opts.add_option("-t", "--threads", dest="threads",
+                    help="run a synthetic workload with the given comma"
+                    " separated step_threads counts (eg, 1,2,4)")
+    opts.add_option("-s", "--steppers", type="int", dest="steppers",
+                    default=8, help="number of steppers in thread mode")
+    opts.add_option("-m", "--moves", type="int", dest="moves", default=1000,
+                    help="number of moves in thread and solver mode (steps"
+                    " per stepper in merge mode)")
+    opts.add_option("--merge", dest="merge",
+                    help="benchmark the steppersync message merge with the"
+                    " given comma separated stepper counts (eg, 3,8,16)")
+    opts.add_option("--solver", dest="solver",
+                    help="compare the analytic and iterative step solvers"
+                    " for the given comma separated kinematics"
+                    " (cartesian, delta)")
+    opts.add_option("--seed", type="int", dest="seed", default=1,
+                    help="random seed of the moves in solver and merge"
+                    " mode")
+    options, args = opts.parse_args()
+    ffi_main, ffi_lib = chelper.get_ffi()
+    if options.solver:
+        if args:
+            opts.error("Capture files are not used with --solver")
+        for kin_name in options.solver.split(','):
+            if kin_name not in SOLVERS:
+                opts.error("Unknown kinematics '%s'" % (kin_name,))
+        bench_solvers(ffi_main, ffi_lib, options)
+        return
+    if options.merge:
+        if args:
+            opts.error("Capture files are not used with --merge")
+        bench_merge(ffi_main, ffi_lib, options)
+        return
+    if options.threads:
+        if args:
+            opts.error("Capture files are not used with --threads")
+        bench_threads(ffi_main, ffi_lib, options)
+        return
+    if not args:
+        opts.error("Incorrect number of arguments")
+    if options.update and not options.golden:
+        opts.error("The --update option requires --golden")
+
+    total_steps = total_msgs = total_bytes = total_time = 0.
+    failures = []
+    for fname in args:
+        data = array.array('I')
+        f = open(fname, 'rb')
+        data.fromstring(f.read())
+        f.close()
+        res, duration = replay(ffi_main, ffi_lib, data, options.fast,
+                               count=options.repeat)
+        steps = res.steps
+        total_steps += steps
+        total_msgs += res.messages
+        total_bytes += res.bytes
+        total_time += duration
+        print ("%s: oid=%d steps=%d steps/sec=%.0f msgs/1000steps=%.2f"
+               " bytes=%d max_error=%d peak_error=%d" % (
+                   os.path.basename(fname), res.oid, steps,
+                   steps / duration, 1000. * res.messages / max(1, steps),
+                   res.bytes, res.max_error, res.peak_error))
+        if not options.golden:
+            continue
+        golden = os.path.join(options.golden,
+                              os.path.basename(fname) + ".golden")
+        if options.update:
+            replay(ffi_main, ffi_lib, data, options.fast, golden)
+            continue
+        out_filename = golden + ".out"
+        replay(ffi_main, ffi_lib, data, options.fast, out_filename)
+        if not os.path.exists(golden) or not filecmp.cmp(
+                golden, out_filename, shallow=False):
+            failures.append(os.path.basename(fname))
+        else:
+            os.unlink(out_filename)
+    print ("Total: steps=%d steps/sec=%.0f msgs/1000steps=%.2f bytes=%d" % (
+        total_steps, total_steps / total_time,
+        1000. * total_msgs / max(1, total_steps), total_bytes))
+    if failures:
+        print "Output does not match golden files: %s" % (
+            " ".join(failures),)
+        sys.exit(1)
+    if options.golden and not options.update:
+        print "Output matches golden files"
+
+if __name__ == '__main__':
+    main()
@@ -42,3 +42,17 @@ echo "=============== Test invoke klippy"
 $PYTHON klippy/klippy.py config/example.cfg -i /dev/null -o ${HOSTDIR}/output -v -d ${DICTDIR}/atmega2560-16mhz.dict
 $PYTHON klippy/parsedump.py ${DICTDIR}/atmega2560-16mhz.dict ${HOSTDIR}/output > ${HOSTDIR}/output-parsed
 echo "travis_fold:end:klippy"
+
+
+######################################################################
+# Run host code regression checks
+######################################################################
+
+echo "travis_fold:start:host_checks"
+echo "=============== Test python and C look-ahead planners"
+$PYTHON scripts/lookahead_check.py
+echo "=============== Test step compression golden output"
+$PYTHON scripts/stepcompress_bench.py -r 1 -g test/stepcompress test/stepcompress/*.mcu.?
+echo "=============== Test step generation thread consistency"
+$PYTHON scripts/stepcompress_bench.py -t 1,2,4 -r 1
+echo "travis_fold:end:host_checks"